@@ -0,0 +1,95 @@
+"""Authentication overhead per request, without the database.
+
+    python -m benchmarks.auth --requests 20000
+
+For each signing algorithm, times reading the user of an access token:
+building the strategy for every request (keys parsed each time), one shared
+strategy decoding every token, and the token cache. The user manager hands
+out a fixed user, so only the auth work is measured, not the user SELECT
+that the cache also saves.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+from src.auth.cache import user_cache
+from src.auth.service import create_jwt_strategy
+# Registers Bench, User's mapper can't be configured without it
+from src.benches.models import Bench  # noqa: F401
+from src.users.models import User
+
+PRIVATE_KEYS = {
+    "ES256": lambda: ec.generate_private_key(ec.SECP256R1()),
+    "EdDSA": ed25519.Ed25519PrivateKey.generate,
+}
+
+
+class _UserManager:
+    def __init__(self, user: User):
+        self.user = user
+
+    def parse_id(self, value: str) -> int:
+        return int(value)
+
+    async def get(self, user_id: int) -> User:
+        return self.user
+
+
+def _write_key(directory: str, algorithm: str) -> str:
+    path = os.path.join(directory, f"{algorithm}.pem")
+    with open(path, "wb") as f:
+        f.write(
+            PRIVATE_KEYS[algorithm]().private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return path
+
+
+async def _per_second(requests: int, read) -> float:
+    started = time.perf_counter()
+    for _ in range(requests):
+        assert await read() is not None
+    return requests / (time.perf_counter() - started)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    args = parser.parse_args()
+
+    user = User(id=1, email="user@example.com", username="user", is_active=True)
+    manager = _UserManager(user)
+    ttl = user_cache.ttl
+    with tempfile.TemporaryDirectory() as directory:
+        for algorithm in ("HS256", "ES256", "EdDSA"):
+            key = None if algorithm == "HS256" else _write_key(directory, algorithm)
+            strategy = create_jwt_strategy(algorithm, key)
+            token = await strategy.write_token(user)
+
+            user_cache.ttl = 0
+            per_request = await _per_second(
+                args.requests,
+                lambda: create_jwt_strategy(algorithm, key).read_token(token, manager),
+            )
+            shared = await _per_second(
+                args.requests, lambda: strategy.read_token(token, manager)
+            )
+            user_cache.ttl = ttl
+            user_cache.clear()
+            cached = await _per_second(args.requests, lambda: strategy.read_token(token, manager))
+            print(
+                f"{algorithm:<6} per request {per_request:9.0f}/s, "
+                f"shared {shared:9.0f}/s, cached {cached:9.0f}/s"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
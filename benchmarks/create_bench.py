@@ -0,0 +1,93 @@
+"""Throughput of the bench create endpoints against the configured database.
+
+    python -m benchmarks.create_bench --requests 2000 --concurrency 20
+
+Requests go through the ASGI app in process, authenticated as the user
+with the lowest id, so the numbers are the app and database cost without
+the network. Created benches are deleted afterwards.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from httpx import ASGITransport, AsyncClient
+from redis import asyncio as aioredis
+from sqlalchemy import select
+
+from src.auth.dependencies import current_active_user
+from src.benches.models import Bench
+from src.benches.service import delete_benches
+from src.config import REDIS_URI
+from src.database import async_session_maker
+from src.main import app
+from src.users.models import User
+
+NAME_PREFIX = "benchmark-"
+
+
+def _bench(i: int) -> dict:
+    return {
+        "name": f"{NAME_PREFIX}{i}",
+        "description": None,
+        "count": 1,
+        "latitude": random.uniform(-60, 60),
+        "longitude": random.uniform(-180, 180),
+    }
+
+
+async def _run(client: AsyncClient, concurrency: int, calls: list[tuple[str, object]]) -> float:
+    queue = asyncio.Queue()
+    for call in calls:
+        queue.put_nowait(call)
+
+    async def worker():
+        while not queue.empty():
+            url, payload = queue.get_nowait()
+            response = await client.post(url, json=payload)
+            assert response.status_code == 200, response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    redis = aioredis.from_url(REDIS_URI)
+    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    async with async_session_maker() as session:
+        user = (await session.scalars(select(User).order_by(User.id).limit(1))).one()
+    app.dependency_overrides[current_active_user] = lambda: user
+
+    try:
+        async with AsyncClient(transport=ASGITransport(app), base_url="http://bench") as client:
+            single = [("/create_bench", _bench(i)) for i in range(args.requests)]
+            elapsed = await _run(client, args.concurrency, single)
+            print(f"create_bench:   {args.requests / elapsed:8.1f} req/s")
+
+            batches = [
+                ("/create_benches", [_bench(i) for i in range(start, start + args.batch_size)])
+                for start in range(0, args.requests, args.batch_size)
+            ]
+            elapsed = await _run(client, args.concurrency, batches)
+            print(
+                f"create_benches: {len(batches) / elapsed:8.1f} req/s, "
+                f"{args.requests / elapsed:8.1f} benches/s"
+            )
+    finally:
+        async with async_session_maker() as session:
+            await delete_benches(session, Bench.name.startswith(NAME_PREFIX))
+            await session.commit()
+        await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
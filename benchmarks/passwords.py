@@ -0,0 +1,62 @@
+"""Event loop lag during a burst of logins.
+
+    python -m benchmarks.passwords --logins 50
+
+Verifies ``--logins`` passwords at once, on the event loop like the login
+used to and through the password hasher's thread pool, while a ticker
+measures how late the loop wakes it up. Other requests of the worker wait
+that long.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from src.auth.passwords import PasswordHasher
+
+TICK = 0.001
+
+
+async def _ticker(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def _run(label: str, logins: int, verify) -> None:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    await asyncio.sleep(TICK)
+    started = time.perf_counter()
+    await asyncio.gather(*(verify() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    print(
+        f"{label:<10} {logins / elapsed:6.1f} logins/s, loop lag "
+        f"median {statistics.median(lags) * 1000:7.1f} ms, max {max(lags) * 1000:7.1f} ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=50)
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(max_pending=args.logins)
+    hashed = hasher.helper.hash("password")
+
+    async def inline():
+        hasher.helper.verify_and_update("password", hashed)
+
+    async def pooled():
+        await hasher.verify_and_update("password", hashed)
+
+    await _run("inline", args.logins, inline)
+    await _run("executor", args.logins, pooled)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
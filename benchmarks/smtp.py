@@ -0,0 +1,184 @@
+"""Verification email throughput against a local debugging SMTP server.
+
+    python -m benchmarks.smtp --emails 500 --latency 20
+
+Compares a connection per email (how the task used to send), the pooled
+connection and batches. The server speaks implicit TLS with a throwaway
+certificate and can delay its replies to simulate a remote server.
+"""
+import argparse
+import base64
+import datetime
+import os
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from src.tasks.smtp import SMTPPool
+from src.tasks.task import get_verification_email_template
+
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    """Accepts every message without delivering it. Recipients containing
+    ``refused`` are rejected, ones containing ``deferred`` told to try later."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ssl_context: Optional[ssl.SSLContext] = None, latency: float = 0):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.ssl_context = ssl_context
+        self.latency = latency
+        self.messages: list[bytes] = []
+        self.connections = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    server: DebugSMTPServer
+
+    def setup(self):
+        self.server.connections += 1
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+
+    def reply(self, line: str):
+        time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 debug ESMTP")
+        while line := self.rfile.readline():
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-debug\r\n250-8BITMIME\r\n250 AUTH PLAIN")
+            elif verb == "AUTH":
+                base64.b64decode(command.split(" ")[2])
+                self.reply("235 Authenticated")
+            elif verb == "RCPT" and "refused" in command:
+                self.reply("550 No such user")
+            elif verb == "RCPT" and "deferred" in command:
+                self.reply("450 Try again later")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = bytearray()
+                while (line := self.rfile.readline()) not in (b".\r\n", b""):
+                    data += line
+                self.server.messages.append(bytes(data))
+                self.reply("250 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+def _self_signed_context() -> ssl.SSLContext:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path = os.path.join(directory, "cert.pem")
+        key_path = os.path.join(directory, "key.pem")
+        with open(cert_path, "wb") as f:
+            f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, "wb") as f:
+            f.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption(),
+                )
+            )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--emails", type=int, default=300)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0, help="ms before each reply")
+    args = parser.parse_args()
+
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    with DebugSMTPServer(_self_signed_context(), args.latency / 1000) as server:
+        def pool(**kwargs) -> SMTPPool:
+            return SMTPPool(
+                "127.0.0.1", server.port, "ssl", "user", "pass", ssl_context=client_context, **kwargs
+            )
+
+        def run(label: str, send) -> None:
+            started = time.perf_counter()
+            connections = server.connections
+            send()
+            elapsed = time.perf_counter() - started
+            print(
+                f"{label:<16} {args.emails / elapsed:8.1f} emails/s, "
+                f"{server.connections - connections} connections"
+            )
+
+        messages = [
+            get_verification_email_template(f"user{i}@example.com", f"token-{i}")
+            for i in range(args.emails)
+        ]
+
+        def per_email():
+            for message in messages:
+                # A fresh connection for every email
+                pool(max_messages=1).send([message])
+
+        def pooled():
+            shared = pool()
+            for message in messages:
+                shared.send([message])
+            shared.close()
+
+        def batched():
+            shared = pool()
+            for start in range(0, len(messages), args.batch_size):
+                shared.send(messages[start : start + args.batch_size])
+            shared.close()
+
+        run("connection/email", per_email)
+        run("pooled", pooled)
+        run("batched", batched)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Write and read throughput of the configured storage backend.
+
+    STORAGE_BACKEND=local python -m benchmarks.storage --objects 200 --size 2000000
+
+Objects are written in 256 KiB chunks, like photo uploads, under a
+``benchmark/`` prefix and deleted afterwards.
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+
+from src.storage import UPLOAD_CHUNK_SIZE, Storage, create_storage
+
+PREFIX = "benchmark/"
+
+
+async def _write(storage: Storage, name: str, data: bytes) -> None:
+    writer = await storage.open_writer(name, "application/octet-stream")
+    for start in range(0, len(data), UPLOAD_CHUNK_SIZE):
+        await writer.write(data[start : start + UPLOAD_CHUNK_SIZE])
+    await writer.close()
+
+
+async def _timed(concurrency: int, calls) -> float:
+    queue = asyncio.Queue()
+    for call in calls:
+        queue.put_nowait(call)
+
+    async def worker():
+        while not queue.empty():
+            await queue.get_nowait()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=100)
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    storage = create_storage()
+    data = os.urandom(args.size)
+    names = [f"{PREFIX}{uuid.uuid4().hex}" for _ in range(args.objects)]
+    megabytes = args.objects * args.size / 1e6
+    try:
+        elapsed = await _timed(args.concurrency, (_write(storage, name, data) for name in names))
+        print(f"write: {args.objects / elapsed:8.1f} objects/s, {megabytes / elapsed:8.1f} MB/s")
+
+        elapsed = await _timed(args.concurrency, (storage.read(name) for name in names))
+        print(f"read:  {args.objects / elapsed:8.1f} objects/s, {megabytes / elapsed:8.1f} MB/s")
+    finally:
+        await asyncio.gather(*(storage.delete(name) for name in names))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,25 @@
+"""Read by gunicorn from the working directory, next to the command line
+options in the Dockerfile.
+
+Workers write their metrics to PROMETHEUS_MULTIPROC_DIR so that /metrics
+adds up all of them, whichever worker answers it.
+"""
+import os
+import shutil
+
+# Before anything imports prometheus_client, it picks single or multiprocess
+# mode on import
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+
+
+def on_starting(server):
+    # Samples of a previous run would be added to this one's
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,99 @@
+"""Users of recently verified tokens, so that authenticated requests don't
+load the user from Postgres every time.
+
+Entries are keyed by the token's hash and live for at most
+``AUTH_CACHE_TTL`` seconds, never past the token's expiry. Whatever changes
+a user calls ``invalidate_user``, which reaches the other workers over the
+cache invalidation channel.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi_cache import FastAPICache
+from sqlalchemy.orm import make_transient_to_detached
+
+from src.cache import TwoTierBackend, invalidation_handlers
+from src.config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from src.users.models import User
+
+logger = logging.getLogger(__name__)
+
+USER_INVALIDATION = "user"
+
+
+def token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+class UserCache:
+    """Column values of users by token key, least recently used entries are
+    evicted beyond ``max_size``."""
+
+    def __init__(self, max_size: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Bumped by every invalidation, see ``set``
+        self.version = 0
+        self._entries: OrderedDict[bytes, tuple[float, dict]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: bytes) -> Optional[User]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, values = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        # A new instance for every request, sessions may attach and change it.
+        # Filled in like the ORM loads rows, User() would track every value.
+        user = User.__mapper__.class_manager.new_instance()
+        user.__dict__.update(values)
+        make_transient_to_detached(user)
+        return user
+
+    def set(
+        self, key: bytes, user: User, expires_at: Optional[float], version: int
+    ) -> None:
+        """Cache ``user`` unless it was invalidated since ``version`` was
+        read, the user may have been loaded before the change."""
+        if self.ttl <= 0 or self.max_size <= 0 or version != self.version:
+            return
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        self._entries[key] = (deadline, values)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int | str) -> None:
+        self.version += 1
+        user_id = int(user_id)
+        for key in [key for key, (_, values) in self._entries.items() if values["id"] == user_id]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self.version += 1
+        self._entries.clear()
+
+
+user_cache = UserCache()
+invalidation_handlers[USER_INVALIDATION] = user_cache
+
+
+async def invalidate_user(user_id: int) -> None:
+    user_cache.invalidate(user_id)
+    try:
+        backend = FastAPICache.get_backend()
+        if isinstance(backend, TwoTierBackend):
+            await backend.publish_invalidation(USER_INVALIDATION, str(user_id))
+    except Exception:
+        logger.warning("Error invalidating cached user %s", user_id, exc_info=True)
@@ -0,0 +1,13 @@
+from fastapi_users import FastAPIUsers
+
+from src.auth.manager import get_user_manager
+from src.auth.service import auth_backend
+from src.users.models import User
+
+fastapi_users = FastAPIUsers[User, int](
+    get_user_manager,
+    [auth_backend],
+)
+
+current_active_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
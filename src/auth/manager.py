@@ -1,22 +1,35 @@
-from typing import Optional
+import asyncio
+from typing import Any, Optional
 
 from fastapi import Depends, Request
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import (BaseUserManager, IntegerIDMixin, exceptions, models,
                            schemas, jwt)
 import jwt
 from fastapi_users.jwt import generate_jwt, decode_jwt
+from sqlalchemy import insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from src.auth.cache import invalidate_user
+from src.auth.passwords import password_hasher
+from src.benches.cache import invalidate_benches
+from src.benches.models import Bench
+from src.benches.service import delete_benches
+from src.cache import BENCHES_TAG, TILES_TAG, bump_generation
 from src.config import SECRET_PASS, SECRET_VER
-from src.constants import NON_UNIQ_FIELD
+from src.constants import NON_UNIQ_FIELD, VALIDATION_ERROR
 from src.database import User, get_user_db
 from src.exceptions import ErrorHTTPException
-from src.tasks.task import send_verification_email
+from src.tasks.outbox import queue_verification_email
+from src.users.service import find_taken_fields
 
 
 class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     reset_password_token_secret = SECRET_PASS
     verification_token_secret = SECRET_VER
+    # Benches deleted along with the user, see on_before_delete
+    _deleted_bench_ids: tuple[int, ...] = ()
 
     async def create(
         self,
@@ -24,33 +37,77 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
         safe: bool = False,
         request: Optional[Request] = None,
     ) -> models.UP:
-        try:
-            await self.validate_password(user_create.password, user_create)
-
-            existing_user = await self.user_db.get_by_email(user_create.email)
-            if existing_user is not None:
-                raise exceptions.UserAlreadyExists()
-
-            user_dict = (
-                user_create.create_update_dict()
-                if safe
-                else user_create.create_update_dict_superuser()
-            )
-            password = user_dict.pop("password")
-            user_dict["hashed_password"] = self.password_helper.hash(password)
+        await self.validate_password(user_create.password, user_create)
+        session = self.user_db.session
+        # Before hashing, taken values don't cost a hash
+        await self._check_unique(session, user_create)
 
-            created_user = await self.user_db.create(user_dict)
+        user_dict = (
+            user_create.create_update_dict()
+            if safe
+            else user_create.create_update_dict_superuser()
+        )
+        password = user_dict.pop("password")
+        user_dict["hashed_password"] = await password_hasher.hash(password)
 
-        except IntegrityError as e:
-            raise ErrorHTTPException(status_code=400, error_code=NON_UNIQ_FIELD,
-                                     detail='Пользователь с этим username уже существует' if "(username)" in str(e)
-                                     else "Пользователь с этим telegram username уже существует")
+        try:
+            created_user = await session.scalar(insert(User).values(user_dict).returning(User))
+            await session.commit()
+        except IntegrityError:
+            # Taken by a registration since the check, or a value the table
+            # constraints reject
+            await session.rollback()
+            await self._check_unique(session, user_create)
+            raise ErrorHTTPException(status_code=400, error_code=VALIDATION_ERROR,
+                                     detail="Недопустимые данные пользователя")
 
         await self.on_after_register(created_user, request)
         await self.request_verify(created_user, request)
 
         return created_user
 
+    async def _check_unique(self, session: AsyncSession, user_create: schemas.UC) -> None:
+        taken = await find_taken_fields(
+            session,
+            user_create.email,
+            user_create.username,
+            getattr(user_create, "telegram_username", None),
+        )
+        if "email" in taken:
+            raise exceptions.UserAlreadyExists()
+        if "username" in taken:
+            raise ErrorHTTPException(status_code=400, error_code=NON_UNIQ_FIELD,
+                                     detail="Пользователь с этим username уже существует")
+        if "telegram_username" in taken:
+            raise ErrorHTTPException(status_code=400, error_code=NON_UNIQ_FIELD,
+                                     detail="Пользователь с этим telegram username уже существует")
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[User]:
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            # As slow as a wrong password, not to tell which emails exist
+            await password_hasher.hash(credentials.password)
+            return None
+
+        verified, updated_password_hash = await password_hasher.verify_and_update(
+            credentials.password, user.hashed_password
+        )
+        if not verified:
+            return None
+        # Hashed with older parameters, see ARGON2_* in src.config
+        if updated_password_hash is not None:
+            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+        return user
+
+    async def _update(self, user: User, update_dict: dict[str, Any]) -> User:
+        password = update_dict.get("password")
+        if password is not None:
+            await self.validate_password(password, user)
+            update_dict = {key: value for key, value in update_dict.items() if key != "password"}
+            update_dict["hashed_password"] = await password_hasher.hash(password)
+        return await super()._update(user, update_dict)
+
     async def request_verify(
             self, user: models.UP, request: Optional[Request] = None
     ) -> None:
@@ -108,6 +165,63 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
 
         return verified_user
 
+    async def forgot_password(self, user: User, request: Optional[Request] = None) -> None:
+        if not user.is_active:
+            raise exceptions.UserInactive()
+
+        token_data = {
+            "sub": str(user.id),
+            "password_fgpt": await password_hasher.hash(user.hashed_password),
+            "aud": self.reset_password_token_audience,
+        }
+        token = generate_jwt(
+            token_data,
+            self.reset_password_token_secret,
+            self.reset_password_token_lifetime_seconds,
+        )
+        await self.on_after_forgot_password(user, token, request)
+
+    async def reset_password(
+            self, token: str, password: str, request: Optional[Request] = None
+    ) -> User:
+        try:
+            data = decode_jwt(
+                token,
+                self.reset_password_token_secret,
+                [self.reset_password_token_audience],
+            )
+        except jwt.PyJWTError:
+            raise exceptions.InvalidResetPasswordToken()
+
+        try:
+            user_id = data["sub"]
+            password_fingerprint = data["password_fgpt"]
+        except KeyError:
+            raise exceptions.InvalidResetPasswordToken()
+
+        try:
+            parsed_id = self.parse_id(user_id)
+        except exceptions.InvalidID:
+            raise exceptions.InvalidResetPasswordToken()
+
+        user = await self.get(parsed_id)
+
+        # Only valid until the password changes
+        valid_password_fingerprint, _ = await password_hasher.verify_and_update(
+            user.hashed_password, password_fingerprint
+        )
+        if not valid_password_fingerprint:
+            raise exceptions.InvalidResetPasswordToken()
+
+        if not user.is_active:
+            raise exceptions.UserInactive()
+
+        updated_user = await self._update(user, {"password": password})
+
+        await self.on_after_reset_password(user, request)
+
+        return updated_user
+
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
@@ -116,12 +230,42 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     ):
         print(f"User {user.id} has forgot their password. Reset token: {token}")
 
+    # Changed users must not be served from the token cache
+
+    async def on_after_update(
+        self, user: User, update_dict: dict, request: Optional[Request] = None
+    ) -> None:
+        await invalidate_user(user.id)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None) -> None:
+        await invalidate_user(user.id)
+
+    async def on_after_reset_password(
+        self, user: User, request: Optional[Request] = None
+    ) -> None:
+        await invalidate_user(user.id)
+
+    async def on_before_delete(self, user: User, request: Optional[Request] = None) -> None:
+        # Through the bench delete path, the foreign key cascade would leave
+        # the clusters behind. Committed along with the user
+        deleted = await delete_benches(self.user_db.session, Bench.creator_id == user.id)
+        self._deleted_bench_ids = tuple(bench_id for bench_id, _, _ in deleted)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None) -> None:
+        await invalidate_user(user.id)
+        if self._deleted_bench_ids:
+            await invalidate_benches(self._deleted_bench_ids)
+            # As for bulk creates, starting the tile cache over is cheaper
+            await bump_generation(BENCHES_TAG, TILES_TAG)
+
     async def on_after_request_verify(
         self, user: User, token: str, request: Optional[Request] = None
     ) -> None:
         print(f"Verification requested for user {user.id}. Verification token: {token}")
-        send_verification_email.delay(user.email, token)
+        # Sent with other emails of the next few seconds, see src.tasks.outbox
+        await asyncio.to_thread(queue_verification_email, user.email, token)
 
 
 async def get_user_manager(user_db=Depends(get_user_db)):
-    yield UserManager(user_db)
+    # All hashing goes through password_hasher, the helper only satisfies the base class
+    yield UserManager(user_db, password_hasher.helper)
@@ -0,0 +1,90 @@
+"""Password hashing off the event loop.
+
+Argon2 and bcrypt are slow on purpose, run inline a burst of logins would
+stall every other request of the worker. Both release the GIL while
+hashing, so a small thread pool is enough.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi_users.password import PasswordHelper
+from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+from pwdlib.hashers.bcrypt import BcryptHasher
+
+from src.config import (ARGON2_MEMORY_COST, ARGON2_PARALLELISM,
+                        ARGON2_TIME_COST, PASSWORD_HASH_QUEUE,
+                        PASSWORD_HASH_WORKERS)
+from src.constants import OVERLOADED
+from src.exceptions import ErrorHTTPException
+from src.metrics import (PASSWORD_HASH_DURATION, PASSWORD_HASH_PENDING,
+                         PASSWORD_HASH_REJECTED)
+
+T = TypeVar("T")
+
+
+def create_password_helper() -> PasswordHelper:
+    # Verifies hashes of the other hashers and of other Argon2 parameters,
+    # verify_and_update returns a new hash for those
+    return PasswordHelper(
+        PasswordHash(
+            (
+                Argon2Hasher(
+                    time_cost=ARGON2_TIME_COST,
+                    memory_cost=ARGON2_MEMORY_COST,
+                    parallelism=ARGON2_PARALLELISM,
+                ),
+                BcryptHasher(),
+            )
+        )
+    )
+
+
+class PasswordHasher:
+    """Runs ``helper`` in a thread pool, with at most ``max_pending`` calls
+    running or waiting for a thread."""
+
+    def __init__(
+        self,
+        helper: Optional[PasswordHelper] = None,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_QUEUE,
+    ):
+        self.helper = helper or create_password_helper()
+        self.max_pending = max_pending
+        self.pending = 0
+        # Threads are started on first use, after gunicorn has forked
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+
+    async def _run(self, operation: str, func: Callable[..., T], *args) -> T:
+        if self.pending >= self.max_pending:
+            PASSWORD_HASH_REJECTED.labels(operation).inc()
+            raise ErrorHTTPException(
+                status_code=503, error_code=OVERLOADED, detail="Too many logins, try again later"
+            )
+        self.pending += 1
+        PASSWORD_HASH_PENDING.inc()
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            PASSWORD_HASH_PENDING.dec()
+            PASSWORD_HASH_DURATION.labels(operation).observe(time.perf_counter() - started)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", self.helper.hash, password)
+
+    async def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> tuple[bool, Optional[str]]:
+        """Whether ``password`` matches, and its new hash when
+        ``hashed_password`` was made with other parameters or hasher."""
+        return await self._run(
+            "verify", self.helper.verify_and_update, password, hashed_password
+        )
+
+
+password_hasher = PasswordHasher()
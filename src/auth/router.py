@@ -1,23 +1,17 @@
-import uuid
-
 from fastapi import APIRouter, Depends
-from fastapi_users import FastAPIUsers
-from sqlalchemy import select
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_encode
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.auth.custom_verify import get_verify_router
+from src.auth.dependencies import fastapi_users
 from src.auth.manager import get_user_manager
-from src.auth.service import auth_backend, get_jwt_strategy
+from src.auth.service import CachedJWTStrategy, auth_backend, get_jwt_strategy
 from src.constants import NOT_FOUND
 from src.database import get_async_session
 from src.exceptions import ErrorHTTPException
-from src.users.models import User
 from src.users.schemas import UserCreate, UserRead
-
-fastapi_users = FastAPIUsers[User, uuid.UUID](
-    get_user_manager,
-    [auth_backend],
-)
+from src.users.service import get_by_telegram_username
 
 router = APIRouter()
 
@@ -46,9 +40,7 @@ async def tg_login(
     telegram_username: str, session: AsyncSession = Depends(get_async_session)
 ):
     async with session.begin():
-        stmt = select(User).where(User.telegram_username == telegram_username)
-        result = await session.execute(stmt)
-        user = result.scalar_one_or_none()
+        user = await get_by_telegram_username(session, telegram_username)
         if user:
             strategy = get_jwt_strategy()
             response = await auth_backend.login(strategy, user)
@@ -59,4 +51,22 @@ async def tg_login(
             )
 
 
+@tg_login_router.get("/jwt/jwks")
+async def get_jwks(strategy: CachedJWTStrategy = Depends(get_jwt_strategy)):
+    """Public key of the access tokens, for services that verify them
+    without calling the API. Only with ES256 or EdDSA signing."""
+    if strategy.public_key is None:
+        raise ErrorHTTPException(
+            status_code=404, error_code=NOT_FOUND, detail="Tokens are signed with a secret"
+        )
+    algorithm = get_default_algorithms()[strategy.algorithm]
+    jwk = algorithm.to_jwk(strategy.public_key, as_dict=True)
+    if strategy.algorithm == "ES256":
+        # PyJWT before 2.9 drops leading zero bytes, the coordinates have 32 bytes
+        numbers = strategy.public_key.public_numbers()
+        jwk["x"] = base64url_encode(numbers.x.to_bytes(32, "big")).decode()
+        jwk["y"] = base64url_encode(numbers.y.to_bytes(32, "big")).decode()
+    return {"keys": [{**jwk, "alg": strategy.algorithm, "use": "sig"}]}
+
+
 router.include_router(tg_login_router)
@@ -1,9 +1,19 @@
+import functools
+from typing import Optional
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from fastapi import Response, status
 from fastapi.responses import JSONResponse
+from fastapi_users import BaseUserManager, exceptions
 from fastapi_users.authentication import (AuthenticationBackend,
                                           CookieTransport, JWTStrategy)
+from fastapi_users.jwt import decode_jwt
 
-from src.config import SECRET
+from src.auth.cache import token_key, user_cache
+from src.config import JWT_ALGORITHM, JWT_LIFETIME, JWT_PRIVATE_KEY, SECRET
+from src.users.models import User
 
 
 class CustomCookieTransport(CookieTransport):
@@ -16,14 +26,80 @@ class CustomCookieTransport(CookieTransport):
 
 cookie_transport = CustomCookieTransport(
     cookie_name="token",
-    cookie_max_age=24 * 3600,
+    cookie_max_age=JWT_LIFETIME,
     cookie_secure=True,
     cookie_samesite="none",
 )
 
 
-def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=24 * 3600)
+class CachedJWTStrategy(JWTStrategy):
+    """Reads the user of a token already seen from ``user_cache`` instead
+    of decoding the token and loading the user again."""
+
+    async def read_token(
+        self, token: Optional[str], user_manager: BaseUserManager[User, int]
+    ) -> Optional[User]:
+        if token is None:
+            return None
+        key = token_key(token)
+        user = user_cache.get(key)
+        if user is not None:
+            return user
+
+        version = user_cache.version
+        try:
+            data = decode_jwt(
+                token, self.decode_key, self.token_audience, algorithms=[self.algorithm]
+            )
+            user_id = data.get("sub")
+            if user_id is None:
+                return None
+        except jwt.PyJWTError:
+            return None
+
+        try:
+            user = await user_manager.get(user_manager.parse_id(user_id))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        user_cache.set(key, user, data.get("exp"), version)
+        return user
+
+
+def load_private_key(path: str, algorithm: str):
+    with open(path, "rb") as f:
+        key = load_pem_private_key(f.read(), password=None)
+    if algorithm == "ES256":
+        valid = isinstance(key, ec.EllipticCurvePrivateKey) and key.curve.name == "secp256r1"
+    else:
+        valid = isinstance(key, ed25519.Ed25519PrivateKey)
+    if not valid:
+        raise ValueError(f"{path} is not a {algorithm} private key")
+    return key
+
+
+def create_jwt_strategy(
+    algorithm: str = JWT_ALGORITHM, private_key: Optional[str] = JWT_PRIVATE_KEY
+) -> CachedJWTStrategy:
+    if algorithm == "HS256":
+        return CachedJWTStrategy(secret=SECRET, lifetime_seconds=JWT_LIFETIME)
+    if algorithm not in ("ES256", "EdDSA"):
+        raise ValueError(f"Unsupported JWT_ALGORITHM {algorithm!r}")
+    if not private_key:
+        raise ValueError(f"JWT_PRIVATE_KEY is required for {algorithm}")
+    # Parsed once, PyJWT takes key objects as they are
+    key = load_private_key(private_key, algorithm)
+    return CachedJWTStrategy(
+        secret=key,
+        lifetime_seconds=JWT_LIFETIME,
+        algorithm=algorithm,
+        public_key=key.public_key(),
+    )
+
+
+@functools.lru_cache
+def get_jwt_strategy() -> CachedJWTStrategy:
+    # Shared by all requests, it holds no per request state
+    return create_jwt_strategy()
 
 
 auth_backend = AuthenticationBackend(
@@ -0,0 +1,70 @@
+import logging
+from typing import Iterable, Optional
+
+from fastapi_cache import FastAPICache
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.benches.models import Bench
+from src.benches.schemas import BenchRead
+from src.cache import SingleFlight, bump_generation, get_generation
+
+logger = logging.getLogger(__name__)
+
+BENCH_CACHE_EXPIRE = 3600
+
+bench_loads = SingleFlight()
+
+
+def bench_tag(bench_id: int) -> str:
+    return f"bench:{bench_id}"
+
+
+def bench_cache_key(bench_id: int, generation: int) -> str:
+    return f"{FastAPICache.get_prefix()}:bench:{bench_id}:{generation}"
+
+
+async def _load_bench(
+    session: AsyncSession, bench_id: int, key: Optional[str]
+) -> Optional[bytes]:
+    backend = FastAPICache.get_backend()
+    value = None
+    if key is not None:
+        try:
+            value = await backend.get(key)
+        except Exception:
+            logger.warning("Error retrieving bench %s from cache", bench_id, exc_info=True)
+
+    if value is None:
+        result = await session.execute(select(Bench).where(Bench.id == bench_id))
+        bench = result.scalar_one_or_none()
+        if bench is None:
+            return None
+        value = BenchRead.model_validate(bench, from_attributes=True).model_dump_json().encode()
+        if key is None:
+            return value
+        try:
+            await backend.set(key, value, BENCH_CACHE_EXPIRE)
+        except Exception:
+            logger.warning("Error caching bench %s", bench_id, exc_info=True)
+    return value
+
+
+async def get_cached_bench(session: AsyncSession, bench_id: int) -> Optional[bytes]:
+    """``BenchRead`` JSON of the bench, read through the cache backend.
+    Concurrent misses for the same bench share one lookup.
+
+    The key holds the bench's generation, read before the SELECT: a row
+    read before a write committed is stored under a generation that the
+    write's invalidation has already left behind."""
+    generation = await get_generation(bench_tag(bench_id))
+    if generation is None:
+        # Unknown generation, don't risk caching under an old one
+        return await _load_bench(session, bench_id, None)
+    key = bench_cache_key(bench_id, generation)
+    return await bench_loads.do(key, lambda: _load_bench(session, bench_id, key))
+
+
+async def invalidate_benches(bench_ids: Iterable[int]) -> None:
+    """Call after the change has been committed."""
+    await bump_generation(*(bench_tag(bench_id) for bench_id in bench_ids))
@@ -0,0 +1,113 @@
+import json
+import logging
+import time
+from typing import AsyncIterator, Optional
+
+from anyio import CancelScope
+from fastapi_cache import FastAPICache
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.benches.models import Bench
+from src.cache import BENCHES_TAG, get_generation
+
+logger = logging.getLogger(__name__)
+
+EXPORT_MEDIA_TYPES = {
+    "geojson": "application/geo+json",
+    "ndjson": "application/x-ndjson",
+}
+# Rows fetched from the server side cursor, and written, at a time
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_COLUMNS = (
+    Bench.id,
+    Bench.name,
+    Bench.description,
+    Bench.count,
+    Bench.latitude,
+    Bench.longitude,
+    Bench.creator_id,
+    Bench.photo_url,
+)
+
+
+def export_epoch_key() -> str:
+    return f"{FastAPICache.get_prefix()}:export-epoch"
+
+
+async def _export_epoch() -> Optional[str]:
+    """Set once, in the same Redis as the benches generation: a generation
+    lost and counted up again from zero comes with a new epoch."""
+    try:
+        async with FastAPICache.get_backend().redis.pipeline(transaction=False) as pipe:
+            pipe.set(export_epoch_key(), time.time_ns(), nx=True)
+            pipe.get(export_epoch_key())
+            _, epoch = await pipe.execute()
+    except Exception:
+        logger.warning("Error reading the export epoch", exc_info=True)
+        return None
+    return epoch.decode() if isinstance(epoch, bytes) else epoch
+
+
+async def export_etag(session: AsyncSession, format: str) -> Optional[str]:
+    """ETag of the current dataset, ``None`` when it cannot be told. Every
+    write bumps the benches generation, the max id comes from the primary
+    key index."""
+    generation = await get_generation(BENCHES_TAG)
+    epoch = await _export_epoch()
+    if generation is None or epoch is None:
+        return None
+    max_id = await session.scalar(select(func.max(Bench.id)))
+    return f'"{format}-{epoch}-{generation}-{max_id or 0}"'
+
+
+def _ndjson_line(row) -> str:
+    return json.dumps(row._asdict(), ensure_ascii=False) + "\n"
+
+
+def _geojson_feature(row) -> str:
+    bench = row._asdict()
+    feature = {
+        "type": "Feature",
+        "id": bench.pop("id"),
+        "geometry": {
+            "type": "Point",
+            "coordinates": [bench.pop("longitude"), bench.pop("latitude")],
+        },
+        "properties": bench,
+    }
+    return json.dumps(feature, ensure_ascii=False)
+
+
+async def _partitions(session: AsyncSession) -> AsyncIterator[list]:
+    # Cancelling a fetch makes asyncpg drop the connection half way, so the
+    # stream is only cancelled between fetches, while a batch is written
+    with CancelScope(shield=True):
+        result = await session.stream(
+            select(*EXPORT_COLUMNS)
+            .order_by(Bench.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+    while True:
+        with CancelScope(shield=True):
+            rows = await result.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+async def export_benches(session: AsyncSession, format: str) -> AsyncIterator[bytes]:
+    """Every bench as NDJSON lines or one GeoJSON FeatureCollection, read
+    through a server side cursor so memory does not grow with the table."""
+    if format == "ndjson":
+        async for rows in _partitions(session):
+            yield "".join(_ndjson_line(row) for row in rows).encode()
+        return
+
+    yield b'{"type": "FeatureCollection", "features": ['
+    separator = "\n"
+    async for rows in _partitions(session):
+        yield (separator + ",\n".join(_geojson_feature(row) for row in rows)).encode()
+        separator = ",\n"
+    yield b"\n]}\n"
@@ -0,0 +1,174 @@
+import math
+
+from sqlalchemy import func
+
+EARTH_RADIUS = 6371008.8
+
+GEOHASH_PRECISION = 12
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_DECODE = {char: index for index, char in enumerate(GEOHASH_ALPHABET)}
+
+# Sorts after every geohash character under the "C" collation, so
+# ``prefix <= geohash < prefix + GEOHASH_UPPER`` is an index range scan
+GEOHASH_UPPER = "~"
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def geohash_bbox(geohash: str) -> tuple[float, float, float, float]:
+    """Return ``(min_lat, min_lon, max_lat, max_lon)`` of a geohash cell."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_DECODE[char]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            target = lon_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            target[1 - bit] = mid
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def geohash_neighbours(geohash: str) -> list[str]:
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    height = max_lat - min_lat
+    width = max_lon - min_lon
+    center_lat = (min_lat + max_lat) / 2
+    center_lon = (min_lon + max_lon) / 2
+
+    neighbours = []
+    for dlat in (-1, 0, 1):
+        latitude = center_lat + dlat * height
+        if not -90 < latitude < 90:
+            continue
+        for dlon in (-1, 0, 1):
+            if dlat == dlon == 0:
+                continue
+            longitude = (center_lon + dlon * width + 180) % 360 - 180
+            neighbour = encode_geohash(latitude, longitude, len(geohash))
+            if neighbour != geohash and neighbour not in neighbours:
+                neighbours.append(neighbour)
+    return neighbours
+
+
+def geohash_search_radius(latitude: float, longitude: float, geohash: str) -> float:
+    """Distance in metres from the point to the edge of the 3x3 block of cells
+    around ``geohash``: anything outside the block is at least this far away."""
+    min_lat, min_lon, max_lat, max_lon = geohash_bbox(geohash)
+    height = max_lat - min_lat
+    width = max_lon - min_lon
+
+    bounds = []
+    if min_lat - height > -90:
+        bounds.append(math.radians(latitude - (min_lat - height)) * EARTH_RADIUS)
+    if max_lat + height < 90:
+        bounds.append(math.radians(max_lat + height - latitude) * EARTH_RADIUS)
+
+    for dlon in (longitude - (min_lon - width), max_lon + width - longitude):
+        if dlon < 90:
+            # Distance from the point to the meridian's great circle
+            sin_distance = math.sin(math.radians(dlon)) * math.cos(math.radians(latitude))
+            bounds.append(math.asin(min(1.0, sin_distance)) * EARTH_RADIUS)
+
+    return min(bounds, default=math.inf)
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_distance(lat_column, lon_column, latitude: float, longitude: float):
+    """SQL expression for the haversine distance in metres, mirrors ``haversine``."""
+    a = func.pow(func.sin(func.radians(lat_column - latitude) / 2), 2) + func.cos(
+        math.radians(latitude)
+    ) * func.cos(func.radians(lat_column)) * func.pow(
+        func.sin(func.radians(lon_column - longitude) / 2), 2
+    )
+    return 2 * EARTH_RADIUS * func.asin(func.least(1.0, func.sqrt(a)))
+
+
+# Web Mercator cannot represent the poles
+MERCATOR_MAX_LATITUDE = 85.0511287798
+
+# Clusters are kept on a grid 2**CLUSTER_CELL_BITS times finer than the map
+# tiles of the zoom level, i.e. 64x64 px cells on 256 px tiles
+CLUSTER_CELL_BITS = 2
+CLUSTER_MAX_ZOOM = 14
+# Cells of lower zooms span whole continents, so that every write would lock
+# the same few rows; they are summed up from this zoom when read instead
+CLUSTER_MIN_ZOOM = 5
+
+
+def mercator_xy(latitude: float, longitude: float, zoom: int) -> tuple[float, float]:
+    """Web Mercator position in tile units, i.e. ``(1.5, 0.25)`` is in tile (1, 0)."""
+    n = 1 << zoom
+    latitude = max(-MERCATOR_MAX_LATITUDE, min(MERCATOR_MAX_LATITUDE, latitude))
+    phi = math.radians(latitude)
+    x = (longitude + 180) / 360 * n
+    y = (1 - math.log(math.tan(phi) + 1 / math.cos(phi)) / math.pi) / 2 * n
+    return x, y
+
+
+def tile_xy(latitude: float, longitude: float, zoom: int) -> tuple[int, int]:
+    n = 1 << zoom
+    x, y = mercator_xy(latitude, longitude, zoom)
+    return min(n - 1, max(0, int(x))), min(n - 1, max(0, int(y)))
+
+
+def tile_bbox(x: int, y: int, zoom: int) -> tuple[float, float, float, float]:
+    """Return ``(min_lat, min_lon, max_lat, max_lon)`` of a map tile."""
+    n = 1 << zoom
+
+    def latitude(tile_y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return latitude(y + 1), x / n * 360 - 180, latitude(y), (x + 1) / n * 360 - 180
+
+
+def cluster_cells(latitude: float, longitude: float) -> list[tuple[int, int, int]]:
+    """``(zoom, x, y)`` of the cluster cell holding the point on every stored
+    zoom level."""
+    x, y = tile_xy(latitude, longitude, CLUSTER_MAX_ZOOM + CLUSTER_CELL_BITS)
+    return [
+        (zoom, x >> (CLUSTER_MAX_ZOOM - zoom), y >> (CLUSTER_MAX_ZOOM - zoom))
+        for zoom in range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM + 1)
+    ]
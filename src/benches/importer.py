@@ -0,0 +1,344 @@
+"""Bulk import of benches from CSV, NDJSON or GeoJSON streams.
+
+Records are parsed incrementally, validated against ``BenchCreate`` and
+loaded batch by batch with ``COPY``, so memory use does not depend on the
+size of the input. Every batch is committed on its own: a fatal error (e.g.
+malformed JSON) keeps the benches imported so far.
+
+    python -m src.benches.importer benches.geojson --format geojson --creator-id 1
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+import re
+import sys
+from typing import AsyncIterable, AsyncIterator, Callable, Optional
+
+import asyncpg
+from pydantic import ValidationError
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.benches.geo import encode_geohash
+from src.benches.models import Bench
+from src.benches.schemas import BenchCreate
+from src.benches.service import update_clusters
+from src.cache import BENCHES_TAG, TILES_TAG, bump_generation, standalone_cache
+from src.config import REDIS_URI
+from src.database import async_session_maker
+
+IMPORT_FORMATS = ("csv", "ndjson", "geojson")
+IMPORT_BATCH_SIZE = 1000
+# Only the first errors are reported, the rest are counted
+IMPORT_MAX_ERRORS = 1000
+# A single line or GeoJSON feature may not exceed this many characters
+IMPORT_MAX_RECORD_SIZE = 1024 * 1024
+IMPORT_CHUNK_SIZE = 64 * 1024
+
+COPY_COLUMNS = ("name", "description", "count", "latitude", "longitude", "creator_id", "geohash")
+BENCH_FIELDS = ("name", "description", "count", "latitude", "longitude")
+
+_FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+_SEPARATORS = re.compile(r"[\s,]*")
+
+Chunks = AsyncIterable[bytes]
+# A record the reader could not parse comes as the ValueError to report
+Records = AsyncIterator[tuple[int, dict | ValueError]]
+
+
+class BenchImportError(Exception):
+    """The input cannot be parsed any further."""
+
+
+def _decoder():
+    # utf-8-sig drops the BOM spreadsheet exports like to start with
+    return codecs.getincrementaldecoder("utf-8-sig")()
+
+
+async def _lines(chunks: Chunks) -> AsyncIterator[tuple[int, str]]:
+    decoder = _decoder()
+    buffer = ""
+    line_no = 0
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_no += 1
+            yield line_no, line.rstrip("\r")
+        if len(buffer) > IMPORT_MAX_RECORD_SIZE:
+            raise BenchImportError(f"Line {line_no + 1} is too long")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield line_no + 1, buffer.rstrip("\r")
+
+
+async def _csv_records(chunks: Chunks) -> Records:
+    header = None
+    record, start = "", 0
+    async for line_no, line in _lines(chunks):
+        if record:
+            record += "\n" + line
+        elif line.strip():
+            record, start = line, line_no
+        else:
+            continue
+        if record.count('"') % 2:
+            # A quoted field goes on on the next line
+            if len(record) > IMPORT_MAX_RECORD_SIZE:
+                raise BenchImportError(f"Line {start}: unterminated quoted field")
+            continue
+
+        row = next(csv.reader([record]))
+        record = ""
+        if header is None:
+            header = [column.strip().lower() for column in row]
+            continue
+        yield start, {column: value for column, value in zip(header, row) if value != ""}
+
+    if record:
+        raise BenchImportError(f"Line {start}: unterminated quoted field")
+
+
+async def _ndjson_records(chunks: Chunks) -> Records:
+    async for line_no, line in _lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            # Lines are independent, so a broken one is just a bad row
+            yield line_no, ValueError(f"Invalid JSON: {e}")
+            continue
+        yield line_no, record
+
+
+async def _geojson_records(chunks: Chunks) -> Records:
+    """Features of a GeoJSON ``FeatureCollection``, one at a time. Records are
+    numbered by their position in the ``features`` array."""
+    decoder = json.JSONDecoder()
+    text_decoder = _decoder()
+    chunks = aiter(chunks)
+    buffer, pos = "", 0
+
+    async def read() -> bool:
+        nonlocal buffer, pos
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            buffer, pos = buffer[pos:] + text_decoder.decode(b"", final=True), 0
+            return False
+        buffer, pos = buffer[pos:] + text_decoder.decode(chunk), 0
+        return True
+
+    while True:
+        match = _FEATURES_START.search(buffer, pos)
+        if match:
+            pos = match.end()
+            break
+        # Keep enough of the tail for a "features" key split between chunks
+        pos = max(pos, len(buffer) - 64)
+        if not await read():
+            raise BenchImportError("No FeatureCollection features found")
+
+    index = 0
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if pos == len(buffer):
+            if not await read():
+                raise BenchImportError("Unterminated features array")
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            feature, end = decoder.raw_decode(buffer, pos)
+        except ValueError as e:
+            if len(buffer) - pos > IMPORT_MAX_RECORD_SIZE:
+                raise BenchImportError(f"Feature {index + 1} is too large")
+            if await read():
+                continue
+            raise BenchImportError(f"Feature {index + 1}: {e}")
+        pos = end
+        index += 1
+        yield index, feature
+
+
+RECORD_READERS: dict[str, Callable[[Chunks], Records]] = {
+    "csv": _csv_records,
+    "ndjson": _ndjson_records,
+    "geojson": _geojson_records,
+}
+
+
+def _bench_fields(record: dict | ValueError) -> dict:
+    if isinstance(record, ValueError):
+        raise record
+    if record.get("type") == "Feature":
+        geometry = record.get("geometry") or {}
+        if geometry.get("type") != "Point":
+            raise ValueError("Only Point geometries are supported")
+        longitude, latitude = geometry["coordinates"][:2]
+        record = {**(record.get("properties") or {}), "latitude": latitude, "longitude": longitude}
+    fields = {field: record[field] for field in BENCH_FIELDS if field in record}
+    fields.setdefault("description", None)
+    fields.setdefault("count", 1)
+    return fields
+
+
+def _error_detail(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in error.errors()
+        )
+    return str(error)
+
+
+async def _copy(session: AsyncSession, records: list[tuple]) -> None:
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        Bench.__tablename__, records=records, columns=COPY_COLUMNS
+    )
+
+
+async def _load_batch(
+    session: AsyncSession, benches: list[BenchCreate], lines: list[int], creator_id: int
+) -> list[tuple[int, str]]:
+    """Load ``benches``, read from ``lines``. Returns the line and error of
+    every bench the database rejected, the others are loaded."""
+    records = [
+        (
+            bench.name,
+            bench.description,
+            bench.count,
+            bench.latitude,
+            bench.longitude,
+            creator_id,
+            encode_geohash(bench.latitude, bench.longitude),
+        )
+        for bench in benches
+    ]
+    rejected = []
+    try:
+        try:
+            await _copy(session, records)
+        except asyncpg.DataError:
+            # A value the columns cannot hold concerns only its row, the
+            # batch is loaded again one row at a time to find them
+            await session.rollback()
+            loaded = []
+            for line, bench, record in zip(lines, benches, records):
+                try:
+                    async with session.begin_nested():
+                        await _copy(session, [record])
+                except asyncpg.DataError as e:
+                    rejected.append((line, str(e)))
+                else:
+                    loaded.append(bench)
+            benches = loaded
+        await update_clusters(session, [(bench.latitude, bench.longitude) for bench in benches])
+        await session.commit()
+    except (asyncpg.PostgresError, DBAPIError) as e:
+        # E.g. a creator that does not exist, every row would fail the same
+        await session.rollback()
+        raise BenchImportError(f"Lines {lines[0]}-{lines[-1]}: {e}") from e
+    return rejected
+
+
+async def import_benches(
+    session: AsyncSession,
+    chunks: Chunks,
+    format: str,
+    creator_id: int,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    on_progress: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """Import benches from ``chunks`` of a ``format`` file. Returns a report
+    shaped like ``BenchImportReport``, ``on_progress`` gets it after every batch."""
+    report = {"processed": 0, "imported": 0, "failed": 0, "errors": []}
+    batch: list[BenchCreate] = []
+    lines: list[int] = []
+
+    def add_error(line: int, detail: str) -> None:
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"line": line, "detail": detail})
+
+    async def flush() -> None:
+        rejected = await _load_batch(session, batch, lines, creator_id)
+        for line, detail in rejected:
+            add_error(line, detail)
+        report["imported"] += len(batch) - len(rejected)
+        batch.clear()
+        lines.clear()
+        if on_progress is not None:
+            on_progress(report)
+
+    try:
+        async for line, record in RECORD_READERS[format](chunks):
+            report["processed"] += 1
+            try:
+                batch.append(BenchCreate.model_validate(_bench_fields(record)))
+            except (ValidationError, ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+                add_error(line, _error_detail(e))
+                continue
+            lines.append(line)
+            if len(batch) >= batch_size:
+                await flush()
+        if batch:
+            await flush()
+    except BenchImportError as e:
+        if not report["imported"]:
+            raise
+        raise BenchImportError(f"{e} ({report['imported']} benches imported before)") from e
+    finally:
+        if report["imported"]:
+            await bump_generation(BENCHES_TAG, TILES_TAG)
+    return report
+
+
+async def _file_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(IMPORT_CHUNK_SIZE):
+            yield chunk
+
+
+def _print_progress(report: dict) -> None:
+    print(
+        f"processed {report['processed']}, imported {report['imported']}, "
+        f"failed {report['failed']}",
+        file=sys.stderr,
+    )
+
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import benches")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, required=True)
+    parser.add_argument("--creator-id", type=int, required=True)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    try:
+        async with standalone_cache(REDIS_URI), async_session_maker() as session:
+            report = await import_benches(
+                session,
+                _file_chunks(args.path),
+                args.format,
+                args.creator_id,
+                batch_size=args.batch_size,
+                on_progress=_print_progress,
+            )
+    except BenchImportError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['detail']}")
+    _print_progress(report)
+    return 0 if not report["failed"] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
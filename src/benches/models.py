@@ -1,14 +1,22 @@
 from typing import Optional
 
-from sqlalchemy import Float, ForeignKey, Integer, String
+from sqlalchemy import Float, ForeignKey, Index, Integer, SmallInteger, String
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.base import Base
+from src.benches.geo import GEOHASH_PRECISION, encode_geohash
 from src.users.models import User
 
 
+def _geohash_default(context) -> str:
+    params = context.get_current_parameters()
+    return encode_geohash(params["latitude"], params["longitude"])
+
+
 class Bench(Base):
     __tablename__ = "benches"
+    __table_args__ = (Index("ix_benches_latitude_longitude", "latitude", "longitude"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     name: Mapped[str] = mapped_column(String(36), nullable=False)
@@ -18,6 +26,16 @@ class Bench(Base):
     longitude: Mapped[Optional[float]] = mapped_column(Float, nullable=False)
     creator_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     photo_url: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    # Last uploaded photo, it replaces photo_url once processed by src.tasks.images
+    photo_object: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    # Resized copies of the photo, see src.tasks.images
+    photo_variants: Mapped[Optional[list]] = mapped_column(JSONB, nullable=True)
+    geohash: Mapped[str] = mapped_column(
+        String(GEOHASH_PRECISION, collation="C"),
+        default=_geohash_default,
+        nullable=False,
+        index=True,
+    )
 
     creator: Mapped[User] = relationship("User", back_populates="benches")
 
@@ -25,5 +43,24 @@ class Bench(Base):
         return (
             f"Bench(id={self.id!r}, name={self.name!r}, description={self.description!r}, "
             f"count={self.count!r}, latitude={self.latitude!r}, longitude={self.longitude!r}, "
-            f"creator_id={self.creator_id!r}, photo_url={self.photo_url!r})"
+            f"creator_id={self.creator_id!r}, photo_url={self.photo_url!r}, "
+            f"photo_object={self.photo_object!r}, photo_variants={self.photo_variants!r}, geohash={self.geohash!r})"
+        )
+
+
+class BenchCluster(Base):
+    __tablename__ = "bench_clusters"
+
+    zoom: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    x: Mapped[int] = mapped_column(Integer, primary_key=True)
+    y: Mapped[int] = mapped_column(Integer, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+    latitude_sum: Mapped[float] = mapped_column(Float, nullable=False)
+    longitude_sum: Mapped[float] = mapped_column(Float, nullable=False)
+
+    def __repr__(self) -> str:
+        return (
+            f"BenchCluster(zoom={self.zoom!r}, x={self.x!r}, y={self.y!r}, "
+            f"count={self.count!r}, latitude_sum={self.latitude_sum!r}, "
+            f"longitude_sum={self.longitude_sum!r})"
         )
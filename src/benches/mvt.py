@@ -0,0 +1,125 @@
+"""Minimal Mapbox Vector Tile (v2.1) encoder for point layers.
+
+Only the parts of vector_tile.proto needed for benches are written: point
+features with integer/string properties.
+"""
+from typing import Iterable, Optional, Union
+
+MVT_VERSION = 2
+MVT_EXTENT = 4096
+
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+# vector_tile.proto field numbers
+_TILE_LAYERS = 3
+_LAYER_NAME = 1
+_LAYER_FEATURES = 2
+_LAYER_KEYS = 3
+_LAYER_VALUES = 4
+_LAYER_EXTENT = 5
+_LAYER_VERSION = 15
+_FEATURE_ID = 1
+_FEATURE_TAGS = 2
+_FEATURE_TYPE = 3
+_FEATURE_GEOMETRY = 4
+_VALUE_STRING = 1
+_VALUE_INT = 4
+
+_GEOM_POINT = 1
+_MOVE_TO_ONE = (1 & 0x7) | (1 << 3)
+
+Property = Union[str, int]
+
+
+class PointFeature:
+    __slots__ = ("x", "y", "properties", "id")
+
+    def __init__(self, x: int, y: int, properties: dict[str, Property], id: Optional[int] = None):
+        self.x = x
+        self.y = y
+        self.properties = properties
+        self.id = id
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field: int, payload: bytes) -> bytes:
+    return _key(field, _LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _uint_field(field: int, value: int) -> bytes:
+    return _key(field, _VARINT) + _varint(value)
+
+
+def _packed(field: int, values: Iterable[int]) -> bytes:
+    return _bytes_field(field, b"".join(_varint(value) for value in values))
+
+
+def _value(value: Property) -> bytes:
+    if isinstance(value, str):
+        return _bytes_field(_VALUE_STRING, value.encode())
+    # int64 values are encoded as two's complement varints
+    return _uint_field(_VALUE_INT, value & 0xFFFFFFFFFFFFFFFF)
+
+
+def encode_layer(name: str, features: Iterable[PointFeature], extent: int = MVT_EXTENT) -> bytes:
+    keys: dict[str, int] = {}
+    values: dict[tuple[type, Property], int] = {}
+    encoded_features = []
+
+    for feature in features:
+        tags = []
+        for key, value in feature.properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+
+        body = b""
+        if feature.id is not None:
+            body += _uint_field(_FEATURE_ID, feature.id)
+        if tags:
+            body += _packed(_FEATURE_TAGS, tags)
+        body += _uint_field(_FEATURE_TYPE, _GEOM_POINT)
+        body += _packed(
+            _FEATURE_GEOMETRY, (_MOVE_TO_ONE, _zigzag(feature.x), _zigzag(feature.y))
+        )
+        encoded_features.append(_bytes_field(_LAYER_FEATURES, body))
+
+    return b"".join(
+        [
+            _uint_field(_LAYER_VERSION, MVT_VERSION),
+            _bytes_field(_LAYER_NAME, name.encode()),
+            *encoded_features,
+            *(_bytes_field(_LAYER_KEYS, key.encode()) for key in keys),
+            *(_bytes_field(_LAYER_VALUES, _value(value)) for _, value in values),
+            _uint_field(_LAYER_EXTENT, extent),
+        ]
+    )
+
+
+def encode_tile(layers: dict[str, list[PointFeature]]) -> bytes:
+    return b"".join(
+        _bytes_field(_TILE_LAYERS, encode_layer(name, features))
+        for name, features in layers.items()
+        if features
+    )
@@ -0,0 +1,125 @@
+import hashlib
+import uuid
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterable, Optional
+
+from src.storage import Storage, StorageError
+
+PHOTO_CONTENT_TYPES = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+}
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+UPLOAD_URL_EXPIRE = timedelta(minutes=15)
+# The bucket rejects uploads outside this range, the header must be sent as signed
+CONTENT_LENGTH_RANGE_HEADER = "x-goog-content-length-range"
+
+
+class PhotoUploadError(Exception):
+    pass
+
+
+class PhotoTooLargeError(PhotoUploadError):
+    pass
+
+
+def photo_prefix(bench_id: int) -> str:
+    return f"benches/{bench_id}/"
+
+
+def new_photo_name(bench_id: int, content_type: str) -> str:
+    # Random names: a signed URL can only ever overwrite its own upload
+    return f"{photo_prefix(bench_id)}{uuid.uuid4().hex}.{PHOTO_CONTENT_TYPES[content_type]}"
+
+
+async def create_upload_url(storage: Storage, object_name: str, content_type: str) -> dict:
+    """Signed URL the client PUTs the photo to, straight to the bucket. The
+    returned headers have to be sent along with the upload."""
+    headers = {
+        "Content-Type": content_type,
+        CONTENT_LENGTH_RANGE_HEADER: f"0,{PHOTO_MAX_SIZE}",
+    }
+    expires_at = datetime.now(timezone.utc) + UPLOAD_URL_EXPIRE
+    url = await storage.signed_upload_url(
+        object_name,
+        content_type,
+        {CONTENT_LENGTH_RANGE_HEADER: headers[CONTENT_LENGTH_RANGE_HEADER]},
+        UPLOAD_URL_EXPIRE,
+    )
+    return {
+        "upload_url": url,
+        "object_name": object_name,
+        "method": "PUT",
+        "headers": headers,
+        "expires_at": expires_at,
+    }
+
+
+async def check_upload(storage: Storage, object_name: str) -> None:
+    """Check the uploaded object. It is kept private, only the copies made
+    by ``src.tasks.images`` are published."""
+    stored = await storage.stat(object_name)
+    if stored is None:
+        raise PhotoUploadError("Photo has not been uploaded")
+    if stored.content_type not in PHOTO_CONTENT_TYPES or stored.size > PHOTO_MAX_SIZE:
+        await storage.delete(object_name)
+        raise PhotoUploadError("Photo must be a JPEG, PNG or WebP image of at most 10 MB")
+
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+async def store_photo(storage: Storage, chunks: AsyncIterable[bytes]) -> tuple[str, str]:
+    """Stream a photo into ``storage`` while hashing it, without holding more
+    than a chunk in memory. Photos are stored under their SHA-256, so the
+    same photo uploaded twice is kept once. Returns the object name and the
+    content type sniffed from the data."""
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    content_type = None
+    writer = None
+    upload_name = f"uploads/{uuid.uuid4().hex}"
+
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > PHOTO_MAX_SIZE:
+                raise PhotoTooLargeError("Photo is larger than 10 MB")
+            digest.update(chunk)
+            if writer is None:
+                head += chunk
+                if len(head) < 12:
+                    continue
+                content_type = sniff_content_type(head)
+                if content_type is None:
+                    raise PhotoUploadError("Photo must be a JPEG, PNG or WebP image")
+                writer = await storage.open_writer(upload_name, content_type)
+                chunk, head = head, b""
+            await writer.write(chunk)
+
+        if writer is None:
+            raise PhotoUploadError("Photo must be a JPEG, PNG or WebP image")
+        await writer.close()
+    except BaseException:
+        # Also on a timeout: the unfinished upload holds a session until aborted
+        if writer is not None:
+            with suppress(StorageError):
+                await writer.abort()
+        raise
+
+    name = f"photos/{digest.hexdigest()}.{PHOTO_CONTENT_TYPES[content_type]}"
+    if await storage.exists(name):
+        await storage.delete(upload_name)
+    else:
+        await storage.rename(upload_name, name)
+    return name, content_type
@@ -1,83 +1,210 @@
 import asyncio
-from datetime import datetime
+import logging
+from typing import Literal, Optional
 
-from fastapi import (APIRouter, BackgroundTasks, Depends, File, Query,
-                     UploadFile)
+from fastapi import (APIRouter, Body, Depends, Path, Query, Request,
+                     Response)
+from fastapi.responses import StreamingResponse
 from fastapi_cache.decorator import cache
-from fastapi_users import FastAPIUsers
-from google.api_core.retry import Retry
-from google.auth.exceptions import TransportError
-from google.cloud.exceptions import GoogleCloudError
-from firebase_admin import storage
-from sqlalchemy import and_, delete, func, insert, select, update
+from starlette.background import BackgroundTask
+from sqlalchemy import and_, insert, select, update
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.auth.manager import get_user_manager
-from src.auth.service import auth_backend
+from src.auth.dependencies import current_active_user, current_superuser
 from src.benches.models import Bench
-from src.benches.schemas import BenchCreate, BenchRead
-from src.config import FIREBASE_BUCKET
-from src.constants import EMPTY_LIST, NOT_FOUND, UNKNOWN, VALIDATION_ERROR
-from src.database import get_async_session
+from src.benches.cache import get_cached_bench, invalidate_benches
+from src.benches.exporter import (EXPORT_MEDIA_TYPES, export_benches,
+                                  export_etag)
+from src.benches.geo import CLUSTER_MAX_ZOOM
+from src.benches.importer import BenchImportError, import_benches
+from src.benches.photos import (PHOTO_MAX_SIZE, PhotoTooLargeError,
+                               PhotoUploadError, check_upload,
+                               create_upload_url, new_photo_name, photo_prefix,
+                               store_photo)
+from src.benches.schemas import (BenchClusterRead, BenchCreate,
+                                 BenchImportReport, BenchRead,
+                                 PhotoUploadComplete, PhotoUploadCreate,
+                                 PhotoUploadRead)
+from src.benches.service import (delete_benches, find_clusters,
+                                find_nearest_bench, in_bbox, update_clusters)
+from src.benches.tiles import (MVT_MEDIA_TYPE, TILE_MAX_ZOOM, get_tile,
+                              invalidate_tiles, tile_etag)
+from src.cache import (BENCHES_TAG, TAGGED_CACHE_EXPIRE, TILES_TAG,
+                       bump_generation, must_revalidate, tagged_key_builder)
+from src.constants import (EMPTY_LIST, NOT_FOUND, STORAGE_ERROR, UNKNOWN,
+                           VALIDATION_ERROR)
+from src.database import get_async_session, get_read_session
 from src.exceptions import ErrorHTTPException
+from src.pagination import Page, build_page, decode_cursor
+from src.storage import Storage, StorageError, get_storage
+from src.tasks.images import process_bench_photo
+from src.uploads import UploadError, multipart_file_chunks
 from src.users.models import User
 
-fastapi_users = FastAPIUsers[User, int](
-    get_user_manager,
-    [auth_backend],
-)
+router = APIRouter()
 
-current_active_user = fastapi_users.current_user(active=True)
+logger = logging.getLogger(__name__)
 
-router = APIRouter()
+BBOX_LIMIT = 1000
+CLUSTER_LIMIT = 1000
+TILE_MAX_AGE = 60
+# Room for the multipart boundaries and part headers around the photo
+MULTIPART_OVERHEAD = 64 * 1024
+PHOTO_UPLOAD_TIMEOUT = 300
+CREATE_BATCH_LIMIT = 1000
 
 
-@router.get("/benches", response_model=list[BenchRead])
-@cache(expire=60)
+async def invalidate_bench_caches(
+    bench_ids: list[int], points: list[tuple[float, float]]
+) -> None:
+    await invalidate_benches(bench_ids)
+    await invalidate_tiles(points)
+    await bump_generation(BENCHES_TAG)
+
+
+@router.get("/benches", response_model=Page[BenchRead])
+@must_revalidate
+@cache(
+    expire=TAGGED_CACHE_EXPIRE,
+    namespace=BENCHES_TAG,
+    key_builder=tagged_key_builder(BENCHES_TAG),
+)
 async def get_benches(
     limit: int = Query(10, ge=1, le=100),
-    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
     session: AsyncSession = Depends(get_async_session),
 ):
+    last_id = decode_cursor(cursor)
     try:
-        query = select(Bench)
+        query = select(Bench).where(Bench.id > last_id).order_by(Bench.id).limit(limit + 1)
         result = await session.execute(query)
         benches = result.scalars().all()
-        return benches[offset:][:limit]
+        return Page[BenchRead].model_validate(build_page(benches, limit), from_attributes=True)
     except Exception as e:
         return ErrorHTTPException(status_code=400, error_code=EMPTY_LIST, detail=str(e))
 
 
+@router.get("/benches/export", response_class=StreamingResponse)
+async def export_benches_file(
+    request: Request,
+    format: Literal["geojson", "ndjson"] = Query("geojson"),
+    session: AsyncSession = Depends(get_async_session),
+):
+    etag = await export_etag(session, format)
+    headers = {
+        "Cache-Control": "no-cache",
+        "Content-Disposition": f'attachment; filename="benches.{format}"',
+    }
+    if etag is not None:
+        headers["ETag"] = etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    # The dependency has closed the session by the time the body is sent: a
+    # closed session starts over on a new connection, released once the
+    # response is done or the client went away
+    return StreamingResponse(
+        export_benches(session, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers=headers,
+        background=BackgroundTask(session.close),
+    )
+
+
+@router.get("/benches/in_bbox", response_model=list[BenchRead])
+async def get_benches_in_bbox(
+    min_latitude: float = Query(..., ge=-90, le=90),
+    min_longitude: float = Query(..., ge=-180, le=180),
+    max_latitude: float = Query(..., ge=-90, le=90),
+    max_longitude: float = Query(..., ge=-180, le=180),
+    limit: int = Query(BBOX_LIMIT, ge=1, le=BBOX_LIMIT),
+    session: AsyncSession = Depends(get_read_session),
+):
+    """Benches in the viewport, zoomed out maps should use ``get_bench_clusters``."""
+    if min_latitude > max_latitude:
+        raise ErrorHTTPException(
+            status_code=400,
+            error_code=VALIDATION_ERROR,
+            detail="min_latitude must not exceed max_latitude",
+        )
+
+    query = (
+        select(Bench)
+        .where(in_bbox(min_latitude, min_longitude, max_latitude, max_longitude))
+        .order_by(Bench.id)
+        .limit(limit)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+@router.get("/benches/clusters", response_model=list[BenchClusterRead])
+async def get_bench_clusters(
+    min_latitude: float = Query(..., ge=-90, le=90),
+    min_longitude: float = Query(..., ge=-180, le=180),
+    max_latitude: float = Query(..., ge=-90, le=90),
+    max_longitude: float = Query(..., ge=-180, le=180),
+    zoom: int = Query(..., ge=0, le=CLUSTER_MAX_ZOOM),
+    limit: int = Query(CLUSTER_LIMIT, ge=1, le=CLUSTER_LIMIT),
+    session: AsyncSession = Depends(get_read_session),
+):
+    if min_latitude > max_latitude:
+        raise ErrorHTTPException(
+            status_code=400,
+            error_code=VALIDATION_ERROR,
+            detail="min_latitude must not exceed max_latitude",
+        )
+
+    return await find_clusters(
+        session, min_latitude, min_longitude, max_latitude, max_longitude, zoom, limit
+    )
+
+
+@router.get("/tiles/{z}/{x}/{y}.mvt", response_class=Response)
+async def get_bench_tile(
+    request: Request,
+    z: int = Path(..., ge=0, le=TILE_MAX_ZOOM),
+    x: int = Path(..., ge=0),
+    y: int = Path(..., ge=0),
+    session: AsyncSession = Depends(get_async_session),
+):
+    if x >= 1 << z or y >= 1 << z:
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail="Tile out of range"
+        )
+
+    tile = await get_tile(session, z, x, y)
+    headers = {"ETag": tile_etag(tile), "Cache-Control": f"public, max-age={TILE_MAX_AGE}"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile, media_type=MVT_MEDIA_TYPE, headers=headers)
+
+
 @router.get("/benches/{bench_id}", response_model=BenchRead)
 async def get_bench(bench_id: int, session: AsyncSession = Depends(get_async_session)):
-    try:
-        query = select(Bench).where(bench_id == Bench.id)
-        result = await session.execute(query)
-        bench = result.scalar_one_or_none()
-        if bench is None:
-            raise ErrorHTTPException(
-                status_code=400, error_code=EMPTY_LIST, detail="Bench not found"
-            )
-        return bench
-    except Exception as e:
-        return ErrorHTTPException(status_code=400, error_code=UNKNOWN, detail=str(e))
+    bench = await get_cached_bench(session, bench_id)
+    if bench is None:
+        raise ErrorHTTPException(
+            status_code=400, error_code=EMPTY_LIST, detail="Bench not found"
+        )
+    return Response(content=bench, media_type="application/json")
 
 
 @router.get("/nearest_bench/", response_model=BenchRead)
+@must_revalidate
+@cache(
+    expire=TAGGED_CACHE_EXPIRE,
+    namespace=BENCHES_TAG,
+    key_builder=tagged_key_builder(BENCHES_TAG),
+)
 async def get_nearest_bench(
-    latitude: float,
-    longitude: float,
+    latitude: float = Query(..., ge=-90, le=90),
+    longitude: float = Query(..., ge=-180, le=180),
     session: AsyncSession = Depends(get_async_session),
 ):
     try:
-        result = await session.execute(
-            select(Bench).order_by(
-                func.pow(Bench.latitude - latitude, 2)
-                + func.pow(Bench.longitude - longitude, 2)
-            )
-        )
-        nearest_bench = result.scalars().first()
+        nearest_bench = await find_nearest_bench(session, latitude, longitude)
         return nearest_bench
     except Exception as e:
         return ErrorHTTPException(status_code=400, error_code=UNKNOWN, detail=str(e))
@@ -93,27 +220,17 @@ async def create_bench(
         stmt = (
             insert(Bench)
             .values(**operation.model_dump(exclude={"creator_id"}), creator_id=user.id)
-            .returning(Bench.id)
+            .returning(Bench)
         )
         result = await session.execute(stmt)
-        created_bench_id = result.scalar_one()
-
-        stmt = select(Bench).where(Bench.id == created_bench_id)
-        result = await session.execute(stmt)
         created_bench = result.scalar_one()
 
+        point = (created_bench.latitude, created_bench.longitude)
+        await update_clusters(session, [point])
         await session.commit()
+        await invalidate_bench_caches([created_bench.id], [point])
 
-        return BenchRead(
-            id=created_bench.id,
-            name=created_bench.name,
-            description=created_bench.description,
-            count=created_bench.count,
-            latitude=created_bench.latitude,
-            longitude=created_bench.longitude,
-            creator_id=created_bench.creator_id,
-            photo_url=created_bench.photo_url,
-        )
+        return BenchRead.model_validate(created_bench, from_attributes=True)
 
     except SQLAlchemyError as e:
         return ErrorHTTPException(
@@ -124,6 +241,54 @@ async def create_bench(
         return ErrorHTTPException(status_code=400, error_code=UNKNOWN, detail=str(e))
 
 
+@router.post("/create_benches", response_model=list[BenchRead])
+async def create_benches(
+    operations: list[BenchCreate] = Body(..., min_length=1, max_length=CREATE_BATCH_LIMIT),
+    session: AsyncSession = Depends(get_async_session),
+    user: User = Depends(current_active_user),
+):
+    try:
+        stmt = insert(Bench).returning(Bench, sort_by_parameter_order=True)
+        result = await session.scalars(
+            stmt,
+            [{**operation.model_dump(), "creator_id": user.id} for operation in operations],
+        )
+        created_benches = result.all()
+
+        points = [(bench.latitude, bench.longitude) for bench in created_benches]
+        await update_clusters(session, points)
+        await session.commit()
+        # New ids have nothing cached, and dropping the tiles of every point
+        # costs more than starting the tile cache over
+        await bump_generation(BENCHES_TAG, TILES_TAG)
+
+        return [
+            BenchRead.model_validate(bench, from_attributes=True) for bench in created_benches
+        ]
+
+    except SQLAlchemyError as e:
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail=str(e)
+        )
+
+
+@router.post("/benches/import", response_model=BenchImportReport)
+async def import_benches_file(
+    request: Request,
+    format: Literal["csv", "ndjson", "geojson"] = Query(...),
+    session: AsyncSession = Depends(get_async_session),
+    user: User = Depends(current_superuser),
+):
+    """Bulk import from the raw request body, e.g.
+    ``curl --data-binary @benches.csv '/benches/import?format=csv'``."""
+    try:
+        return await import_benches(session, request.stream(), format, user.id)
+    except BenchImportError as e:
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail=str(e)
+        )
+
+
 @router.delete("/delete_bench")
 async def delete_bench(
     bench_name: str,
@@ -131,12 +296,13 @@ async def delete_bench(
     user: User = Depends(current_active_user),
 ):
     try:
-        stmt = delete(Bench).where(
-            and_(Bench.name == bench_name, Bench.creator_id == user.id)
+        deleted = await delete_benches(
+            session, Bench.name == bench_name, Bench.creator_id == user.id
         )
-        result = await session.execute(stmt)
-        if result.rowcount > 0:
+        if deleted:
+            points = [(latitude, longitude) for _, latitude, longitude in deleted]
             await session.commit()
+            await invalidate_bench_caches([bench_id for bench_id, _, _ in deleted], points)
             return {"status_code": "200", "detail": f"Bench {bench_name} deleted"}
         else:
             return ErrorHTTPException(
@@ -148,49 +314,148 @@ async def delete_bench(
         return ErrorHTTPException(status_code=400, error_code=UNKNOWN, detail=str(e))
 
 
-@router.post("/upload_bench_photo/{bench_id}")
-async def upload_bench_photo(
+async def get_own_bench(session: AsyncSession, bench_id: int, user: User) -> Bench:
+    result = await session.execute(
+        select(Bench).where(and_(Bench.id == bench_id, Bench.creator_id == user.id))
+    )
+    bench = result.scalar_one_or_none()
+    if bench is None:
+        raise ErrorHTTPException(
+            status_code=400,
+            error_code=NOT_FOUND,
+            detail="Bench not found or you aren't creator!",
+        )
+    return bench
+
+
+@router.post("/benches/{bench_id}/photo/upload_url", response_model=PhotoUploadRead)
+async def create_photo_upload_url(
     bench_id: int,
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    operation: PhotoUploadCreate,
     session: AsyncSession = Depends(get_async_session),
     user: User = Depends(current_active_user),
+    storage: Storage = Depends(get_storage),
 ):
-    content = await file.read()
-    filename = f'bench{bench_id}_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.png'
+    """First step of a photo upload: the client PUTs the photo to the returned
+    signed URL, then calls ``/benches/{bench_id}/photo/complete``."""
+    await get_own_bench(session, bench_id, user)
+    object_name = new_photo_name(bench_id, operation.content_type)
+    try:
+        return await create_upload_url(storage, object_name, operation.content_type)
+    except StorageError:
+        logger.warning("Failed to sign photo upload of bench %s", bench_id, exc_info=True)
+        raise ErrorHTTPException(
+            status_code=502, error_code=STORAGE_ERROR, detail="Failed to create upload URL"
+        )
 
-    async def upload_to_cdn():
-        try:
-            bucket = storage.bucket()
-            blob = bucket.blob(f"benches/{bench_id}/{filename}")
 
-            retry_strategy = Retry(
-                total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504]
-            )
-            blob._retry = retry_strategy
+@router.post("/benches/{bench_id}/photo/complete", response_model=BenchRead)
+async def complete_photo_upload(
+    bench_id: int,
+    operation: PhotoUploadComplete,
+    session: AsyncSession = Depends(get_async_session),
+    user: User = Depends(current_active_user),
+    storage: Storage = Depends(get_storage),
+):
+    await get_own_bench(session, bench_id, user)
+    if not operation.object_name.startswith(photo_prefix(bench_id)):
+        raise ErrorHTTPException(
+            status_code=400,
+            error_code=VALIDATION_ERROR,
+            detail="Photo does not belong to the bench",
+        )
 
-            await asyncio.wait_for(
-                asyncio.to_thread(
-                    blob.upload_from_string, content, content_type=file.content_type
-                ),
-                timeout=300,
-            )
+    try:
+        await check_upload(storage, operation.object_name)
+    except PhotoUploadError as e:
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail=str(e)
+        )
+    except StorageError:
+        raise ErrorHTTPException(
+            status_code=502, error_code=STORAGE_ERROR, detail="Failed to check photo"
+        )
 
-            blob.make_public()
-            public_url = blob.public_url
+    # The bench keeps its current photo until the new one is processed
+    result = await session.execute(
+        update(Bench)
+        .where(Bench.id == bench_id)
+        .values(photo_object=operation.object_name)
+        .returning(Bench)
+    )
+    bench = result.scalar_one()
+    await session.commit()
+    enqueue_photo_processing(bench_id, operation.object_name)
+    return BenchRead.model_validate(bench, from_attributes=True)
 
-            stmt = (
-                update(Bench)
-                .where(and_(Bench.id == bench_id, Bench.creator_id == user.id))
-                .values(photo_url=public_url)
-            )
-            await session.execute(stmt)
-            await session.commit()
 
-        except (asyncio.TimeoutError, GoogleCloudError, TransportError) as e:
-            print(f"An error occurred: {str(e)}")
-            raise ErrorHTTPException(status_code=500, error_code=1100, detail="Failed to upload photo")
+def enqueue_photo_processing(bench_id: int, object_name: str) -> None:
+    # The upload itself is already saved, it can be processed again later
+    try:
+        process_bench_photo.apply_async((bench_id, object_name), retry=False)
+    except Exception:
+        logger.warning("Failed to enqueue processing of bench %s photo", bench_id, exc_info=True)
+
+
+@router.post(
+    "/upload_bench_photo/{bench_id}",
+    deprecated=True,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_bench_photo(
+    bench_id: int,
+    request: Request,
+    session: AsyncSession = Depends(get_async_session),
+    user: User = Depends(current_active_user),
+    storage: Storage = Depends(get_storage),
+):
+    """Photo upload through the API, streamed to storage as it is received.
+    Prefer uploading to a signed URL, see ``create_photo_upload_url``."""
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail="Invalid Content-Length header"
+        )
+    if content_length > PHOTO_MAX_SIZE + MULTIPART_OVERHEAD:
+        raise ErrorHTTPException(
+            status_code=413, error_code=VALIDATION_ERROR, detail="Photo is larger than 10 MB"
+        )
+    await get_own_bench(session, bench_id, user)
+
+    try:
+        filename, _ = await asyncio.wait_for(
+            store_photo(storage, multipart_file_chunks(request, "file")),
+            timeout=PHOTO_UPLOAD_TIMEOUT,
+        )
+    except PhotoTooLargeError as e:
+        raise ErrorHTTPException(status_code=413, error_code=VALIDATION_ERROR, detail=str(e))
+    except (PhotoUploadError, UploadError) as e:
+        raise ErrorHTTPException(status_code=400, error_code=VALIDATION_ERROR, detail=str(e))
+    except (asyncio.TimeoutError, StorageError):
+        logger.warning("Failed to upload photo of bench %s", bench_id, exc_info=True)
+        raise ErrorHTTPException(
+            status_code=500, error_code=STORAGE_ERROR, detail="Failed to upload photo"
+        )
 
-    background_tasks.add_task(upload_to_cdn)
+    # The photo is published once processed, see complete_photo_upload
+    await session.execute(
+        update(Bench).where(Bench.id == bench_id).values(photo_object=filename)
+    )
+    await session.commit()
+    enqueue_photo_processing(bench_id, filename)
 
     return {"status_code": "200", "filename": filename}
@@ -1,6 +1,7 @@
-from typing import Optional
+from datetime import datetime
+from typing import Literal, Optional
 
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 
 
 class Bench(BaseModel):
@@ -11,11 +12,59 @@ class Bench(BaseModel):
     count: int
 
 
+class PhotoVariant(BaseModel):
+    url: HttpUrl
+    content_type: str
+    width: int
+    height: int
+
+
 class BenchRead(Bench):
     id: int
     creator_id: int | None
     photo_url: Optional[HttpUrl] = None
+    # Smaller copies of the photo, once they have been made
+    photo_variants: Optional[list[PhotoVariant]] = None
 
 
 class BenchCreate(Bench):
-    pass
+    name: str = Field(max_length=36)
+    description: str | None = Field(max_length=512)
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    # An integer column
+    count: int = Field(ge=1, le=2**31 - 1)
+
+
+class BenchClusterRead(BaseModel):
+    latitude: float
+    longitude: float
+    count: int
+
+
+class BenchImportRowError(BaseModel):
+    line: int
+    detail: str
+
+
+class BenchImportReport(BaseModel):
+    processed: int
+    imported: int
+    failed: int
+    errors: list[BenchImportRowError]
+
+
+class PhotoUploadCreate(BaseModel):
+    content_type: Literal["image/jpeg", "image/png", "image/webp"]
+
+
+class PhotoUploadRead(BaseModel):
+    upload_url: str
+    object_name: str
+    method: str
+    headers: dict[str, str]
+    expires_at: datetime
+
+
+class PhotoUploadComplete(BaseModel):
+    object_name: str
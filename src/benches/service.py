@@ -0,0 +1,183 @@
+from typing import Iterable, Optional
+
+from sqlalchemy import (ColumnElement, Float, Integer, Select, SmallInteger,
+                        and_, bindparam, delete, desc, func, or_, select,
+                        tuple_)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.benches.geo import (CLUSTER_CELL_BITS, CLUSTER_MIN_ZOOM, GEOHASH_UPPER,
+                             cluster_cells, encode_geohash, geohash_neighbours,
+                             geohash_search_radius, haversine_distance, tile_xy)
+from src.benches.models import Bench, BenchCluster
+
+# ~150 m cells; every step down widens the ring ~4-8x
+NEAREST_START_PRECISION = 7
+
+
+def geohash_prefix(prefix: str):
+    return and_(Bench.geohash >= prefix, Bench.geohash < prefix + GEOHASH_UPPER)
+
+
+def in_bbox(min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float):
+    latitude = Bench.latitude.between(min_latitude, max_latitude)
+    if min_longitude <= max_longitude:
+        return and_(latitude, Bench.longitude.between(min_longitude, max_longitude))
+    # Viewport crosses the antimeridian
+    return and_(
+        latitude, or_(Bench.longitude >= min_longitude, Bench.longitude <= max_longitude)
+    )
+
+
+async def find_nearest_bench(
+    session: AsyncSession, latitude: float, longitude: float
+) -> Optional[Bench]:
+    distance = haversine_distance(Bench.latitude, Bench.longitude, latitude, longitude)
+
+    for precision in range(NEAREST_START_PRECISION, 0, -1):
+        cell = encode_geohash(latitude, longitude, precision)
+        cells = [cell, *geohash_neighbours(cell)]
+        stmt = (
+            select(Bench, distance)
+            .where(or_(*[geohash_prefix(c) for c in cells]))
+            .order_by(distance, Bench.id)
+            .limit(1)
+        )
+        row = (await session.execute(stmt)).first()
+        if row is None:
+            continue
+        bench, meters = row
+        # Only trust the ring when nothing outside it can be closer
+        if meters <= geohash_search_radius(latitude, longitude, cell):
+            return bench
+
+    result = await session.execute(select(Bench).order_by(distance, Bench.id).limit(1))
+    return result.scalar_one_or_none()
+
+
+async def update_clusters(
+    session: AsyncSession, points: Iterable[tuple[float, float]], sign: int = 1
+) -> None:
+    """Add (``sign=1``) or remove (``sign=-1``) benches at ``points`` from the
+    per-zoom cluster aggregates, in the caller's transaction."""
+    deltas: dict[tuple[int, int, int], list] = {}
+    for latitude, longitude in points:
+        for cell in cluster_cells(latitude, longitude):
+            delta = deltas.setdefault(cell, [0, 0.0, 0.0])
+            delta[0] += sign
+            delta[1] += sign * latitude
+            delta[2] += sign * longitude
+    if not deltas:
+        return
+
+    # Sorted so concurrent writers lock cluster rows in the same order
+    cells = sorted(deltas)
+    # Rows are sent as one array per column: a single, cheap to compile
+    # statement however many cells there are
+    rows = func.unnest(
+        bindparam("zoom", [zoom for zoom, _, _ in cells], type_=ARRAY(SmallInteger)),
+        bindparam("x", [x for _, x, _ in cells], type_=ARRAY(Integer)),
+        bindparam("y", [y for _, _, y in cells], type_=ARRAY(Integer)),
+        bindparam("count", [deltas[cell][0] for cell in cells], type_=ARRAY(Integer)),
+        bindparam("latitude_sum", [deltas[cell][1] for cell in cells], type_=ARRAY(Float)),
+        bindparam("longitude_sum", [deltas[cell][2] for cell in cells], type_=ARRAY(Float)),
+    ).table_valued("zoom", "x", "y", "count", "latitude_sum", "longitude_sum").render_derived()
+
+    stmt = pg_insert(BenchCluster).from_select(
+        ["zoom", "x", "y", "count", "latitude_sum", "longitude_sum"], select(rows)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[BenchCluster.zoom, BenchCluster.x, BenchCluster.y],
+        set_={
+            "count": BenchCluster.count + stmt.excluded.count,
+            "latitude_sum": BenchCluster.latitude_sum + stmt.excluded.latitude_sum,
+            "longitude_sum": BenchCluster.longitude_sum + stmt.excluded.longitude_sum,
+        },
+    )
+    await session.execute(stmt)
+
+    if sign < 0:
+        await session.execute(
+            delete(BenchCluster).where(
+                BenchCluster.count <= 0,
+                tuple_(BenchCluster.zoom, BenchCluster.x, BenchCluster.y).in_(
+                    select(rows.c.zoom, rows.c.x, rows.c.y)
+                ),
+            )
+        )
+
+
+def _cell_range(column, first: int, last: int) -> ColumnElement:
+    if first <= last:
+        return column.between(first, last)
+    # Wraps around the antimeridian
+    return or_(column >= first, column <= last)
+
+
+def select_clusters(zoom: int, x_range: tuple[int, int], y_range: tuple[int, int]) -> Select:
+    """``count``, ``latitude``, ``longitude``, ``x`` and ``y`` of the cluster
+    cells of ``zoom`` within the cell ranges. Zooms under ``CLUSTER_MIN_ZOOM``
+    are summed up from the cells of that zoom."""
+    shift = max(0, CLUSTER_MIN_ZOOM - zoom)
+    (min_x, max_x), (min_y, max_y) = x_range, y_range
+    where = (
+        BenchCluster.zoom == zoom + shift,
+        _cell_range(BenchCluster.x, min_x << shift, ((max_x + 1) << shift) - 1),
+        BenchCluster.y.between(min_y << shift, ((max_y + 1) << shift) - 1),
+    )
+    if not shift:
+        return select(
+            BenchCluster.count,
+            (BenchCluster.latitude_sum / BenchCluster.count).label("latitude"),
+            (BenchCluster.longitude_sum / BenchCluster.count).label("longitude"),
+            BenchCluster.x,
+            BenchCluster.y,
+        ).where(*where)
+
+    x = BenchCluster.x.op(">>")(shift)
+    y = BenchCluster.y.op(">>")(shift)
+    count = func.sum(BenchCluster.count)
+    return (
+        select(
+            count.label("count"),
+            (func.sum(BenchCluster.latitude_sum) / count).label("latitude"),
+            (func.sum(BenchCluster.longitude_sum) / count).label("longitude"),
+            x.label("x"),
+            y.label("y"),
+        )
+        .where(*where)
+        .group_by(x, y)
+    )
+
+
+async def find_clusters(
+    session: AsyncSession,
+    min_latitude: float,
+    min_longitude: float,
+    max_latitude: float,
+    max_longitude: float,
+    zoom: int,
+    limit: int,
+) -> list:
+    min_x, max_y = tile_xy(min_latitude, min_longitude, zoom + CLUSTER_CELL_BITS)
+    max_x, min_y = tile_xy(max_latitude, max_longitude, zoom + CLUSTER_CELL_BITS)
+    query = (
+        select_clusters(zoom, (min_x, max_x), (min_y, max_y))
+        .order_by(desc("count"), "x", "y")
+        .limit(limit)
+    )
+    result = await session.execute(query)
+    return result.mappings().all()
+
+
+async def delete_benches(session: AsyncSession, *where) -> list[tuple[int, float, float]]:
+    """Delete the benches matching ``where`` and take them off the clusters,
+    in the caller's transaction. Returns their id, latitude and longitude."""
+    result = await session.execute(
+        delete(Bench).where(*where).returning(Bench.id, Bench.latitude, Bench.longitude)
+    )
+    deleted = [tuple(row) for row in result]
+    points = [(latitude, longitude) for _, latitude, longitude in deleted]
+    await update_clusters(session, points, sign=-1)
+    return deleted
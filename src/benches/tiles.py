@@ -0,0 +1,111 @@
+import hashlib
+import logging
+from typing import Iterable
+
+from fastapi_cache import FastAPICache
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.benches.geo import CLUSTER_CELL_BITS, mercator_xy, tile_bbox, tile_xy
+from src.benches.models import Bench
+from src.benches.mvt import MVT_EXTENT, PointFeature, encode_tile
+from src.benches.service import in_bbox, select_clusters
+from src.cache import TILES_TAG, TwoTierBackend, get_generation
+
+logger = logging.getLogger(__name__)
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+TILE_MAX_ZOOM = 22
+# Up to this zoom tiles carry cluster centroids instead of single benches
+TILE_CLUSTER_MAX_ZOOM = 12
+TILE_LIMIT = 5000
+TILE_EXPIRE = 24 * 3600
+
+
+def tile_cache_key(z: int, x: int, y: int, generation: int) -> str:
+    return f"{FastAPICache.get_prefix()}:{TILES_TAG}.{generation}:{z}:{x}:{y}"
+
+
+def tile_etag(tile: bytes) -> str:
+    return f'"{hashlib.sha1(tile).hexdigest()}"'
+
+
+def _tile_pixel(latitude: float, longitude: float, z: int, x: int, y: int) -> tuple[int, int]:
+    tile_x, tile_y = mercator_xy(latitude, longitude, z)
+    return round((tile_x - x) * MVT_EXTENT), round((tile_y - y) * MVT_EXTENT)
+
+
+async def render_tile(session: AsyncSession, z: int, x: int, y: int) -> bytes:
+    if z <= TILE_CLUSTER_MAX_ZOOM:
+        first_x, first_y = x << CLUSTER_CELL_BITS, y << CLUSTER_CELL_BITS
+        cells = (1 << CLUSTER_CELL_BITS) - 1
+        query = select_clusters(z, (first_x, first_x + cells), (first_y, first_y + cells))
+        result = await session.execute(query)
+        clusters = [
+            PointFeature(*_tile_pixel(latitude, longitude, z, x, y), {"count": count})
+            for count, latitude, longitude, _, _ in result
+        ]
+        return encode_tile({"clusters": clusters})
+
+    query = (
+        select(Bench.id, Bench.name, Bench.count, Bench.latitude, Bench.longitude)
+        .where(in_bbox(*tile_bbox(x, y, z)))
+        .order_by(Bench.id)
+        .limit(TILE_LIMIT)
+    )
+    result = await session.execute(query)
+    benches = [
+        PointFeature(
+            *_tile_pixel(latitude, longitude, z, x, y),
+            {"name": name, "count": count},
+            id=bench_id,
+        )
+        for bench_id, name, count, latitude, longitude in result
+    ]
+    return encode_tile({"benches": benches})
+
+
+async def get_tile(session: AsyncSession, z: int, x: int, y: int) -> bytes:
+    generation = await get_generation(TILES_TAG)
+    if generation is None:
+        return await render_tile(session, z, x, y)
+
+    backend = FastAPICache.get_backend()
+    key = tile_cache_key(z, x, y, generation)
+    try:
+        tile = await backend.get(key)
+    except Exception:
+        logger.warning("Error retrieving tile %s from cache", key, exc_info=True)
+        tile = None
+
+    if tile is None:
+        tile = await render_tile(session, z, x, y)
+        try:
+            await backend.set(key, tile, TILE_EXPIRE)
+        except Exception:
+            logger.warning("Error caching tile %s", key, exc_info=True)
+    return tile
+
+
+async def invalidate_tiles(points: Iterable[tuple[float, float]]) -> None:
+    """Drop the cached tiles holding ``points``. Bulk changes should rather
+    ``bump_generation(TILES_TAG)`` to drop every tile at once."""
+    generation = await get_generation(TILES_TAG)
+    if generation is None:
+        return
+    backend = FastAPICache.get_backend()
+    keys = {
+        tile_cache_key(zoom, *tile_xy(latitude, longitude, zoom), generation)
+        for latitude, longitude in points
+        for zoom in range(TILE_MAX_ZOOM + 1)
+    }
+    if not keys:
+        return
+    try:
+        # One round trip for all zooms, clear(key=) would take two per key
+        await backend.redis.delete(*keys)
+        if isinstance(backend, TwoTierBackend):
+            await backend.evict(*keys)
+    except Exception:
+        logger.warning("Error invalidating %d cached tiles", len(keys), exc_info=True)
@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import wraps
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional
+from urllib.parse import urlencode
+
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from redis import asyncio as aioredis
+from redis.asyncio.client import AbstractRedis
+from starlette.requests import Request
+from starlette.responses import Response
+
+from src.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "fastapi-cache"
+
+BENCHES_TAG = "benches"
+TILES_TAG = "tiles"
+
+# Entries are invalidated by bumping their tag generation, the TTL only
+# bounds how long unreachable generations linger in Redis
+TAGGED_CACHE_EXPIRE = 6 * 3600
+
+INVALIDATION_CHANNEL = "fastapi-cache:invalidate"
+
+# Other in-process caches invalidated over INVALIDATION_CHANNEL, by message
+# kind. The values have ``invalidate(target)`` and ``clear()`` methods.
+invalidation_handlers: dict[str, Any] = {}
+
+
+def generation_key(tag: str) -> str:
+    return f"{FastAPICache.get_prefix()}:generation:{tag}"
+
+
+async def get_generation(tag: str) -> Optional[int]:
+    try:
+        value = await FastAPICache.get_backend().get(generation_key(tag))
+    except Exception:
+        logger.warning("Error reading cache generation of %r", tag, exc_info=True)
+        return None
+    return int(value) if value else 0
+
+
+async def bump_generation(*tags: str) -> None:
+    """Make every cached entry tagged with one of ``tags`` unreachable."""
+    keys = [generation_key(tag) for tag in tags]
+    try:
+        backend = FastAPICache.get_backend()
+        async with backend.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.incr(key)
+            await pipe.execute()
+        if isinstance(backend, TwoTierBackend):
+            await backend.evict(*keys)
+    except Exception:
+        logger.warning("Error bumping cache generation of %r", tags, exc_info=True)
+
+
+def tagged_key_builder(*tags: str) -> Callable:
+    """Key builder for ``@cache`` that keys on the request URL and the current
+    generation of ``tags``, so a ``bump_generation`` invalidates the entries."""
+
+    async def key_builder(
+        func: Callable,
+        namespace: Optional[str] = "",
+        request: Optional[Request] = None,
+        response: Optional[Response] = None,
+        args: Optional[tuple] = None,
+        kwargs: Optional[dict] = None,
+    ) -> str:
+        generations = await asyncio.gather(*(get_generation(tag) for tag in tags))
+        if None in generations:
+            # Unknown generation: use a key that nothing can have been cached under
+            version = uuid.uuid4().hex
+        else:
+            version = ":".join(f"{tag}.{gen}" for tag, gen in zip(tags, generations))
+        query = urlencode(sorted(request.query_params.multi_items()))
+        digest = hashlib.md5(f"{request.url.path}?{query}".encode()).hexdigest()
+        return f"{FastAPICache.get_prefix()}:{namespace}:{func.__name__}:{version}:{digest}"
+
+    return key_builder
+
+
+def must_revalidate(func: Callable) -> Callable:
+    """Put on top of ``@cache``: clients revalidate with the ETag instead of
+    keeping the response for the whole server side TTL."""
+
+    @wraps(func)
+    async def inner(*args, **kwargs):
+        ret = await func(*args, **kwargs)
+        response = kwargs.get("response")
+        if response is not None:
+            response.headers["Cache-Control"] = "no-cache"
+        return ret
+
+    return inner
+
+
+class LRUCache:
+    """In-process cache of ``bytes`` values bounded by their total size.
+
+    Least recently used entries are evicted beyond ``max_bytes`` and entries
+    expire ``ttl`` seconds after being set.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_with_ttl(key)[1]
+
+    def get_with_ttl(self, key: str) -> tuple[int, Optional[bytes]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return 0, None
+        expires_at, value = entry
+        ttl = expires_at - time.monotonic()
+        if ttl <= 0:
+            self.delete(key)
+            return 0, None
+        self._entries.move_to_end(key)
+        return int(ttl), value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.delete(key)
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.size += size
+        while self.size > self.max_bytes:
+            old_key, (_, old_value) = self._entries.popitem(last=False)
+            self.size -= len(old_key) + len(old_value)
+
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(key) + len(entry[1])
+
+    def delete_prefix(self, prefix: str) -> None:
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            self.delete(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+
+class TwoTierBackend(RedisBackend):
+    """fastapi-cache backend with a per-worker ``LRUCache`` in front of Redis.
+
+    Hot keys are answered without a network hop. ``clear`` and ``evict`` are
+    broadcast on ``INVALIDATION_CHANNEL`` and every worker running ``listen``
+    drops its local copy; local entries live at most ``ttl`` seconds anyway.
+    """
+
+    def __init__(self, redis: AbstractRedis, max_bytes: int, ttl: float):
+        super().__init__(redis)
+        self.local = LRUCache(max_bytes=max_bytes, ttl=ttl)
+
+    def _local_ttl(self, expire: Optional[int]) -> float:
+        # Redis reports -1 for keys without expiry
+        return self.local.ttl if expire is None or expire < 0 else min(self.local.ttl, expire)
+
+    async def get_with_ttl(self, key: str) -> tuple[int, Optional[bytes]]:
+        ttl, value = self.local.get_with_ttl(key)
+        if value is not None:
+            CACHE_LOOKUPS.labels("local").inc()
+            return ttl, value
+        ttl, value = await super().get_with_ttl(key)
+        if value is not None:
+            CACHE_LOOKUPS.labels("redis").inc()
+            self.local.set(key, value, ttl=self._local_ttl(ttl))
+        else:
+            CACHE_LOOKUPS.labels("miss").inc()
+        return ttl, value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return (await self.get_with_ttl(key))[1]
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        await super().set(key, value, expire)
+        self.local.set(key, value, ttl=self._local_ttl(expire))
+
+    async def clear(self, namespace: Optional[str] = None, key: Optional[str] = None) -> int:
+        cleared = await super().clear(namespace, key)
+        if namespace:
+            self.local.delete_prefix(f"{namespace}:")
+            await self.redis.publish(INVALIDATION_CHANNEL, f"namespace:{namespace}:")
+        elif key:
+            await self.evict(key)
+        return cleared
+
+    async def evict(self, *keys: str) -> None:
+        """Drop ``keys`` from the local tier of every worker, Redis is untouched."""
+        for key in keys:
+            self.local.delete(key)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.publish(INVALIDATION_CHANNEL, f"key:{key}")
+            await pipe.execute()
+
+    def _on_invalidation(self, message: bytes) -> None:
+        kind, _, target = message.decode().partition(":")
+        if kind == "key":
+            self.local.delete(target)
+        elif kind == "namespace":
+            self.local.delete_prefix(target)
+        elif kind in invalidation_handlers:
+            invalidation_handlers[kind].invalidate(target)
+
+    def _clear_local(self) -> None:
+        self.local.clear()
+        for handler in invalidation_handlers.values():
+            handler.clear()
+
+    async def publish_invalidation(self, kind: str, target: str) -> None:
+        await self.redis.publish(INVALIDATION_CHANNEL, f"{kind}:{target}")
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # Invalidations sent while we were not subscribed are lost
+                    self._clear_local()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._on_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Cache invalidation listener failed", exc_info=True)
+                self._clear_local()
+                await asyncio.sleep(1)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one: the first caller
+    runs the loader, the others wait for its result."""
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The leading call failed or was cancelled, load on our own
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await loader()
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+@asynccontextmanager
+async def standalone_cache(redis_uri: str) -> AsyncIterator[None]:
+    """Set up the cache outside of the API (scripts, Celery tasks) so their
+    invalidations also reach the local tier of the API workers."""
+    redis = aioredis.from_url(redis_uri)
+    FastAPICache.init(TwoTierBackend(redis, max_bytes=0, ttl=0), prefix=CACHE_PREFIX)
+    try:
+        yield
+    finally:
+        await redis.close()
@@ -2,7 +2,6 @@ import os
 from pathlib import Path
 
 from dotenv import load_dotenv
-from firebase_admin import credentials
 
 load_dotenv()
 
@@ -14,6 +13,28 @@ DB_USER = os.environ.get("DB_USER")
 DB_NAME = os.environ.get("DB_NAME")
 DB_PORT = os.environ.get("DB_PORT")
 
+# Per process, e.g. each gunicorn worker has its own pool
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+# Seconds to wait for a connection before failing the request
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# Connections older than that are replaced, -1 keeps them forever
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 30 * 60))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+# Prepared statements cached per connection by asyncpg
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 500))
+# Connecting through PgBouncer in transaction mode, which can't keep
+# prepared statements between transactions
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "false").lower() == "true"
+
+# Read replicas as comma separated host:port, with the primary's credentials
+DB_REPLICAS = [host for host in os.environ.get("DB_REPLICAS", "").split(",") if host]
+# Replicas further behind the primary don't get reads
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 2))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 5))
+# A client reads from the primary for that many seconds after it wrote
+DB_READ_YOUR_WRITES = int(os.environ.get("DB_READ_YOUR_WRITES", 5))
+
 DB_HOST_TEST = os.environ.get("DB_HOST_TEST")
 DB_PASS_TEST = os.environ.get("DB_PASS_TEST")
 DB_USER_TEST = os.environ.get("DB_USER_TEST")
@@ -24,13 +45,75 @@ SECRET = os.environ.get("SECRET")
 SECRET_PASS = os.environ.get("SECRET_PASS")
 SECRET_VER = os.environ.get("SECRET_VER")
 
+# HS256 signs access tokens with SECRET. ES256 and EdDSA sign them with the
+# PEM private key at JWT_PRIVATE_KEY, other services verify them with its
+# public key, see /auth/jwt/jwks
+JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
+JWT_PRIVATE_KEY = os.environ.get("JWT_PRIVATE_KEY")
+JWT_LIFETIME = int(os.environ.get("JWT_LIFETIME", 24 * 3600))
+
+# Passwords are hashed in this many threads per worker, logins and
+# registrations are refused while PASSWORD_HASH_QUEUE of them are pending
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 32))
+# Argon2 parameters of new hashes, older hashes are upgraded on login
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", 64 * 1024))
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", 4))
+
 REDIS_URI = os.environ.get("REDIS_URI")
 
+CACHE_LOCAL_MAX_BYTES = int(os.environ.get("CACHE_LOCAL_MAX_BYTES", 32 * 1024 * 1024))
+CACHE_LOCAL_TTL = int(os.environ.get("CACHE_LOCAL_TTL", 30))
+
+# Users of verified tokens are kept this many seconds per worker, 0 disables
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 30))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+
+current_dir = Path(__file__).parent
+
 FIREBASE_BUCKET = os.environ.get("FIREBASE_BUCKET")
+# Only read when the firebase storage backend is first used
+FIREBASE_CREDS = os.environ.get(
+    "FIREBASE_CREDS", str(current_dir.parent / "creds" / "firebase.json")
+)
+
+# firebase, local or memory, see src.storage
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase")
+STORAGE_LOCAL_PATH = os.environ.get("STORAGE_LOCAL_PATH", str(current_dir.parent / "media"))
+# Links to the published objects, what the app serves at STORAGE_LOCAL_URL
+STORAGE_LOCAL_PUBLIC_PATH = os.environ.get(
+    "STORAGE_LOCAL_PUBLIC_PATH", str(current_dir.parent / "media-public")
+)
+STORAGE_LOCAL_URL = os.environ.get("STORAGE_LOCAL_URL", "http://localhost:5002/media/")
+STORAGE_MAX_CONCURRENCY = int(os.environ.get("STORAGE_MAX_CONCURRENCY", 16))
+STORAGE_RETRIES = int(os.environ.get("STORAGE_RETRIES", 3))
 
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 465))
+# ssl, starttls or none
+SMTP_SECURITY = os.environ.get("SMTP_SECURITY", "ssl")
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
 SMTP_USER = os.environ.get("SMTP_USER")
 SMTP_PASS = os.environ.get("SMTP_PASS")
 
-current_dir = Path(__file__).parent
-firebase_path = current_dir.parent / "creds" / "firebase.json"
-firebase_creds = credentials.Certificate(firebase_path)
+# Outgoing emails are collected for this many seconds and sent in batches
+EMAIL_FLUSH_WINDOW = float(os.environ.get("EMAIL_FLUSH_WINDOW", 2))
+EMAIL_BATCH_SIZE = int(os.environ.get("EMAIL_BATCH_SIZE", 50))
+# Token bucket: emails per second on average, EMAIL_BURST at once
+EMAIL_RATE_LIMIT = float(os.environ.get("EMAIL_RATE_LIMIT", 5))
+EMAIL_BURST = int(os.environ.get("EMAIL_BURST", 20))
+
+# Port of the Celery workers' metrics endpoint, not served when unset
+CELERY_METRICS_PORT = os.environ.get("CELERY_METRICS_PORT")
+
+# Token buckets per client, a user or the IP of requests without a valid
+# token: "route=rate/burst" for route templates, comma separated, with
+# requests per second on average and at once. "*" applies to other routes.
+RATE_LIMITS = os.environ.get(
+    "RATE_LIMITS", "/nearest_bench/=5/20,/benches=10/30,/benches/in_bbox=10/30"
+)
+# Requests are refused with a 503 when the event loop lags or pool
+# checkouts wait longer than these seconds, more of them the higher above
+SHED_LOOP_LAG = float(os.environ.get("SHED_LOOP_LAG", 0.25))
+SHED_POOL_WAIT = float(os.environ.get("SHED_POOL_WAIT", 1))
@@ -4,4 +4,9 @@ NOT_FOUND = 1002
 INVALID_TG = 1003
 VALIDATION_ERROR = 1004
 
+STORAGE_ERROR = 1100
+
+OVERLOADED = 1200
+RATE_LIMITED = 1201
+
 NON_UNIQ_FIELD = 2000
@@ -1,23 +1,242 @@
-from typing import AsyncGenerator
+import asyncio
+import itertools
+import logging
+import os
+import time
+import uuid
+from typing import AsyncGenerator, Optional
 
-from fastapi import Depends
+from fastapi import Depends, Request
 from fastapi_users.db import SQLAlchemyUserDatabase
-from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
-                                    create_async_engine)
+from sqlalchemy import URL, make_url, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    async_sessionmaker, create_async_engine)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from src.config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from src.config import (DB_HOST, DB_MAX_OVERFLOW, DB_NAME, DB_PASS,
+                        DB_PGBOUNCER, DB_POOL_PRE_PING, DB_POOL_RECYCLE,
+                        DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_PORT,
+                        DB_READ_YOUR_WRITES, DB_REPLICA_CHECK_INTERVAL,
+                        DB_REPLICA_MAX_LAG, DB_REPLICAS,
+                        DB_STATEMENT_CACHE_SIZE, DB_USER)
+from src.metrics import DB_POOL_TIMEOUTS, DB_POOL_WAIT, instrument_engine
 from src.users.models import User
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-engine = create_async_engine(DATABASE_URL)
+# Seconds behind the primary, 0 when the replica has replayed all it received
+# (or is not a replica at all)
+REPLICATION_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() IS NOT DISTINCT FROM pg_last_wal_replay_lsn()"
+    " THEN 0 ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+PRIMARY_COOKIE = "db_primary_until"
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection."""
+
+    # Set by src.metrics.instrument_engine
+    metrics_label: Optional[str] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            if self.metrics_label:
+                DB_POOL_TIMEOUTS.labels(self.metrics_label).inc()
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if self.metrics_label:
+                DB_POOL_WAIT.labels(self.metrics_label).observe(waited)
+
+    def recreate(self):
+        # Keeps the counters when the engine is disposed
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.timeouts = self.timeouts
+        pool.wait_seconds = self.wait_seconds
+        pool.max_wait_seconds = self.max_wait_seconds
+        pool.metrics_label = self.metrics_label
+        return pool
+
+
+def connect_args(pgbouncer: bool = DB_PGBOUNCER) -> dict:
+    if pgbouncer:
+        # A transaction pooler hands each transaction to any server
+        # connection: no statement caches, and unique statement names so
+        # they can't collide on a shared server connection
+        return {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return {
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+    }
+
+
+def create_engine(url: str | URL = DATABASE_URL, **kwargs) -> AsyncEngine:
+    options = {
+        "poolclass": InstrumentedPool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "connect_args": connect_args(),
+    }
+    options.update(kwargs)
+    return create_async_engine(url, **options)
+
+
+engine = create_engine()
+instrument_engine(engine, "primary")
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
+def pool_status(engine: AsyncEngine = engine) -> dict:
+    """Pool usage of this process."""
+    pool = engine.sync_engine.pool
+    status = {
+        "pid": os.getpid(),
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # Negative while fewer than pool_size connections have been opened
+        "overflow": pool.overflow(),
+        "max_overflow": pool._max_overflow,
+    }
+    if isinstance(pool, InstrumentedPool):
+        status.update(
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_seconds=pool.wait_seconds,
+            max_wait_seconds=pool.max_wait_seconds,
+        )
+    return status
+
+
+class ReplicaSet:
+    """Read replicas taking turns. ``monitor`` checks them in the
+    background, until the first check all reads go to the primary."""
+
+    def __init__(self, engines: list[AsyncEngine], max_lag: float = DB_REPLICA_MAX_LAG):
+        self.engines = engines
+        self.max_lag = max_lag
+        self.healthy: list[AsyncEngine] = []
+        self._turns = itertools.count()
+
+    def pick(self) -> Optional[AsyncEngine]:
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._turns) % len(healthy)]
+
+    async def _is_healthy(self, engine: AsyncEngine) -> bool:
+        try:
+            async with asyncio.timeout(DB_REPLICA_CHECK_INTERVAL):
+                async with engine.connect() as connection:
+                    lag = await connection.scalar(REPLICATION_LAG_QUERY)
+        except Exception:
+            logger.warning("Replica %s is unavailable", engine.url.host, exc_info=True)
+            return False
+        if lag is None or lag > self.max_lag:
+            logger.warning("Replica %s is %s s behind", engine.url.host, lag)
+            return False
+        return True
+
+    async def check(self) -> None:
+        results = await asyncio.gather(*(self._is_healthy(engine) for engine in self.engines))
+        self.healthy = [engine for engine, healthy in zip(self.engines, results) if healthy]
+
+    async def monitor(self, interval: float = DB_REPLICA_CHECK_INTERVAL) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+
+def replica_url(address: str) -> URL:
+    host, _, port = address.partition(":")
+    return make_url(DATABASE_URL).set(host=host, port=int(port or 5432))
+
+
+replicas = ReplicaSet([create_engine(replica_url(address)) for address in DB_REPLICAS])
+for address, replica in zip(DB_REPLICAS, replicas.engines):
+    instrument_engine(replica, f"replica {address}")
+
+
+def reads_from_primary(request: Request) -> bool:
+    """Whether the client wrote recently, so that it sees its own writes."""
+    try:
+        return int(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    """Sends clients to the primary for a while after a successful write,
+    replicas may not have caught up with it yet."""
+
+    def __init__(self, app: ASGIApp, window: int = DB_READ_YOUR_WRITES):
+        self.app = app
+        self.window = window
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = int(time.time()) + self.window
+                cookie = f"{PRIMARY_COOKIE}={until}; Max-Age={self.window}; Path=/; HttpOnly"
+                MutableHeaders(scope=message).append("set-cookie", f"{cookie}; SameSite=Lax")
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
 
 
+async def get_read_session(
+    request: Request, session: AsyncSession = Depends(get_async_session)
+) -> AsyncGenerator[AsyncSession, None]:
+    """Session for read only endpoints: a replica when one is healthy,
+    the primary otherwise. The primary session connects only if used.
+
+    Not for reads that fill shared caches: right after a write a lagging
+    replica would cache the old data for the whole expiry, past the
+    invalidation."""
+    replica = None if reads_from_primary(request) else replicas.pick()
+    if replica is None:
+        yield session
+        return
+    async with async_session_maker(bind=replica) as replica_session:
+        yield replica_session
+
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User)
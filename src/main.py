@@ -1,28 +1,44 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import AsyncGenerator
 
-import firebase_admin
 from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
 from redis import asyncio as aioredis
 
 from src.auth.router import router as auth_router
+from src.auth.service import get_jwt_strategy
 from src.benches.router import router as benches_router
-from src.config import FIREBASE_BUCKET, REDIS_URI, firebase_creds
+from src.cache import CACHE_PREFIX, TwoTierBackend
+from src.config import (CACHE_LOCAL_MAX_BYTES, CACHE_LOCAL_TTL, REDIS_URI,
+                        STORAGE_BACKEND, STORAGE_LOCAL_PUBLIC_PATH)
+from src.database import ReadYourWritesMiddleware, replicas
 from src.error_handlers import setup_error_handlers
+from src.metrics import MetricsMiddleware, metrics
+from src.ratelimit import RateLimitMiddleware
+from src.shedding import LoadMonitor, LoadSheddingMiddleware
+from src.status.router import router as status_router
 from src.users.router import router as users_router
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
-    redis = aioredis.from_url(
-        REDIS_URI, encoding="utf8", decode_responses=True
-    )
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    # A bad JWT_ALGORITHM or JWT_PRIVATE_KEY fails the startup, not the first login
+    get_jwt_strategy()
+    redis = aioredis.from_url(REDIS_URI, encoding="utf8")
+    backend = TwoTierBackend(redis, max_bytes=CACHE_LOCAL_MAX_BYTES, ttl=CACHE_LOCAL_TTL)
+    FastAPICache.init(backend, prefix=CACHE_PREFIX)
+    background = [asyncio.create_task(backend.listen()), asyncio.create_task(load_monitor.run())]
+    if replicas.engines:
+        background.append(asyncio.create_task(replicas.monitor()))
     try:
         yield
     finally:
+        for task in background:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
         await redis.close()
 
 
@@ -30,16 +46,33 @@ tags_metadata = [
     {"name": "Benches", "description": "Operations with benches"},
     {"name": "Users", "description": "Operations with users"},
     {"name": "Authorization", "description": "Authorization logic"},
+    {"name": "Status", "description": "Health and usage of the service"},
 ]
 
+load_monitor = LoadMonitor()
+
 app = FastAPI(
     title="Bench app", docs_url="/api", openapi_tags=tags_metadata, lifespan=lifespan
 )
 
 setup_error_handlers(app)
 
+if replicas.engines:
+    app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(RateLimitMiddleware, routes=app.router.routes)
+# Before the rate limits, shedding must not wait for Redis
+app.add_middleware(LoadSheddingMiddleware, monitor=load_monitor)
+# Added last so that it is outermost and times the other middleware too
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics, include_in_schema=False)
+
 app.include_router(benches_router, tags=["Benches"])
 app.include_router(users_router, tags=["Users"])
 app.include_router(auth_router, tags=["Authorization"])
+app.include_router(status_router, tags=["Status"])
 
-firebase_admin.initialize_app(firebase_creds, {"storageBucket": FIREBASE_BUCKET})
+if STORAGE_BACKEND == "local":
+    # Published photos of the local storage backend, see STORAGE_LOCAL_URL
+    app.mount(
+        "/media", StaticFiles(directory=STORAGE_LOCAL_PUBLIC_PATH, check_dir=False), name="media"
+    )
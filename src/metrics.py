@@ -0,0 +1,174 @@
+"""Prometheus metrics of the API and the Celery workers.
+
+With several processes (gunicorn workers, Celery prefork children) every
+process writes its samples to ``PROMETHEUS_MULTIPROC_DIR`` and ``/metrics``
+aggregates the files, see ``gunicorn.conf.py``. Without that variable the
+metrics are those of the current process.
+"""
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Most requests are answered from a cache or one indexed query
+LATENCY_BUCKETS = (0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response has been sent",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being served",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+HTTP_REQUESTS_REJECTED = Counter(
+    "http_requests_rejected_total",
+    "Requests refused by the rate limits or load shedding",
+    ["route", "reason"],
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds", "Recent event loop lag", multiprocess_mode="livemax"
+)
+
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Database statements by their first keyword",
+    ["database", "statement"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Failed database statements", ["database"])
+# Other statements are counted as OTHER
+DB_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "COPY", "BEGIN", "COMMIT"}
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Time to check out a pooled connection",
+    ["database"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total", "Checkouts that gave up waiting", ["database"]
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Connections in use", ["database"], multiprocess_mode="livesum"
+)
+
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total", "Cache reads by where they were answered", ["result"]
+)
+
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "Time to hash or verify a password, waiting for a thread included",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+PASSWORD_HASH_PENDING = Gauge(
+    "password_hash_pending",
+    "Passwords being hashed or waiting for a thread",
+    multiprocess_mode="livesum",
+)
+PASSWORD_HASH_REJECTED = Counter(
+    "password_hash_rejected_total", "Hashes refused with a full queue", ["operation"]
+)
+
+CELERY_TASK_DURATION = Histogram(
+    "celery_task_duration_seconds",
+    "Celery task run time",
+    ["task", "state"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+
+def registry() -> CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+async def metrics(request: Request) -> Response:
+    return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+def _route(scope: Scope) -> str:
+    # The route template, not the path, so that ids don't make new series
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_progress.dec()
+            route = _route(scope)
+            HTTP_REQUEST_DURATION.labels(method, route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method, route, status).inc()
+
+
+def instrument_engine(engine: AsyncEngine, database: str) -> None:
+    """Time the statements of ``engine`` and track its pool."""
+    sync_engine = engine.sync_engine
+    # Read by InstrumentedPool for the checkout waits
+    sync_engine.pool.metrics_label = database
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        words = statement.split(None, 1)
+        keyword = words[0].upper() if words else ""
+        if keyword not in DB_STATEMENTS:
+            keyword = "OTHER"
+        DB_QUERY_DURATION.labels(database, keyword).observe(time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection else None
+        if started:
+            started.pop()
+        DB_QUERY_ERRORS.labels(database).inc()
+
+    @event.listens_for(sync_engine.pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.labels(database).inc()
+
+    @event.listens_for(sync_engine.pool, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.labels(database).dec()
@@ -0,0 +1,62 @@
+"""initial
+
+Revision ID: 3f1c2a9b7d10
+Revises:
+Create Date: 2024-09-08 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1c2a9b7d10"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("email", sa.String(length=254), nullable=False),
+        sa.Column("username", sa.String(length=32), nullable=False),
+        sa.Column("telegram_username", sa.String(length=32), nullable=True),
+        sa.Column("hashed_password", sa.String(length=255), nullable=False),
+        sa.Column("registered_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("is_active", sa.Boolean(), nullable=False),
+        sa.Column("is_superuser", sa.Boolean(), nullable=False),
+        sa.Column("is_verified", sa.Boolean(), nullable=False),
+        sa.CheckConstraint(
+            "LENGTH(telegram_username) >= 5", name="telegram_username_min_length"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("email"),
+        sa.UniqueConstraint("telegram_username"),
+        sa.UniqueConstraint("username"),
+    )
+    op.create_index(op.f("ix_users_id"), "users", ["id"], unique=False)
+    op.create_table(
+        "benches",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=36), nullable=False),
+        sa.Column("description", sa.String(length=512), nullable=True),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("latitude", sa.Float(), nullable=False),
+        sa.Column("longitude", sa.Float(), nullable=False),
+        sa.Column("creator_id", sa.Integer(), nullable=False),
+        sa.Column("photo_url", sa.String(length=512), nullable=True),
+        sa.ForeignKeyConstraint(["creator_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_benches_id"), "benches", ["id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_benches_id"), table_name="benches")
+    op.drop_table("benches")
+    op.drop_index(op.f("ix_users_id"), table_name="users")
+    op.drop_table("users")
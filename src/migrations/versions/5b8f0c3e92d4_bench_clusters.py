@@ -0,0 +1,90 @@
+"""bench clusters
+
+Revision ID: 5b8f0c3e92d4
+Revises: c27d9e04a1f8
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from src.benches.geo import cluster_cells
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5b8f0c3e92d4"
+down_revision: Union[str, None] = "c27d9e04a1f8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 300
+
+
+def upgrade() -> None:
+    clusters = op.create_table(
+        "bench_clusters",
+        sa.Column("zoom", sa.SmallInteger(), nullable=False),
+        sa.Column("x", sa.Integer(), nullable=False),
+        sa.Column("y", sa.Integer(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.Column("latitude_sum", sa.Float(), nullable=False),
+        sa.Column("longitude_sum", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("zoom", "x", "y"),
+    )
+
+    benches = sa.table(
+        "benches",
+        sa.column("id", sa.Integer),
+        sa.column("latitude", sa.Float),
+        sa.column("longitude", sa.Float),
+    )
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(benches.c.id, benches.c.latitude, benches.c.longitude)
+            .where(benches.c.id > last_id)
+            .order_by(benches.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+
+        deltas = {}
+        for row in rows:
+            for cell in cluster_cells(row.latitude, row.longitude):
+                delta = deltas.setdefault(cell, [0, 0.0, 0.0])
+                delta[0] += 1
+                delta[1] += row.latitude
+                delta[2] += row.longitude
+        stmt = pg_insert(clusters).values(
+            [
+                {
+                    "zoom": zoom,
+                    "x": x,
+                    "y": y,
+                    "count": count,
+                    "latitude_sum": latitude_sum,
+                    "longitude_sum": longitude_sum,
+                }
+                for (zoom, x, y), (count, latitude_sum, longitude_sum) in deltas.items()
+            ]
+        )
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["zoom", "x", "y"],
+                set_={
+                    "count": clusters.c.count + stmt.excluded.count,
+                    "latitude_sum": clusters.c.latitude_sum + stmt.excluded.latitude_sum,
+                    "longitude_sum": clusters.c.longitude_sum + stmt.excluded.longitude_sum,
+                },
+            )
+        )
+        last_id = rows[-1].id
+
+
+def downgrade() -> None:
+    op.drop_table("bench_clusters")
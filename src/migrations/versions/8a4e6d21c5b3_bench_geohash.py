@@ -0,0 +1,66 @@
+"""bench geohash
+
+Revision ID: 8a4e6d21c5b3
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from src.benches.geo import GEOHASH_PRECISION, encode_geohash
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8a4e6d21c5b3"
+down_revision: Union[str, None] = "3f1c2a9b7d10"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def upgrade() -> None:
+    op.add_column(
+        "benches",
+        sa.Column("geohash", sa.String(length=GEOHASH_PRECISION, collation="C"), nullable=True),
+    )
+
+    benches = sa.table(
+        "benches",
+        sa.column("id", sa.Integer),
+        sa.column("latitude", sa.Float),
+        sa.column("longitude", sa.Float),
+        sa.column("geohash", sa.String),
+    )
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(benches.c.id, benches.c.latitude, benches.c.longitude)
+            .where(benches.c.id > last_id)
+            .order_by(benches.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            benches.update()
+            .where(benches.c.id == sa.bindparam("bench_id"))
+            .values(geohash=sa.bindparam("bench_geohash")),
+            [
+                {"bench_id": row.id, "bench_geohash": encode_geohash(row.latitude, row.longitude)}
+                for row in rows
+            ],
+        )
+        last_id = rows[-1].id
+
+    op.alter_column("benches", "geohash", nullable=False)
+    op.create_index(op.f("ix_benches_geohash"), "benches", ["geohash"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_benches_geohash"), table_name="benches")
+    op.drop_column("benches", "geohash")
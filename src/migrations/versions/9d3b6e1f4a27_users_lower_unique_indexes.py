@@ -0,0 +1,35 @@
+"""users lower unique indexes
+
+Revision ID: 9d3b6e1f4a27
+Revises: e41b7a6c0d95
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9d3b6e1f4a27"
+down_revision: Union[str, None] = "e41b7a6c0d95"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = ("email", "username", "telegram_username")
+
+
+def upgrade() -> None:
+    # Fails if two users only differ by case, they have to be merged first
+    for column in COLUMNS:
+        op.create_index(
+            f"ix_users_lower_{column}", "users", [sa.text(f"lower({column})")], unique=True
+        )
+        op.drop_constraint(f"users_{column}_key", "users", type_="unique")
+
+
+def downgrade() -> None:
+    for column in COLUMNS:
+        op.create_unique_constraint(f"users_{column}_key", "users", [column])
+        op.drop_index(f"ix_users_lower_{column}", table_name="users")
@@ -0,0 +1,26 @@
+"""bench photo object
+
+Revision ID: b5e2f7a0c3d9
+Revises: 9d3b6e1f4a27
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b5e2f7a0c3d9"
+down_revision: Union[str, None] = "9d3b6e1f4a27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("benches", sa.Column("photo_object", sa.String(length=512), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("benches", "photo_object")
@@ -0,0 +1,27 @@
+"""bench latitude longitude index
+
+Revision ID: c27d9e04a1f8
+Revises: 8a4e6d21c5b3
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c27d9e04a1f8"
+down_revision: Union[str, None] = "8a4e6d21c5b3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_benches_latitude_longitude", "benches", ["latitude", "longitude"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_benches_latitude_longitude", table_name="benches")
@@ -0,0 +1,40 @@
+"""bench clusters min zoom
+
+Revision ID: d83a5c6f1e20
+Revises: b5e2f7a0c3d9
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d83a5c6f1e20"
+down_revision: Union[str, None] = "b5e2f7a0c3d9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# CLUSTER_MIN_ZOOM when this revision was written
+MIN_ZOOM = 5
+
+
+def upgrade() -> None:
+    # Summed up from MIN_ZOOM when read from now on
+    op.execute(f"DELETE FROM bench_clusters WHERE zoom < {MIN_ZOOM}")
+
+
+def downgrade() -> None:
+    for zoom in range(MIN_ZOOM):
+        shift = MIN_ZOOM - zoom
+        op.execute(
+            f"""
+            INSERT INTO bench_clusters (zoom, x, y, count, latitude_sum, longitude_sum)
+            SELECT {zoom}, x >> {shift}, y >> {shift}, sum(count),
+                   sum(latitude_sum), sum(longitude_sum)
+            FROM bench_clusters
+            WHERE zoom = {MIN_ZOOM}
+            GROUP BY x >> {shift}, y >> {shift}
+            """
+        )
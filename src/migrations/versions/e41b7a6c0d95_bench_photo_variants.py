@@ -0,0 +1,30 @@
+"""bench photo variants
+
+Revision ID: e41b7a6c0d95
+Revises: 5b8f0c3e92d4
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e41b7a6c0d95"
+down_revision: Union[str, None] = "5b8f0c3e92d4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "benches",
+        sa.Column("photo_variants", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("benches", "photo_variants")
@@ -0,0 +1,38 @@
+import base64
+import binascii
+from typing import Generic, Optional, Sequence, TypeVar
+
+from pydantic import BaseModel
+
+from src.constants import VALIDATION_ERROR
+from src.exceptions import ErrorHTTPException
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ErrorHTTPException(
+            status_code=400, error_code=VALIDATION_ERROR, detail="Invalid cursor"
+        )
+
+
+def build_page(rows: Sequence, limit: int) -> dict:
+    """``rows`` is the result of a ``LIMIT limit + 1`` keyset query ordered by id."""
+    items = list(rows[:limit])
+    next_cursor = encode_cursor(items[-1].id) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
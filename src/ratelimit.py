@@ -0,0 +1,150 @@
+"""Per client token buckets kept in Redis.
+
+A client is the user of a valid access token, otherwise the IP address.
+Buckets are updated by a Lua script, so that the workers sharing Redis
+agree on them without races, and expire once they would be full again.
+"""
+import logging
+import math
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import jwt
+from fastapi_cache import FastAPICache
+from fastapi_users.jwt import decode_jwt
+from starlette.requests import HTTPConnection
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from src.auth.cache import token_key, user_cache
+from src.auth.service import cookie_transport, get_jwt_strategy
+from src.config import RATE_LIMITS
+from src.constants import RATE_LIMITED
+from src.error_handlers import error_response
+from src.metrics import HTTP_REQUESTS_REJECTED
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PREFIX = "ratelimit"
+# Routes without a limit of their own in RATE_LIMITS
+OTHER_ROUTES = "*"
+
+# KEYS[1]: bucket, ARGV: rate, burst. Returns whether the request is
+# allowed and, as a string to keep the fraction, the seconds until it would be
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    rate: float
+    burst: int
+
+
+def parse_rate_limits(spec: str) -> dict[str, RateLimit]:
+    """``"/benches=10/30,*=50/100"`` to limits by route template."""
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        route, _, limit = item.rpartition("=")
+        rate, _, burst = limit.partition("/")
+        limits[route] = RateLimit(float(rate), int(burst or rate))
+    return limits
+
+
+def route_template(routes: Sequence[BaseRoute], scope: Scope) -> Optional[str]:
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None)
+    return None
+
+
+def client_key(scope: Scope) -> str:
+    connection = HTTPConnection(scope)
+    token = connection.cookies.get(cookie_transport.cookie_name)
+    if token:
+        user = user_cache.get(token_key(token))
+        if user is not None:
+            return f"user:{user.id}"
+        strategy = get_jwt_strategy()
+        try:
+            data = decode_jwt(
+                token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm]
+            )
+        except jwt.PyJWTError:
+            data = {}
+        if data.get("sub"):
+            return f"user:{data['sub']}"
+    # Behind a proxy, with uvicorn's --forwarded-allow-ips set to trust it
+    return f"ip:{connection.client.host if connection.client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """Answers 429 to clients over their limit. ``routes`` are those of the
+    app, to find the route template before the app does."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        routes: Sequence[BaseRoute],
+        limits: Optional[dict[str, RateLimit]] = None,
+    ):
+        self.app = app
+        self.routes = routes
+        self.limits = parse_rate_limits(RATE_LIMITS) if limits is None else limits
+        self._scripts = {}
+
+    async def _retry_after(self, key: str, limit: RateLimit) -> Optional[float]:
+        """Seconds until the client may retry, None when the request is allowed."""
+        redis = FastAPICache.get_backend().redis
+        script = self._scripts.get(id(redis))
+        if script is None:
+            script = self._scripts[id(redis)] = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        allowed, retry_after = await script(keys=[key], args=[limit.rate, limit.burst])
+        return None if allowed else float(retry_after)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.limits:
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(self.routes, scope)
+        limit = self.limits.get(route) or self.limits.get(OTHER_ROUTES)
+        if route is None or limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = f"{RATE_LIMIT_PREFIX}:{route}:{client_key(scope)}"
+        try:
+            retry_after = await self._retry_after(key, limit)
+        except Exception:
+            # Not worth failing requests over
+            logger.warning("Error checking rate limit of %s", key, exc_info=True)
+            retry_after = None
+        if retry_after is None:
+            await self.app(scope, receive, send)
+            return
+
+        HTTP_REQUESTS_REJECTED.labels(route, "rate_limit").inc()
+        response = error_response(429, RATE_LIMITED, "Too many requests, slow down")
+        response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+        await response(scope, receive, send)
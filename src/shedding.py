@@ -0,0 +1,89 @@
+"""Refusing requests early while the worker is overloaded.
+
+``LoadMonitor`` samples the event loop lag and how long database pool
+checkouts wait. Above SHED_LOOP_LAG or SHED_POOL_WAIT a share of requests
+is answered 503 at once, growing to all of them at twice the threshold,
+instead of every request queueing until it times out.
+"""
+import asyncio
+import random
+import time
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from src.config import SHED_LOOP_LAG, SHED_POOL_WAIT
+from src.constants import OVERLOADED
+from src.database import engine
+from src.error_handlers import error_response
+from src.metrics import EVENT_LOOP_LAG, HTTP_REQUESTS_REJECTED
+
+SHED_CHECK_INTERVAL = 0.1
+# Share of the previous value kept, spikes count at once but fade quickly
+DECAY = 0.8
+# Never refused, to keep watching the worker
+EXEMPT_PATHS = ("/metrics", "/status/")
+
+
+class LoadMonitor:
+    def __init__(
+        self,
+        engine: AsyncEngine = engine,
+        loop_lag: float = SHED_LOOP_LAG,
+        pool_wait: float = SHED_POOL_WAIT,
+    ):
+        self.engine = engine
+        self.thresholds = {"loop_lag": loop_lag, "pool_wait": pool_wait}
+        self.values = {"loop_lag": 0.0, "pool_wait": 0.0}
+
+    def _update(self, name: str, value: float) -> None:
+        self.values[name] = max(value, self.values[name] * DECAY)
+
+    async def run(self, interval: float = SHED_CHECK_INTERVAL) -> None:
+        pool = self.engine.sync_engine.pool
+        checkouts = getattr(pool, "checkouts", 0)
+        waited = getattr(pool, "wait_seconds", 0.0)
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self._update("loop_lag", time.perf_counter() - started - interval)
+            EVENT_LOOP_LAG.set(self.values["loop_lag"])
+
+            # Average wait of the checkouts since the last sample, see
+            # database.InstrumentedPool
+            new_checkouts = getattr(pool, "checkouts", 0) - checkouts
+            new_wait = getattr(pool, "wait_seconds", 0.0) - waited
+            checkouts += new_checkouts
+            waited += new_wait
+            self._update("pool_wait", new_wait / new_checkouts if new_checkouts else 0.0)
+
+    def overload(self) -> tuple[float, Optional[str]]:
+        """Share of requests to refuse, and the measure that calls for it."""
+        share, reason = 0.0, None
+        for name, threshold in self.thresholds.items():
+            excess = (self.values[name] - threshold) / threshold
+            if excess > share:
+                share, reason = min(excess, 1.0), name
+        return share, reason
+
+
+class LoadSheddingMiddleware:
+    def __init__(self, app: ASGIApp, monitor: LoadMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        share, reason = self.monitor.overload()
+        if not share or random.random() >= share:
+            await self.app(scope, receive, send)
+            return
+
+        HTTP_REQUESTS_REJECTED.labels("*", reason).inc()
+        response = error_response(503, OVERLOADED, "The service is overloaded, try again later")
+        response.headers["Retry-After"] = "1"
+        await response(scope, receive, send)
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends
+
+from src.auth.dependencies import current_superuser
+from src.database import pool_status
+from src.users.models import User
+
+router = APIRouter()
+
+
+@router.get("/status/db_pool")
+async def get_db_pool_status(user: User = Depends(current_superuser)):
+    """Database pool of the worker process that serves the request."""
+    return pool_status()
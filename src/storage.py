@@ -0,0 +1,405 @@
+"""Object storage used for bench photos.
+
+The backend is picked with ``STORAGE_BACKEND``: ``firebase`` (the default),
+``local`` (files under ``STORAGE_LOCAL_PATH``, the published ones served by
+the app under ``/media``) or ``memory``. ``get_storage`` is a dependency, so tests can
+override it with ``MemoryStorage``.
+
+Blocking calls run in threads, at most ``STORAGE_MAX_CONCURRENCY`` at a time
+per storage, and transient errors are retried ``STORAGE_RETRIES`` times.
+Other failures are raised as ``StorageError``.
+"""
+import asyncio
+import functools
+import mimetypes
+import os
+import shutil
+import tempfile
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+import firebase_admin
+import requests
+from firebase_admin import credentials
+from firebase_admin import storage as firebase_storage
+from google.api_core.retry import if_transient_error
+from google.auth.exceptions import TransportError
+from google.cloud.exceptions import GoogleCloudError, NotFound
+
+from src.config import (FIREBASE_BUCKET, FIREBASE_CREDS, STORAGE_BACKEND,
+                        STORAGE_LOCAL_PATH, STORAGE_LOCAL_PUBLIC_PATH,
+                        STORAGE_LOCAL_URL, STORAGE_MAX_CONCURRENCY,
+                        STORAGE_RETRIES)
+
+# GCS resumable uploads are sent in multiples of 256 KiB
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Doubled after every attempt
+RETRY_DELAY = 0.2
+
+
+class StorageError(Exception):
+    pass
+
+
+@dataclass
+class StoredObject:
+    size: int
+    content_type: Optional[str]
+
+
+class StorageWriter(ABC):
+    """An object being uploaded. Nothing is stored unless ``close`` is
+    called, a writer that is dropped half way leaves no object behind.
+    ``abort`` frees what the upload holds right away instead."""
+
+    @abstractmethod
+    async def write(self, data: bytes) -> None: ...
+
+    @abstractmethod
+    async def close(self) -> None: ...
+
+    @abstractmethod
+    async def abort(self) -> None: ...
+
+
+class Storage(ABC):
+    # Errors of the blocking client raised as StorageError
+    errors: tuple[type[Exception], ...] = (OSError,)
+
+    def __init__(
+        self, max_concurrency: int = STORAGE_MAX_CONCURRENCY, retries: int = STORAGE_RETRIES
+    ):
+        self.retries = retries
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    def is_transient(self, error: Exception) -> bool:
+        return False
+
+    async def _call(self, func: Callable, *args, retry: bool = True, **kwargs):
+        """Run a blocking call in a thread. Only idempotent calls may be retried."""
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            try:
+                async with self._slots:
+                    return await asyncio.to_thread(func, *args, **kwargs)
+            except self.errors as e:
+                if attempt + 1 == attempts or not self.is_transient(e):
+                    raise StorageError(str(e)) from e
+            # Not holding a slot while waiting
+            await asyncio.sleep(RETRY_DELAY * 2**attempt)
+
+    @abstractmethod
+    async def open_writer(self, name: str, content_type: str) -> StorageWriter: ...
+
+    @abstractmethod
+    async def read(self, name: str) -> bytes: ...
+
+    @abstractmethod
+    async def stat(self, name: str) -> Optional[StoredObject]:
+        """Size and content type of the object, None if it does not exist."""
+
+    @abstractmethod
+    async def rename(self, name: str, new_name: str) -> None: ...
+
+    @abstractmethod
+    async def delete(self, name: str) -> None: ...
+
+    @abstractmethod
+    async def publish(self, name: str) -> str:
+        """Make the object public, returns its URL."""
+
+    async def exists(self, name: str) -> bool:
+        return await self.stat(name) is not None
+
+    async def write(self, name: str, data: bytes, content_type: str) -> None:
+        writer = await self.open_writer(name, content_type)
+        await writer.write(data)
+        await writer.close()
+
+    async def signed_upload_url(
+        self, name: str, content_type: str, headers: dict[str, str], expiration: timedelta
+    ) -> str:
+        """URL a client can PUT the object to without going through the API.
+        ``headers`` have to be sent along with the upload."""
+        raise StorageError(f"{type(self).__name__} does not support signed uploads")
+
+
+def firebase_app() -> firebase_admin.App:
+    """The default Firebase app, initialised on first use so that the
+    credentials are only needed by the Firebase backend."""
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        creds = credentials.Certificate(FIREBASE_CREDS)
+        return firebase_admin.initialize_app(creds, {"storageBucket": FIREBASE_BUCKET})
+
+
+class FirebaseStorageWriter(StorageWriter):
+    def __init__(self, storage: "FirebaseStorage", blob_writer):
+        self._storage = storage
+        self._blob_writer = blob_writer
+
+    # Resumable uploads retry their own chunks, a chunk can't be sent twice
+    async def write(self, data: bytes) -> None:
+        # Buffers up to UPLOAD_CHUNK_SIZE, then uploads one resumable chunk
+        await self._storage._call(self._blob_writer.write, data, retry=False)
+
+    async def close(self) -> None:
+        await self._storage._call(self._blob_writer.close, retry=False)
+
+    async def abort(self) -> None:
+        await self._storage._call(self._cancel, retry=False)
+
+    def _cancel(self) -> None:
+        # BlobWriter has no way to drop an upload, close() would finish it
+        blob_writer = self._blob_writer
+        # The session is only started with the first chunk
+        if blob_writer._upload_and_transport is not None:
+            upload, transport = blob_writer._upload_and_transport
+            # GCS ends a resumable session on a DELETE of its URL
+            transport.request("DELETE", upload.resumable_url)
+        blob_writer._buffer.close()
+
+
+class FirebaseStorage(Storage):
+    """The Firebase app's default bucket."""
+
+    errors = (GoogleCloudError, TransportError, requests.RequestException)
+
+    def is_transient(self, error: Exception) -> bool:
+        return if_transient_error(error)
+
+    @property
+    def bucket(self):
+        return firebase_storage.bucket(app=firebase_app())
+
+    async def open_writer(self, name: str, content_type: str) -> StorageWriter:
+        blob = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob_writer = await self._call(blob.open, "wb", content_type=content_type)
+        return FirebaseStorageWriter(self, blob_writer)
+
+    async def read(self, name: str) -> bytes:
+        return await self._call(self.bucket.blob(name).download_as_bytes)
+
+    async def stat(self, name: str) -> Optional[StoredObject]:
+        blob = await self._call(self.bucket.get_blob, name)
+        if blob is None:
+            return None
+        return StoredObject(blob.size or 0, blob.content_type)
+
+    async def rename(self, name: str, new_name: str) -> None:
+        # Not retried, the source is gone if a timed out attempt succeeded
+        bucket = self.bucket
+        await self._call(bucket.rename_blob, bucket.blob(name), new_name, retry=False)
+
+    async def delete(self, name: str) -> None:
+        try:
+            await self._call(self.bucket.blob(name).delete)
+        except StorageError as e:
+            # A retried delete may find the object already gone
+            if not isinstance(e.__cause__, NotFound):
+                raise
+
+    async def publish(self, name: str) -> str:
+        blob = self.bucket.blob(name)
+        await self._call(blob.make_public)
+        return blob.public_url
+
+    async def signed_upload_url(
+        self, name: str, content_type: str, headers: dict[str, str], expiration: timedelta
+    ) -> str:
+        # Signed locally with the service account key, no request is made
+        return await self._call(
+            self.bucket.blob(name).generate_signed_url,
+            version="v4",
+            expiration=expiration,
+            method="PUT",
+            content_type=content_type,
+            headers=headers,
+        )
+
+
+def _discard(file) -> None:
+    file.close()
+    with suppress(FileNotFoundError):
+        os.unlink(file.name)
+
+
+class LocalStorageWriter(StorageWriter):
+    def __init__(self, storage: "LocalStorage", path: Path, file):
+        self._storage = storage
+        self._path = path
+        self._file = file
+        # Removes the temporary file if the writer is dropped without close()
+        self._finalizer = weakref.finalize(self, _discard, file)
+
+    async def write(self, data: bytes) -> None:
+        await self._storage._call(self._file.write, data, retry=False)
+
+    async def close(self) -> None:
+        await self._storage._call(self._commit, retry=False)
+
+    async def abort(self) -> None:
+        # Runs _discard once, a committed writer has no finalizer left
+        await self._storage._call(self._finalizer, retry=False)
+
+    def _commit(self) -> None:
+        self._file.close()
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self._file.name, self._path)
+        self._finalizer.detach()
+        # A published object is replaced by a new file, the link still has the old one
+        public_path = self._storage._public_path(self._path)
+        if public_path.exists():
+            self._storage._link(self._path, public_path)
+
+
+class LocalStorage(Storage):
+    """Objects as files under ``root``, for development, CI and load tests
+    without network access. Published objects are hard linked under
+    ``public_root``, the only directory to serve, at ``base_url``."""
+
+    def __init__(self, root: str | Path, public_root: str | Path, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.root = Path(root).resolve()
+        self.public_root = Path(public_root).resolve()
+        self.base_url = base_url
+
+    def _path(self, name: str) -> Path:
+        path = (self.root / name).resolve()
+        if not path.is_relative_to(self.root):
+            raise StorageError(f"Invalid object name {name!r}")
+        return path
+
+    def _public_path(self, path: Path) -> Path:
+        return self.public_root / path.relative_to(self.root)
+
+    def _link(self, path: Path, public_path: Path) -> None:
+        public_path.parent.mkdir(parents=True, exist_ok=True)
+        with suppress(FileNotFoundError):
+            public_path.unlink()
+        try:
+            os.link(path, public_path)
+        except FileExistsError:
+            # Published at the same time by another request
+            pass
+        except OSError:
+            # E.g. the public root on another file system
+            shutil.copyfile(path, public_path)
+
+    def _unlink_public(self, path: Path) -> None:
+        self._public_path(path).unlink(missing_ok=True)
+
+    def _open_temporary(self):
+        # Same file system as the objects, so that close() is an atomic rename
+        temporary = self.root / ".tmp"
+        temporary.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=temporary, delete=False)
+
+    async def open_writer(self, name: str, content_type: str) -> StorageWriter:
+        path = self._path(name)
+        file = await self._call(self._open_temporary)
+        return LocalStorageWriter(self, path, file)
+
+    async def read(self, name: str) -> bytes:
+        return await self._call(self._path(name).read_bytes)
+
+    def _stat(self, name: str) -> Optional[StoredObject]:
+        path = self._path(name)
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return None
+        return StoredObject(size, mimetypes.guess_type(path.name)[0])
+
+    async def stat(self, name: str) -> Optional[StoredObject]:
+        return await self._call(self._stat, name)
+
+    async def rename(self, name: str, new_name: str) -> None:
+        # Like a bucket, the object under its new name is private
+        path, new_path = self._path(name), self._path(new_name)
+        await self._call(new_path.parent.mkdir, parents=True, exist_ok=True)
+        await self._call(os.replace, path, new_path)
+        await self._call(self._unlink_public, path)
+
+    async def delete(self, name: str) -> None:
+        path = self._path(name)
+        await self._call(path.unlink, missing_ok=True)
+        await self._call(self._unlink_public, path)
+
+    async def publish(self, name: str) -> str:
+        path = self._path(name)
+        await self._call(self._link, path, self._public_path(path))
+        return f"{self.base_url}{name}"
+
+
+class MemoryStorageWriter(StorageWriter):
+    def __init__(self, storage: "MemoryStorage", name: str, content_type: str):
+        self._storage = storage
+        self._name = name
+        self._content_type = content_type
+        self._data = bytearray()
+
+    async def write(self, data: bytes) -> None:
+        self._data += data
+
+    async def close(self) -> None:
+        self._storage.objects[self._name] = (bytes(self._data), self._content_type)
+
+    async def abort(self) -> None:
+        self._data.clear()
+
+
+class MemoryStorage(Storage):
+    """In-process fake for tests and offline runs."""
+
+    def __init__(self, base_url: str = "http://storage.invalid/", **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+        self.objects: dict[str, tuple[bytes, str]] = {}
+        self.public: set[str] = set()
+
+    async def open_writer(self, name: str, content_type: str) -> StorageWriter:
+        return MemoryStorageWriter(self, name, content_type)
+
+    async def read(self, name: str) -> bytes:
+        return self.objects[name][0]
+
+    async def stat(self, name: str) -> Optional[StoredObject]:
+        if name not in self.objects:
+            return None
+        data, content_type = self.objects[name]
+        return StoredObject(len(data), content_type)
+
+    async def rename(self, name: str, new_name: str) -> None:
+        self.objects[new_name] = self.objects.pop(name)
+
+    async def delete(self, name: str) -> None:
+        self.objects.pop(name, None)
+
+    async def publish(self, name: str) -> str:
+        self.public.add(name)
+        return f"{self.base_url}{name}"
+
+
+def create_storage() -> Storage:
+    """A new storage of the configured backend. Its concurrency limit is
+    bound to one event loop, e.g. Celery tasks create their own."""
+    if STORAGE_BACKEND == "firebase":
+        return FirebaseStorage()
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(STORAGE_LOCAL_PATH, STORAGE_LOCAL_PUBLIC_PATH, STORAGE_LOCAL_URL)
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+
+
+@functools.lru_cache
+def get_storage() -> Storage:
+    # Shared by all requests, so that the concurrency limit is per process
+    return create_storage()
@@ -0,0 +1,162 @@
+import asyncio
+import io
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from sqlalchemy import update
+
+from src.benches.cache import invalidate_benches
+from src.benches.models import Bench
+from src.cache import BENCHES_TAG, bump_generation, standalone_cache
+from src.config import REDIS_URI
+from src.database import async_session_maker, engine
+from src.storage import Storage, create_storage
+from src.tasks.task import celery
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels; photos are never scaled up
+VARIANT_SIZES = {"thumb": 320, "medium": 1280}
+
+# (content type, Pillow format, extension, save options), smallest first
+VARIANT_FORMATS = [
+    ("image/avif", "AVIF", "avif", {"quality": 50}),
+    ("image/webp", "WEBP", "webp", {"quality": 80, "method": 4}),
+]
+
+# Copies of the photo itself by the uploaded Pillow format: (content type,
+# Pillow format, extension, save options)
+FULL_FORMATS = {
+    "JPEG": ("image/jpeg", "JPEG", "jpg", {"quality": 90}),
+    # JPEGs with more pictures appended, as phone cameras make; the first is kept
+    "MPO": ("image/jpeg", "JPEG", "jpg", {"quality": 90}),
+    "PNG": ("image/png", "PNG", "png", {}),
+    "WEBP": ("image/webp", "WEBP", "webp", {"quality": 90}),
+}
+
+
+@dataclass
+class ImageVariant:
+    variant: str
+    content_type: str
+    extension: str
+    width: int
+    height: int
+    data: bytes
+
+
+def variant_name(object_name: str, variant: str, extension: str) -> str:
+    stem = object_name.rsplit(".", 1)[0]
+    return f"{stem}.{variant}.{extension}"
+
+
+def _formats() -> list:
+    # AVIF needs a Pillow built with libavif
+    return [fmt for fmt in VARIANT_FORMATS if fmt[1] != "AVIF" or features.check("avif")]
+
+
+def make_variants(data: bytes) -> list[ImageVariant]:
+    """Resized copies of the photo in every format. Orientation is applied
+    to the pixels and no EXIF is written, which drops e.g. GPS tags."""
+    variants = []
+    with Image.open(io.BytesIO(data)) as original:
+        # Lets JPEG decode at a reduced scale when the photo is much larger
+        original.draft("RGB", (max(VARIANT_SIZES.values()),) * 2)
+        image = ImageOps.exif_transpose(original)
+        icc_profile = image.info.get("icc_profile")
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        sizes = set()
+        for variant, size in VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+            if resized.size in sizes:
+                continue
+            sizes.add(resized.size)
+            for content_type, pil_format, extension, options in _formats():
+                buffer = io.BytesIO()
+                resized.save(buffer, format=pil_format, icc_profile=icc_profile, **options)
+                variants.append(
+                    ImageVariant(variant, content_type, extension, *resized.size, buffer.getvalue())
+                )
+    return variants
+
+
+def make_full(data: bytes) -> ImageVariant:
+    """Copy of the photo at its own size and format, to publish instead of
+    the upload. Like the variants it is written without any EXIF."""
+    with Image.open(io.BytesIO(data)) as original:
+        if original.format not in FULL_FORMATS:
+            raise UnidentifiedImageError(f"Unsupported photo format {original.format}")
+        content_type, pil_format, extension, options = FULL_FORMATS[original.format]
+        image = ImageOps.exif_transpose(original)
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, icc_profile=image.info.get("icc_profile"), **options)
+    return ImageVariant("full", content_type, extension, *image.size, buffer.getvalue())
+
+
+async def store_full(storage: Storage, object_name: str, data: bytes) -> str:
+    """Store and publish the copy of the photo ``data`` stored as
+    ``object_name``, returns its URL."""
+    full = make_full(data)
+    name = variant_name(object_name, full.variant, full.extension)
+    if not await storage.exists(name):
+        await storage.write(name, full.data, full.content_type)
+    return await storage.publish(name)
+
+
+async def store_variants(storage: Storage, object_name: str, data: bytes) -> list[dict]:
+    """Make and store the variants of the photo ``data`` stored as
+    ``object_name``, returns them as ``BenchRead.photo_variants`` records."""
+    records = []
+    for variant in make_variants(data):
+        name = variant_name(object_name, variant.variant, variant.extension)
+        # Photos are content addressed, so existing variants are up to date
+        if not await storage.exists(name):
+            await storage.write(name, variant.data, variant.content_type)
+        records.append(
+            {
+                "url": await storage.publish(name),
+                "content_type": variant.content_type,
+                "width": variant.width,
+                "height": variant.height,
+            }
+        )
+    return records
+
+
+async def _process_bench_photo(bench_id: int, object_name: str) -> None:
+    storage = create_storage()
+    data = await storage.read(object_name)
+    photo_url = await store_full(storage, object_name, data)
+    records = await store_variants(storage, object_name, data)
+    try:
+        async with standalone_cache(REDIS_URI), async_session_maker() as session:
+            result = await session.execute(
+                update(Bench)
+                # The bench may have got another photo in the meantime
+                .where(Bench.id == bench_id, Bench.photo_object == object_name)
+                .values(photo_url=photo_url, photo_variants=records)
+                .returning(Bench.id)
+            )
+            if result.first() is not None:
+                await session.commit()
+                await invalidate_benches([bench_id])
+                await bump_generation(BENCHES_TAG)
+    finally:
+        # Pooled connections belong to this task's event loop
+        await engine.dispose()
+
+
+@celery.task(bind=True, max_retries=3, default_retry_delay=20)
+def process_bench_photo(self, bench_id: int, object_name: str):
+    """Publish an uploaded photo of a bench, the upload itself stays private
+    since it may carry e.g. GPS tags."""
+    try:
+        asyncio.run(_process_bench_photo(bench_id, object_name))
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning("Cannot process photo %s of bench %s", object_name, bench_id, exc_info=True)
+    except Exception as exc:
+        raise self.retry(exc=exc)
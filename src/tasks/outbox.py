@@ -0,0 +1,221 @@
+"""Outgoing emails collected in Redis and sent in batches.
+
+``queue_verification_email`` only appends to the outbox and, for the first
+email of a window, schedules ``flush_email_outbox`` ``EMAIL_FLUSH_WINDOW``
+seconds later. A flush sends what has been collected over the pooled SMTP
+connection, at most ``EMAIL_RATE_LIMIT`` emails per second, and keeps the
+rest for a later flush. Domains that answer with temporary errors are
+backed off exponentially, as is everything when the SMTP server itself
+fails.
+"""
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Optional
+
+import redis
+from redis.exceptions import LockError
+from smtplib import SMTPDataError, SMTPRecipientsRefused
+
+from src.config import (EMAIL_BATCH_SIZE, EMAIL_BURST, EMAIL_FLUSH_WINDOW,
+                        EMAIL_RATE_LIMIT, REDIS_URI)
+from src.tasks.smtp import SMTPPool, SMTPSendError, smtp_pool
+from src.tasks.task import celery, get_verification_email_template
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_KEY = "mail:outbox"
+FLUSH_SCHEDULED_KEY = "mail:flush-scheduled"
+FLUSH_LOCK_KEY = "mail:flush-lock"
+BUCKET_KEY = "mail:bucket"
+BACKOFF_KEY = "mail:backoff"
+# Backoff of the SMTP server itself, applies to every domain
+ALL_DOMAINS = "*"
+
+BACKOFF_BASE = 30
+BACKOFF_MAX = 60 * 60
+# Dropped after that many failed attempts, about a day with the backoff
+MAX_ATTEMPTS = 30
+FLUSH_LOCK_TIMEOUT = 5 * 60
+
+_redis: Optional[redis.Redis] = None
+
+
+def get_redis() -> redis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(REDIS_URI)
+    return _redis
+
+
+def backoff_delay(failures: int) -> float:
+    """Exponential with jitter, so that deferred emails don't all come back
+    at the same moment."""
+    delay = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.75, 1)
+
+
+def queue_verification_email(
+    email: str, token: str, client: Optional[redis.Redis] = None
+) -> None:
+    client = client or get_redis()
+    client.rpush(OUTBOX_KEY, json.dumps({"email": email, "token": token, "attempts": 0}))
+    schedule_flush(client, EMAIL_FLUSH_WINDOW)
+
+
+def schedule_flush(client: redis.Redis, delay: float) -> None:
+    # Expires after the flush should have run, in case the task got lost
+    if client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, px=int((delay + 60) * 1000)):
+        flush_email_outbox.apply_async(countdown=delay)
+
+
+class TokenBucket:
+    """Token bucket kept in Redis. Only used under the flush lock, so
+    reading and writing it back needs no atomicity."""
+
+    def __init__(
+        self, client: redis.Redis, rate: float = EMAIL_RATE_LIMIT, burst: int = EMAIL_BURST
+    ):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+
+    def available(self, now: float) -> float:
+        state = self.client.hgetall(BUCKET_KEY)
+        if not state:
+            return self.burst
+        tokens = float(state[b"tokens"]) + (now - float(state[b"updated"])) * self.rate
+        return min(tokens, self.burst)
+
+    def consume(self, count: int, now: float) -> None:
+        tokens = self.available(now) - count
+        self.client.hset(BUCKET_KEY, mapping={"tokens": tokens, "updated": now})
+
+    def wait(self, now: float) -> float:
+        """Seconds until the next token."""
+        return max(0.0, (1 - self.available(now)) / self.rate)
+
+
+def _domain(email: str) -> str:
+    return email.rsplit("@", 1)[-1].lower()
+
+
+def flush_outbox(
+    client: redis.Redis, pool: SMTPPool, now: Optional[float] = None
+) -> Optional[float]:
+    """Send one batch from the outbox. Returns the seconds until the next
+    flush is due, None when the outbox is empty."""
+    now = time.time() if now is None else now
+    lock = client.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT, blocking=False)
+    if not lock.acquire():
+        # Another flush is running, check back later
+        return EMAIL_FLUSH_WINDOW
+    try:
+        raw = client.lrange(OUTBOX_KEY, 0, EMAIL_BATCH_SIZE - 1)
+        if not raw:
+            return None
+        backoff = {
+            domain.decode(): json.loads(value)
+            for domain, value in client.hgetall(BACKOFF_KEY).items()
+        }
+
+        def backed_off_until(domain: str) -> float:
+            return max(backoff.get(d, {}).get("until", 0) for d in (domain, ALL_DOMAINS))
+
+        by_domain = defaultdict(list)
+        deferred = []
+        for item in map(json.loads, raw):
+            if backed_off_until(_domain(item["email"])) > now:
+                deferred.append(item)
+            else:
+                by_domain[_domain(item["email"])].append(item)
+
+        bucket = TokenBucket(client)
+        allowed = int(bucket.available(now))
+        attempted = 0
+        failed = []
+        for domain, items in by_domain.items():
+            # The server may have failed for an earlier domain
+            if attempted == allowed or backed_off_until(domain) > now:
+                deferred.extend(items)
+                continue
+            batch = items[: allowed - attempted]
+            deferred.extend(items[len(batch) :])
+            attempted += len(batch)
+            failed.extend(_send(pool, batch, domain, backoff, now))
+        bucket.consume(attempted, now)
+
+        for item in failed:
+            item["attempts"] += 1
+        dropped = [item for item in failed if item["attempts"] >= MAX_ATTEMPTS]
+        for item in dropped:
+            logger.error(f"Giving up on verification email to {item['email']}")
+        requeued = deferred + [item for item in failed if item["attempts"] < MAX_ATTEMPTS]
+
+        with client.pipeline() as pipeline:
+            pipeline.ltrim(OUTBOX_KEY, len(raw), -1)
+            if requeued:
+                pipeline.rpush(OUTBOX_KEY, *(json.dumps(item) for item in requeued))
+            pipeline.delete(BACKOFF_KEY)
+            if backoff:
+                pipeline.hset(
+                    BACKOFF_KEY,
+                    mapping={domain: json.dumps(value) for domain, value in backoff.items()},
+                )
+            pipeline.llen(OUTBOX_KEY)
+            remaining = pipeline.execute()[-1]
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning("Email outbox flush took longer than its lock")
+
+    if not remaining:
+        return None
+    waits = [max(0, backed_off_until(_domain(item["email"])) - now) for item in requeued]
+    if remaining > len(requeued):
+        # Emails past this batch, or queued while it was sent
+        waits.append(0)
+    # Every email needs a token
+    return max(min(waits), bucket.wait(now))
+
+
+def _send(pool: SMTPPool, items: list[dict], domain: str, backoff: dict, now: float) -> list[dict]:
+    """Send the emails of one domain, returns the ones to try again."""
+    messages = [get_verification_email_template(item["email"], item["token"]) for item in items]
+    try:
+        refused = pool.send(messages)
+    except SMTPSendError as e:
+        # Recipients or data deferred by the domain, other errors concern the server
+        per_domain = isinstance(e.error, (SMTPRecipientsRefused, SMTPDataError))
+        key = domain if per_domain else ALL_DOMAINS
+        failures = backoff.get(key, {}).get("failures", 0) + 1
+        backoff[key] = {"failures": failures, "until": now + backoff_delay(failures)}
+        logger.warning(f"Backing off emails to {key} after: {e.error}")
+        unsent = {id(message) for message in e.unsent}
+        return [item for item, message in zip(items, messages) if id(message) in unsent]
+
+    backoff.pop(domain, None)
+    backoff.pop(ALL_DOMAINS, None)
+    for message, error in refused:
+        logger.error(f"Verification email to {message['To']} refused: {error}")
+    return []
+
+
+@celery.task(bind=True)
+def flush_email_outbox(self):
+    client = get_redis()
+    try:
+        # Emails queued from now on schedule another flush
+        client.delete(FLUSH_SCHEDULED_KEY)
+        delay = flush_outbox(client, smtp_pool)
+    except Exception as exc:
+        # SMTP errors are backed off within the flush, after anything else
+        # nothing would flush the outbox until another email is queued
+        retry_delay = backoff_delay(self.request.retries + 1)
+        logger.warning(f"Email outbox flush failed, retrying in {retry_delay:.0f}s: {exc}")
+        raise self.retry(exc=exc, countdown=retry_delay, max_retries=None)
+    if delay is not None:
+        schedule_flush(client, delay)
@@ -0,0 +1,168 @@
+"""SMTP connection kept open between the tasks of a worker process.
+
+Opening a connection costs a TCP and TLS handshake plus a login, which is
+most of the time it takes to send one email and what providers rate limit.
+"""
+import os
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from email.message import EmailMessage
+from typing import Iterator, Optional, Sequence
+
+from src.config import (SMTP_HOST, SMTP_PASS, SMTP_PORT, SMTP_SECURITY,
+                        SMTP_TIMEOUT, SMTP_USER)
+
+# A connection idle for longer is checked with NOOP before it is reused
+SMTP_CHECK_AFTER = 30
+# Servers limit the messages per connection, Gmail to about 100
+SMTP_MAX_MESSAGES = 100
+
+
+class SMTPSendError(Exception):
+    """Sending stopped half way, ``unsent`` can be retried later."""
+
+    def __init__(self, unsent: list[EmailMessage], error: Exception):
+        super().__init__(str(error))
+        self.unsent = unsent
+        self.error = error
+
+
+class SMTPPool:
+    """One SMTP connection per process, reused while it is healthy."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        security: str = "ssl",
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        timeout: float = SMTP_TIMEOUT,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        max_messages: int = SMTP_MAX_MESSAGES,
+    ):
+        if security not in ("ssl", "starttls", "none"):
+            raise ValueError(f"Unknown SMTP security {security!r}")
+        self.host = host
+        self.port = port
+        self.security = security
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.max_messages = max_messages
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server: Optional[smtplib.SMTP] = None
+        self._pid: Optional[int] = None
+        self._sent = 0
+        self._used_at = 0.0
+
+    def _connect(self) -> smtplib.SMTP:
+        context = self.ssl_context or ssl.create_default_context()
+        if self.security == "ssl":
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=context)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.security == "starttls":
+                server.starttls(context=context)
+            if self.user:
+                server.login(self.user, self.password)
+        except BaseException:
+            server.close()
+            raise
+        self.connections += 1
+        return server
+
+    def _healthy(self) -> bool:
+        if self._sent >= self.max_messages:
+            return False
+        if time.monotonic() - self._used_at < SMTP_CHECK_AFTER:
+            return True
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _drop(self) -> None:
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[smtplib.SMTP]:
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked from a process that had a connection, the socket
+                # belongs to the parent
+                self._server = None
+            if self._server is not None and not self._healthy():
+                self._drop()
+            if self._server is None:
+                self._server = self._connect()
+                self._pid = os.getpid()
+                self._sent = 0
+            try:
+                yield self._server
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                raise
+            except OSError as e:
+                # Refused messages leave the connection usable, socket errors don't
+                if not isinstance(e, smtplib.SMTPException):
+                    self._server.close()
+                    self._server = None
+                raise
+            finally:
+                self._used_at = time.monotonic()
+
+    def send(
+        self, messages: Sequence[EmailMessage]
+    ) -> list[tuple[EmailMessage, smtplib.SMTPException]]:
+        """Send the messages over as few connections as possible. Returns the
+        messages the server refused for good, raises ``SMTPSendError`` with
+        the unsent ones on other errors."""
+        refused = []
+        pending = list(messages)
+        reconnected = False
+        while pending:
+            try:
+                with self.connection() as server:
+                    while pending and self._sent < self.max_messages:
+                        try:
+                            server.send_message(pending[0])
+                        except smtplib.SMTPRecipientsRefused as e:
+                            # 4xx, e.g. greylisting: try again later
+                            if all(code < 500 for code, _ in e.recipients.values()):
+                                raise
+                            refused.append((pending[0], e))
+                        except smtplib.SMTPResponseException as e:
+                            if e.smtp_code < 500:
+                                raise
+                            refused.append((pending[0], e))
+                        self._sent += 1
+                        pending.pop(0)
+            except smtplib.SMTPServerDisconnected as e:
+                # Once, the server may have dropped the connection while idle
+                if reconnected:
+                    raise SMTPSendError(pending, e) from e
+                reconnected = True
+            except (smtplib.SMTPException, OSError) as e:
+                raise SMTPSendError(pending, e) from e
+        return refused
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                self._drop()
+            self._server = None
+
+
+smtp_pool = SMTPPool(SMTP_HOST, SMTP_PORT, SMTP_SECURITY, SMTP_USER, SMTP_PASS)
@@ -1,49 +1,114 @@
-import smtplib
+import logging
+import os
+import time
 from email.message import EmailMessage
+from html import escape
+from string import Template
 from urllib.parse import urlencode
 
 from celery import Celery
 from celery.exceptions import MaxRetriesExceededError
+from celery.signals import (task_postrun, task_prerun, worker_process_shutdown,
+                            worker_ready)
+from prometheus_client import multiprocess, start_http_server
 
-from src.config import SMTP_USER, SMTP_PASS, BASE_URL, REDIS_URI
+from src.config import SMTP_USER, BASE_URL, CELERY_METRICS_PORT, REDIS_URI
+from src.metrics import CELERY_TASK_DURATION, registry
+from src.tasks.smtp import SMTPSendError, smtp_pool
 
-SMTP_HOST = "smtp.gmail.com"
-SMTP_PORT = 465
+logger = logging.getLogger(__name__)
 
-celery = Celery('tasks', broker=REDIS_URI)
+celery = Celery('tasks', broker=REDIS_URI, include=['src.tasks.images', 'src.tasks.outbox'])
 celery.conf.broker_connection_retry_on_startup = True
 
+VERIFICATION_SUBJECT = 'Подтвердите регистрацию'
+# Rendered once, only the link differs between emails
+VERIFICATION_HTML = Template(
+    '<div>'
+    '<h1>Подтвердите вашу регистрацию</h1>'
+    '<p>Для подтверждения вашей регистрации, пожалуйста, нажмите на следующую ссылку:</p>'
+    '<a href="$verify_url">Подтвердить регистрацию</a>'
+    '<p>Если вы не запрашивали регистрацию, пожалуйста, проигнорируйте это письмо.</p>'
+    '</div>'
+)
+VERIFY_URL = f"{BASE_URL}/auth/verify?"
+
+
+# Start times of the tasks running in this process, by task id
+_task_started: dict[str, float] = {}
+
+
+@worker_process_shutdown.connect
+def close_smtp_connection(pid=None, **kwargs):
+    smtp_pool.close()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    # Served by the main process, it aggregates the pool processes' samples
+    if CELERY_METRICS_PORT:
+        start_http_server(int(CELERY_METRICS_PORT), registry=registry())
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(
+            time.perf_counter() - started
+        )
+
 
 def get_verification_email_template(email: str, token: str):
     message = EmailMessage()
-    message['Subject'] = 'Подтвердите регистрацию'
+    message['Subject'] = VERIFICATION_SUBJECT
     message['From'] = SMTP_USER
     message['To'] = email
 
-    params = urlencode({'token': token})
-    verify_url = f"{BASE_URL}/auth/verify?{params}"
-
+    verify_url = VERIFY_URL + urlencode({'token': token})
     message.set_content(
-        '<div>'
-        f'<h1>Подтвердите вашу регистрацию</h1>'
-        f'<p>Для подтверждения вашей регистрации, пожалуйста, нажмите на следующую ссылку:</p>'
-        f'<a href="{verify_url}">Подтвердить регистрацию</a>'
-        f'<p>Если вы не запрашивали регистрацию, пожалуйста, проигнорируйте это письмо.</p>'
-        '</div>',
-        subtype='html'
+        VERIFICATION_HTML.substitute(verify_url=escape(verify_url)), subtype='html'
     )
     return message
 
 
-@celery.task(bind=True, max_retries=3, default_retry_delay=20)
-def send_verification_email(self, email: str, token: str):
+def _send_verification_emails(task, recipients: list, batch: bool):
+    """Send over the worker's pooled SMTP connection. On failure only the
+    emails that haven't been sent are retried."""
+    messages = [get_verification_email_template(email, token) for email, token in recipients]
     try:
-        message = get_verification_email_template(email, token)
-        with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT) as server:
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(message)
-    except Exception as exc:
+        refused = smtp_pool.send(messages)
+    except SMTPSendError as e:
+        unsent = {id(message) for message in e.unsent}
+        recipients = [
+            recipient for recipient, message in zip(recipients, messages) if id(message) in unsent
+        ]
         try:
-            raise self.retry(exc=exc, countdown=self.default_retry_delay)
+            # 20 s, 40 s, 80 s, ...
+            countdown = task.default_retry_delay * 2 ** task.request.retries
+            raise task.retry(args=[recipients] if batch else None, exc=e.error, countdown=countdown)
         except MaxRetriesExceededError:
-            print(f"Max retries exceeded for sending verification email to {email}")
+            emails = ", ".join(email for email, _ in recipients)
+            logger.error(f"Max retries exceeded for sending verification email to {emails}")
+        return
+    for message, error in refused:
+        logger.error(f"Verification email to {message['To']} refused: {error}")
+
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=20)
+def send_verification_email(self, email: str, token: str):
+    _send_verification_emails(self, [(email, token)], batch=False)
+
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=20)
+def send_verification_emails(self, recipients: list):
+    """Several emails in one SMTP session, ``recipients`` are (email, token)
+    pairs."""
+    _send_verification_emails(self, recipients, batch=True)
@@ -0,0 +1,78 @@
+from typing import AsyncIterator
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+
+class UploadError(ValueError):
+    pass
+
+
+async def multipart_file_chunks(request: Request, field_name: str) -> AsyncIterator[bytes]:
+    """Content of the ``field_name`` part of a multipart/form-data request as
+    it arrives, unlike ``UploadFile`` which is only handed over once the whole
+    body has been received and spooled."""
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body")
+
+    field = field_name.encode()
+    headers: dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    pending: list[bytes] = []
+    in_field = found = done = False
+
+    def on_part_begin():
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        nonlocal in_field, found
+        _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+        in_field = not found and disposition.get(b"name") == field
+        found = found or in_field
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if in_field:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        nonlocal in_field, done
+        done = done or in_field
+        in_field = False
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        },
+    )
+    async for chunk in request.stream():
+        parser.write(chunk)
+        if pending:
+            yield b"".join(pending)
+            pending.clear()
+        if done:
+            return
+
+    if not found:
+        raise UploadError(f"Missing {field_name!r} file")
+    raise UploadError(f"Incomplete {field_name!r} file")
@@ -1,7 +1,7 @@
 import datetime
 from typing import List, Optional
 
-from sqlalchemy import TIMESTAMP, Boolean, String, CheckConstraint
+from sqlalchemy import TIMESTAMP, Boolean, CheckConstraint, Index, String, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.base import Base
@@ -9,14 +9,21 @@ from src.base import Base
 
 class User(Base):
     __tablename__ = "users"
+    # Unique regardless of case, and what lookups by these columns use,
+    # see src.users.service
+    __table_args__ = (
+        Index("ix_users_lower_email", text("lower(email)"), unique=True),
+        Index("ix_users_lower_username", text("lower(username)"), unique=True),
+        Index("ix_users_lower_telegram_username", text("lower(telegram_username)"), unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    email: Mapped[str] = mapped_column(String(254), nullable=False, unique=True)
-    username: Mapped[str] = mapped_column(String(32), nullable=False, unique=True)
+    email: Mapped[str] = mapped_column(String(254), nullable=False)
+    username: Mapped[str] = mapped_column(String(32), nullable=False)
     telegram_username: Mapped[Optional[str]] = mapped_column(
         String(32),
         CheckConstraint("LENGTH(telegram_username) >= 5", name="telegram_username_min_length"),
-        unique=True, nullable=True
+        nullable=True
     )
     hashed_password: Mapped[str] = mapped_column(String(255), nullable=False)
     registered_at: Mapped[datetime.datetime] = mapped_column(
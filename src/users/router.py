@@ -1,25 +1,19 @@
 import re
+from typing import Optional
 
 from fastapi import APIRouter, Depends, Query
-from fastapi_users import FastAPIUsers
 from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.auth.manager import get_user_manager
-from src.auth.service import auth_backend
+from src.auth.cache import invalidate_user
+from src.auth.dependencies import current_active_user, fastapi_users
 from src.constants import EMPTY_LIST, INVALID_TG, UNKNOWN
-from src.database import get_async_session
+from src.database import get_async_session, get_read_session
 from src.exceptions import ErrorHTTPException
+from src.pagination import Page, build_page, decode_cursor
 from src.users.models import User
 from src.users.schemas import UserRead, UserUpdate
 
-fastapi_users = FastAPIUsers[User, int](
-    get_user_manager,
-    [auth_backend],
-)
-
-current_active_user = fastapi_users.current_user(active=True)
-
 router = APIRouter()
 
 router.include_router(
@@ -28,18 +22,18 @@ router.include_router(
 )
 
 
-@router.get("/users", response_model=list[UserRead])
+@router.get("/users", response_model=Page[UserRead])
 async def get_users(
     limit: int = Query(10, ge=1, le=100),
-    offset: int = Query(0, ge=0),
-    session: AsyncSession = Depends(get_async_session),
+    cursor: Optional[str] = Query(None),
+    session: AsyncSession = Depends(get_read_session),
 ):
+    last_id = decode_cursor(cursor)
     try:
-        query = select(User)
+        query = select(User).where(User.id > last_id).order_by(User.id).limit(limit + 1)
         result = await session.execute(query)
-        users = result.scalars().all()[offset:][:limit]
-        users_list = [UserRead.from_orm(user) for user in users]
-        return users_list
+        users = result.scalars().all()
+        return Page[UserRead].model_validate(build_page(users, limit), from_attributes=True)
     except Exception as e:
         return ErrorHTTPException(status_code=400, error_code=EMPTY_LIST, detail=str(e))
 
@@ -62,6 +56,7 @@ async def link_tg(
         )
         await session.execute(stmt)
         await session.commit()
+        await invalidate_user(user.id)
         return {"status_code": "success", "detail": "Telegram username updated"}
     except Exception as e:
         return ErrorHTTPException(status_code=400, error_code=UNKNOWN, detail=str(e))
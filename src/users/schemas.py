@@ -1,7 +1,12 @@
-from typing import Optional
+from typing import Annotated, Optional
 
 from fastapi_users import schemas
-from pydantic import EmailStr
+from pydantic import EmailStr, Field
+
+# The limits of the users table, see src.users.models
+Username = Annotated[str, Field(min_length=1, max_length=32)]
+# As Telegram allows them
+TelegramUsername = Annotated[str, Field(pattern=r"^[A-Za-z0-9_]{5,32}$")]
 
 
 class UserRead(schemas.BaseUser[int]):
@@ -17,8 +22,8 @@ class UserRead(schemas.BaseUser[int]):
 class UserCreate(schemas.BaseUserCreate):
     email: EmailStr
     password: str
-    username: str
-    telegram_username: Optional[str] = None
+    username: Username
+    telegram_username: Optional[TelegramUsername] = None
     is_active: bool = False
     is_superuser: bool = False
     is_verified: bool = False
@@ -27,8 +32,8 @@ class UserCreate(schemas.BaseUserCreate):
 class UserUpdate(schemas.BaseUserUpdate):
     email: EmailStr
     password: str
-    username: str
-    telegram_username: Optional[str] = None
+    username: Username
+    telegram_username: Optional[TelegramUsername] = None
     is_active: bool = False
     is_superuser: bool = False
     is_verified: bool = False
@@ -0,0 +1,36 @@
+from typing import Optional
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.users.models import User
+
+
+def lower_equals(column, value: str):
+    # Matches the lower() indexes of User
+    return func.lower(column) == func.lower(value)
+
+
+async def get_by_telegram_username(
+    session: AsyncSession, telegram_username: str
+) -> Optional[User]:
+    query = select(User).where(lower_equals(User.telegram_username, telegram_username))
+    return await session.scalar(query)
+
+
+async def find_taken_fields(
+    session: AsyncSession, email: str, username: str, telegram_username: Optional[str] = None
+) -> set[str]:
+    """Which of the values other users already have, ignoring case. One
+    query, each condition is answered by its index."""
+    values = {"email": email, "username": username, "telegram_username": telegram_username}
+    conditions = {
+        field: lower_equals(getattr(User, field), value)
+        for field, value in values.items()
+        if value is not None
+    }
+    query = select(
+        *(condition.label(field) for field, condition in conditions.items())
+    ).where(or_(*conditions.values()))
+    rows = (await session.execute(query)).all()
+    return {field for row in rows for field in conditions if getattr(row, field)}
@@ -2,7 +2,6 @@ from typing import AsyncGenerator
 
 import pytest
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
 from httpx import AsyncClient
 from redis import asyncio as aioredis
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
@@ -10,6 +9,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
 from src.base import metadata
+from src.cache import TwoTierBackend
 from src.config import (DB_HOST_TEST, DB_NAME_TEST, DB_PASS_TEST, DB_PORT_TEST,
                         DB_USER_TEST, REDIS_HOST, REDIS_PORT)
 from src.database import get_async_session
@@ -61,6 +61,8 @@ async def ac() -> AsyncGenerator[AsyncClient, None]:
 @pytest.fixture(scope="session", autouse=True)
 async def init_cache():
     redis = aioredis.from_url(
-        f"redis://{REDIS_HOST}:{REDIS_PORT}", encoding="utf8", decode_responses=True
+        f"redis://{REDIS_HOST}:{REDIS_PORT}", encoding="utf8"
+    )
+    FastAPICache.init(
+        TwoTierBackend(redis, max_bytes=1024 * 1024, ttl=30), prefix="fastapi-cache"
     )
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
@@ -1,5 +1,31 @@
+import asyncio
+import time
+
+import jwt
 import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.password import PasswordHelper
 from httpx import AsyncClient
+from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+from sqlalchemy import Engine, event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.auth import service
+from src.auth.cache import UserCache
+from src.auth.manager import UserManager
+from src.auth.passwords import PasswordHasher, password_hasher
+from src.auth.service import create_jwt_strategy, get_jwt_strategy
+from src.benches.models import Bench, BenchCluster
+from src.benches.service import update_clusters
+from src.cache import BENCHES_TAG, get_generation
+from src.constants import NON_UNIQ_FIELD, VALIDATION_ERROR
+from src.exceptions import ErrorHTTPException
+from src.main import app, lifespan
+from src.users.models import User
+from src.users.schemas import UserCreate
 
 
 @pytest.mark.asyncio(loop_scope="session")
@@ -42,3 +68,302 @@ async def test_tg_login(ac: AsyncClient):
         headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
     assert response.status_code == 200
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_token_cache():
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        await client.post(
+            "/auth/register",
+            json={
+                "email": "cached@te.st",
+                "password": "test0123",
+                "is_active": True,
+                "username": "cached",
+            },
+        )
+        response = await client.post(
+            "/auth/jwt/login", data={"username": "cached@te.st", "password": "test0123"}
+        )
+        client.cookies["token"] = response.json()["token"]
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            assert (await client.get("/users/me")).status_code == 200
+            assert any("FROM users" in statement for statement in statements)
+            statements.clear()
+            response = await client.get("/users/me")
+            assert response.status_code == 200
+            assert statements == []
+
+            # Changes are visible at once
+            await client.post("/link_tg", params={"tg_username": "cached_tg"})
+            response = await client.get("/users/me")
+            assert response.json()["telegram_username"] == "cached_tg"
+
+            # Updates the cached user, which isn't attached to any session
+            response = await client.patch(
+                "/users/me",
+                json={"email": "cached@te.st", "password": "test0123", "username": "renamed"},
+            )
+            assert response.status_code == 200
+            assert (await client.get("/users/me")).json()["username"] == "renamed"
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+
+
+def test_user_cache_skips_stale_loads():
+    cache = UserCache(max_size=2, ttl=30)
+    user = User(id=1, email="a@te.st", username="a", hashed_password="x", is_active=True)
+
+    version = cache.version
+    cache.invalidate(1)
+    cache.set(b"stale", user, None, version)
+    assert cache.get(b"stale") is None
+
+    cache.set(b"expired", user, time.time() - 1, cache.version)
+    assert cache.get(b"expired") is None
+
+    for key in (b"a", b"b", b"c"):
+        cache.set(key, user, None, cache.version)
+    assert len(cache) == 2
+    assert cache.get(b"a") is None
+    assert cache.get(b"c").email == "a@te.st"
+
+
+def test_jwt_strategy_is_shared():
+    assert get_jwt_strategy() is get_jwt_strategy()
+
+
+def _short_coordinate_key() -> ec.EllipticCurvePrivateKey:
+    # About one key in 128 has a coordinate under 32 bytes
+    while True:
+        key = ec.generate_private_key(ec.SECP256R1())
+        numbers = key.public_key().public_numbers()
+        if min(numbers.x, numbers.y) < 1 << 248:
+            return key
+
+
+@pytest.mark.parametrize(
+    "algorithm, private_key",
+    [
+        ("ES256", ec.generate_private_key(ec.SECP256R1())),
+        ("ES256", _short_coordinate_key()),
+        ("EdDSA", ed25519.Ed25519PrivateKey.generate()),
+    ],
+)
+async def test_asymmetric_jwt_strategy(tmp_path, algorithm, private_key):
+    path = tmp_path / "jwt.pem"
+    path.write_bytes(
+        private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    strategy = create_jwt_strategy(algorithm, str(path))
+    token = await strategy.write_token(User(id=7))
+
+    # Verified with nothing but the published key
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        app.dependency_overrides[get_jwt_strategy] = lambda: strategy
+        try:
+            response = await client.get("/auth/jwt/jwks")
+        finally:
+            del app.dependency_overrides[get_jwt_strategy]
+    data = jwt.decode(
+        token,
+        jwt.PyJWK(response.json()["keys"][0]).key,
+        algorithms=[algorithm],
+        audience="fastapi-users:auth",
+    )
+    assert data["sub"] == "7"
+
+    with pytest.raises(ValueError):
+        create_jwt_strategy("EdDSA" if algorithm == "ES256" else "ES256", str(path))
+
+
+async def test_jwks_needs_asymmetric_signing():
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/auth/jwt/jwks")
+    assert response.status_code == 404
+
+
+async def test_password_hasher_limits_pending():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    first = asyncio.create_task(hasher.hash("password"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(ErrorHTTPException) as error:
+        await hasher.hash("password")
+    assert error.value.status_code == 503
+
+    assert (await hasher.verify_and_update("password", await first)) == (True, None)
+    assert hasher.pending == 0
+
+
+async def test_login_rehashes_password(async_session: AsyncSession):
+    weak = PasswordHelper(PasswordHash((Argon2Hasher(time_cost=1, memory_cost=8 * 1024),)))
+    old_hash = weak.hash("test0123")
+    async_session.add(
+        User(email="rehash@te.st", username="rehash", hashed_password=old_hash, is_active=True)
+    )
+    await async_session.commit()
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.post(
+            "/auth/jwt/login", data={"username": "rehash@te.st", "password": "test0123"}
+        )
+    assert response.status_code == 200
+
+    async_session.expire_all()
+    user = await async_session.scalar(select(User).where(User.email == "rehash@te.st"))
+    assert user.hashed_password != old_hash
+    assert ",t=3," in user.hashed_password
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_register_checks_uniqueness_ignoring_case():
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    user = {
+        "email": "Unique@te.st",
+        "password": "test0123",
+        "username": "Unique",
+        "telegram_username": "Unique_tg",
+    }
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            response = await client.post("/auth/register", json=user)
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        assert response.status_code == 201
+        # The uniqueness check, then the insert
+        assert [statement.split()[0] for statement in statements] == ["SELECT", "INSERT"]
+
+        response = await client.post("/auth/register", json={**user, "email": "UNIQUE@te.st"})
+        assert response.json()["detail"] == "REGISTER_USER_ALREADY_EXISTS"
+
+        for field in ("username", "telegram_username"):
+            response = await client.post(
+                "/auth/register",
+                json={**user, "email": f"{field}@te.st", field: user[field].upper()},
+            )
+            assert response.status_code == 400
+            assert response.json()["error"]["code"] == NON_UNIQ_FIELD
+
+        response = await client.post("/auth/tg/login", params={"telegram_username": "unique_TG"})
+        assert response.status_code == 200
+
+
+class LoopPasswordHelper(PasswordHelper):
+    def hash(self, password: str) -> str:
+        raise AssertionError("Hashed on the event loop")
+
+    def verify_and_update(self, plain_password: str, hashed_password: str):
+        raise AssertionError("Verified on the event loop")
+
+
+async def test_reset_password_hashes_off_the_loop(async_session: AsyncSession):
+    user = User(
+        email="reset@te.st",
+        username="reset",
+        hashed_password=await password_hasher.hash("test0123"),
+        is_active=True,
+    )
+    async_session.add(user)
+    await async_session.commit()
+
+    tokens = []
+
+    class Manager(UserManager):
+        async def on_after_forgot_password(self, user, token, request=None):
+            tokens.append(token)
+
+    manager = Manager(SQLAlchemyUserDatabase(async_session, User), LoopPasswordHelper())
+    await manager.forgot_password(user)
+    updated = await manager.reset_password(tokens[0], "test4567")
+
+    assert (await password_hasher.verify_and_update("test4567", updated.hashed_password))[0]
+
+
+async def test_bad_jwt_key_fails_startup(monkeypatch, tmp_path):
+    private_key = tmp_path / "jwt.pem"
+    private_key.write_bytes(
+        ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    # Not an ES256 key
+    monkeypatch.setattr(
+        service, "create_jwt_strategy", lambda: create_jwt_strategy("ES256", str(private_key))
+    )
+    get_jwt_strategy.cache_clear()
+    try:
+        with pytest.raises(ValueError):
+            async with lifespan(app):
+                pass
+    finally:
+        get_jwt_strategy.cache_clear()
+
+
+async def test_register_rejects_short_telegram_username():
+    user = {
+        "email": "short_tg@te.st",
+        "password": "test0123",
+        "username": "short_tg",
+        "telegram_username": "abcd",
+    }
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.post("/auth/register", json=user)
+    assert response.status_code == 422
+
+
+async def test_create_reports_constraint_violations(async_session: AsyncSession):
+    # Past the schema, the table's check constraint rejects it
+    user_create = UserCreate.model_construct(
+        email="short_tg@te.st",
+        password="test0123",
+        username="short_tg",
+        telegram_username="abcd",
+        is_active=False,
+        is_superuser=False,
+        is_verified=False,
+    )
+    manager = UserManager(SQLAlchemyUserDatabase(async_session, User), password_hasher.helper)
+
+    with pytest.raises(ErrorHTTPException) as error:
+        await manager.create(user_create)
+    assert error.value.status_code == 400
+    assert error.value.error_code == VALIDATION_ERROR
+
+
+async def test_delete_user_takes_benches_off_clusters(async_session: AsyncSession):
+    user = User(email="leaving@te.st", username="leaving", hashed_password="-", is_active=True)
+    async_session.add(user)
+    await async_session.flush()
+    points = [(40.0, 40.0), (41.0, 41.0)]
+    async_session.add_all(
+        Bench(name=f"Leaving {i}", latitude=latitude, longitude=longitude, creator_id=user.id)
+        for i, (latitude, longitude) in enumerate(points)
+    )
+    await update_clusters(async_session, points)
+    await async_session.commit()
+    generation = await get_generation(BENCHES_TAG)
+
+    manager = UserManager(SQLAlchemyUserDatabase(async_session, User), password_hasher.helper)
+    await manager.delete(user)
+
+    assert await async_session.scalar(select(func.count()).select_from(BenchCluster)) == 0
+    assert await get_generation(BENCHES_TAG) > generation
@@ -1,11 +1,28 @@
 import io
+import json
 
 import pytest
+from fastapi_cache import FastAPICache
 from httpx import AsyncClient
 from PIL import Image
+from redis import asyncio as aioredis
+from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.benches.models import Bench
+from src.benches.cache import (bench_cache_key, bench_tag, get_cached_bench,
+                               invalidate_benches)
+from src.benches.exporter import export_epoch_key
+from src.benches.geo import CLUSTER_MIN_ZOOM, tile_xy
+from src.benches.importer import BenchImportError, import_benches
+from src.benches.models import Bench, BenchCluster
+from src.benches.photos import PHOTO_MAX_SIZE
+from src.benches.service import update_clusters
+from src.benches.tiles import invalidate_tiles, tile_cache_key
+from src.cache import (BENCHES_TAG, TILES_TAG, TwoTierBackend,
+                       generation_key, get_generation)
+from src.config import REDIS_HOST, REDIS_PORT
+from src.main import app
+from src.storage import MemoryStorage, get_storage
 from src.users.models import User
 
 
@@ -79,8 +96,24 @@ async def test_get_benches(authorized_client: AsyncClient, test_benches):
     response = await authorized_client.get("/benches")
     assert response.status_code == 200
     data = response.json()
-    assert len(data) == 5
-    assert data[0]["name"] == "Bench 1"
+    assert len(data["items"]) == 5
+    assert data["items"][0]["name"] == "Bench 1"
+    assert data["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_benches_cursor(authorized_client: AsyncClient, test_benches):
+    response = await authorized_client.get("/benches", params={"limit": 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert [bench["name"] for bench in data["items"]] == ["Bench 1", "Bench 2"]
+
+    response = await authorized_client.get(
+        "/benches", params={"limit": 2, "cursor": data["next_cursor"]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [bench["name"] for bench in data["items"]] == ["Bench 3", "Bench 4"]
 
 
 @pytest.mark.asyncio
@@ -124,22 +157,396 @@ async def test_create_and_delete_bench(authorized_client: AsyncClient):
 
 
 @pytest.mark.asyncio
-async def test_upload_bench_photo(authorized_client: AsyncClient):
+async def test_create_benches(authorized_client: AsyncClient):
+    benches = [
+        {
+            "name": f"Batch Bench {i}",
+            "description": None,
+            "count": 1,
+            "latitude": 40.0 + i,
+            "longitude": 40.0,
+        }
+        for i in range(3)
+    ]
+    response = await authorized_client.post("/create_benches", json=benches)
+    assert response.status_code == 200
+    data = response.json()
+    assert [bench["name"] for bench in data] == [bench["name"] for bench in benches]
+    assert data[0]["id"] < data[1]["id"] < data[2]["id"]
+
+    for bench in benches:
+        response_delete = await authorized_client.delete(
+            "/delete_bench", params={"bench_name": bench["name"]}
+        )
+        assert response_delete.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_photo_upload_url(authorized_client: AsyncClient):
+    bench_data = {
+        "name": "Photo Bench",
+        "description": None,
+        "count": 1,
+        "latitude": 45.0,
+        "longitude": 45.0,
+    }
+    response = await authorized_client.post("/create_bench", json=bench_data)
+    bench_id = response.json()["id"]
+
+    response = await authorized_client.post(
+        f"/benches/{bench_id}/photo/upload_url", json={"content_type": "image/webp"}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["method"] == "PUT"
+    assert data["object_name"].startswith(f"benches/{bench_id}/")
+    assert data["object_name"].endswith(".webp")
+    assert data["headers"]["Content-Type"] == "image/webp"
+    assert "X-Goog-Signature=" in data["upload_url"]
+
+    response = await authorized_client.post(
+        f"/benches/{bench_id}/photo/complete",
+        json={"object_name": f"benches/{bench_id + 1}/photo.webp"},
+    )
+    assert response.status_code == 400
+
+    response = await authorized_client.post(
+        f"/benches/{bench_id + 1}/photo/upload_url", json={"content_type": "image/webp"}
+    )
+    assert response.status_code == 400
+
+    await authorized_client.delete("/delete_bench", params={"bench_name": "Photo Bench"})
+
+
+@pytest.fixture(scope="function")
+def memory_storage():
+    storage = MemoryStorage()
+    app.dependency_overrides[get_storage] = lambda: storage
+    yield storage
+    del app.dependency_overrides[get_storage]
+
+
+@pytest.fixture(scope="function")
+async def own_bench(authorized_client: AsyncClient):
+    bench_data = {
+        "name": "Own Bench",
+        "description": None,
+        "count": 1,
+        "latitude": 35.0,
+        "longitude": 35.0,
+    }
+    response = await authorized_client.post("/create_bench", json=bench_data)
+    yield response.json()["id"]
+    await authorized_client.delete("/delete_bench", params={"bench_name": "Own Bench"})
+
+
+def _png() -> bytes:
     image = Image.new("RGB", (100, 100), color="red")
     img = io.BytesIO()
     image.save(img, format="PNG")
-    img.seek(0)
+    return img.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_upload_bench_photo(
+    authorized_client: AsyncClient, own_bench: int, memory_storage: MemoryStorage
+):
+    for _ in range(2):
+        response = await authorized_client.post(
+            f"/upload_bench_photo/{own_bench}",
+            files={"file": ("test_image.png", _png(), "image/png")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["filename"].startswith("photos/")
+        assert data["filename"].endswith(".png")
+
+    # The same photo is stored once, and no unfinished upload is left over
+    assert list(memory_storage.objects) == [data["filename"]]
+    assert memory_storage.objects[data["filename"]] == (_png(), "image/png")
+    # Only the processed copy of the upload is published
+    assert not memory_storage.public
+
+    response_photo = await authorized_client.get(f"/benches/{own_bench}")
+    assert response_photo.json()["photo_url"] is None
+
 
+@pytest.mark.asyncio
+async def test_upload_bench_photo_rejected(
+    authorized_client: AsyncClient, own_bench: int, memory_storage: MemoryStorage
+):
     response = await authorized_client.post(
-        "/upload_bench_photo/1", files={"file": ("test_image.png", img, "image/png")}
+        f"/upload_bench_photo/{own_bench}",
+        files={"file": ("test.txt", b"definitely not an image", "image/png")},
+    )
+    assert response.status_code == 400
+
+    too_large = _png() + bytes(PHOTO_MAX_SIZE)
+    response = await authorized_client.post(
+        f"/upload_bench_photo/{own_bench}",
+        files={"file": ("test_image.png", too_large, "image/png")},
+    )
+    assert response.status_code == 413
+    assert memory_storage.objects == {}
+
+
+@pytest.mark.asyncio
+async def test_upload_bench_photo_invalid_content_length(
+    authorized_client: AsyncClient, own_bench: int
+):
+    response = await authorized_client.post(
+        f"/upload_bench_photo/{own_bench}",
+        content=b"",
+        headers={"Content-Type": "multipart/form-data; boundary=x", "Content-Length": "ten"},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_benches_in_bbox(ac: AsyncClient, test_benches):
+    response = await ac.get(
+        "/benches/in_bbox",
+        params={
+            "min_latitude": 15,
+            "min_longitude": 15,
+            "max_latitude": 35,
+            "max_longitude": 35,
+        },
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [bench["name"] for bench in data] == ["Bench 2", "Bench 3"]
+
+
+@pytest.fixture(scope="function")
+async def test_clusters(async_session: AsyncSession, test_benches):
+    await update_clusters(async_session, [(i * 10, i * 10) for i in range(1, 6)])
+    await async_session.commit()
+
+    yield
+
+    await async_session.execute(BenchCluster.__table__.delete())
+    await async_session.commit()
+
+
+@pytest.mark.asyncio
+async def test_get_bench_clusters(ac: AsyncClient, test_clusters):
+    response = await ac.get(
+        "/benches/clusters",
+        params={
+            "min_latitude": -85,
+            "min_longitude": -180,
+            "max_latitude": 85,
+            "max_longitude": 180,
+            "zoom": 0,
+        },
     )
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["count"] == 5
+    assert data[0]["latitude"] == pytest.approx(30)
+    assert data[0]["longitude"] == pytest.approx(30)
+
+
+@pytest.mark.asyncio
+async def test_low_zoom_clusters_are_summed_on_read(
+    ac: AsyncClient, async_session: AsyncSession, test_clusters
+):
+    zooms = await async_session.scalars(select(BenchCluster.zoom).distinct())
+    assert min(zooms) == CLUSTER_MIN_ZOOM
 
+    response = await ac.get("/tiles/0/0/0.mvt")
+    assert response.status_code == 200
+    assert b"clusters" in response.content
+
+
+@pytest.mark.asyncio
+async def test_get_bench_tile(ac: AsyncClient, test_benches):
+    x, y = tile_xy(10, 10, 14)
+    response = await ac.get(f"/tiles/14/{x}/{y}.mvt")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.mapbox-vector-tile"
+    assert b"Bench 1" in response.content
+
+    response_cached = await ac.get(
+        f"/tiles/14/{x}/{y}.mvt", headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response_cached.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_invalidate_tiles(monkeypatch):
+    redis = aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}")
+    backend = TwoTierBackend(redis, max_bytes=1024, ttl=30)
+    monkeypatch.setattr(FastAPICache, "_backend", backend)
+    x, y = tile_xy(10, 10, 14)
+    key = tile_cache_key(14, x, y, await get_generation(TILES_TAG))
+    await backend.set(key, b"tile", 60)
+
+    await invalidate_tiles([(10, 10)])
+    assert await redis.get(key) is None
+    assert await backend.get(key) is None
+    await invalidate_tiles([])
+    await redis.close()
+
+
+@pytest.mark.asyncio
+async def test_export_benches(ac: AsyncClient, test_benches):
+    response = await ac.get("/benches/export", params={"format": "ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [bench["name"] for bench in lines] == [f"Bench {i}" for i in range(1, 6)]
+
+    response = await ac.get("/benches/export")
     assert response.status_code == 200
     data = response.json()
+    assert data["type"] == "FeatureCollection"
+    assert data["features"][0]["geometry"]["coordinates"] == [10, 10]
+    assert data["features"][0]["properties"]["name"] == "Bench 1"
+
+    response_cached = await ac.get(
+        "/benches/export", headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response_cached.status_code == 304
+
+    # Redis lost the generation, which then counts up from zero again
+    backend = FastAPICache.get_backend()
+    await backend.redis.delete(generation_key(BENCHES_TAG), export_epoch_key())
+    await backend.evict(generation_key(BENCHES_TAG))
+    response_lost = await ac.get(
+        "/benches/export", headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response_lost.status_code == 200
+
+
+@pytest.fixture(scope="function")
+async def bench_creator(async_session: AsyncSession):
+    user = User(
+        email="importer@example.com",
+        username="importer",
+        telegram_username="tgimporter",
+        hashed_password="hashed_password",
+    )
+    async_session.add(user)
+    await async_session.commit()
+
+    yield user.id
+
+    await async_session.execute(Bench.__table__.delete())
+    await async_session.execute(BenchCluster.__table__.delete())
+    await async_session.execute(User.__table__.delete())
+    await async_session.commit()
+
+
+async def _chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@pytest.mark.asyncio
+async def test_import_benches_csv(async_session: AsyncSession, bench_creator: int):
+    data = (
+        "name,description,latitude,longitude,count\n"
+        'Imported 1,"Two\nlines",55.75,37.61,2\n'
+        "Imported 2,,55.76,37.62,\n"
+        "Broken,,north,37.62,1\n"
+    ).encode()
+
+    report = await import_benches(async_session, _chunks(data, 7), "csv", bench_creator)
+    assert report["processed"] == 3
+    assert report["imported"] == 2
+    assert report["failed"] == 1
+    assert report["errors"][0]["line"] == 5
+    assert report["errors"][0]["detail"].startswith("latitude")
+
+    result = await async_session.execute(
+        select(Bench.description, Bench.count).order_by(Bench.name)
+    )
+    assert result.all() == [("Two\nlines", 2), (None, 1)]
+
+    total = await async_session.scalar(
+        select(func.sum(BenchCluster.count)).where(BenchCluster.zoom == CLUSTER_MIN_ZOOM)
+    )
+    assert total == 2
+
+
+@pytest.mark.asyncio
+async def test_import_benches_geojson(async_session: AsyncSession, bench_creator: int):
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"name": f"OSM {i}", "amenity": "bench"},
+            "geometry": {"type": "Point", "coordinates": [37.6, 55.7 + i / 100]},
+        }
+        for i in range(3)
+    ]
+    features.append({"type": "Feature", "properties": {}, "geometry": None})
+    data = json.dumps({"type": "FeatureCollection", "features": features}).encode()
+
+    report = await import_benches(
+        async_session, _chunks(data, 16), "geojson", bench_creator, batch_size=2
+    )
+    assert report["imported"] == 3
+    assert report["errors"] == [
+        {"line": 4, "detail": "Only Point geometries are supported"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_import_benches_reports_rejected_rows(
+    async_session: AsyncSession, bench_creator: int
+):
+    records = [
+        {"name": "Good 1", "latitude": 1, "longitude": 1},
+        {"name": "Huge", "latitude": 1, "longitude": 1, "count": 2**31},
+        # Valid, but text columns cannot hold NUL characters
+        {"name": "Nul\u0000", "latitude": 1, "longitude": 1},
+        {"name": "Good 2", "latitude": 1, "longitude": 1},
+    ]
+    data = "".join(json.dumps(record) + "\n" for record in records).encode()
+
+    report = await import_benches(async_session, _chunks(data, 32), "ndjson", bench_creator)
+    assert report["imported"] == 2
+    assert report["failed"] == 2
+    assert [error["line"] for error in report["errors"]] == [2, 3]
+    assert report["errors"][0]["detail"].startswith("count")
+
+    names = await async_session.scalars(select(Bench.name).order_by(Bench.name))
+    assert names.all() == ["Good 1", "Good 2"]
+    total = await async_session.scalar(
+        select(func.sum(BenchCluster.count)).where(BenchCluster.zoom == CLUSTER_MIN_ZOOM)
+    )
+    assert total == 2
+
+
+@pytest.mark.asyncio
+async def test_import_benches_unknown_creator(async_session: AsyncSession, bench_creator: int):
+    data = b"name,latitude,longitude\nFirst,55.75,37.61\n\nSecond,55.76,37.62\nThird,1,1\n"
+
+    with pytest.raises(BenchImportError, match="^Lines 2-4: "):
+        await import_benches(
+            async_session, _chunks(data, 7), "csv", bench_creator + 1, batch_size=2
+        )
+    # Rolled back, the session can still be used
+    assert await async_session.scalar(select(func.count()).select_from(Bench)) == 0
+
+
+@pytest.mark.asyncio
+async def test_import_benches_requires_superuser(authorized_client: AsyncClient):
+    response = await authorized_client.post(
+        "/benches/import", params={"format": "csv"}, content=b"name\n"
+    )
+    assert response.status_code == 403
+
 
-    assert data["filename"].startswith(f"bench1")
-    assert data["file_location"].endswith(".png")
+async def test_cached_bench_ignores_stale_fill(async_session: AsyncSession, test_benches):
+    # A miss that read the row before a write commits, and caches it after
+    # the write's invalidation
+    generation = await get_generation(bench_tag(1))
+    await FastAPICache.get_backend().set(bench_cache_key(1, generation), b"stale", 60)
+    await invalidate_benches([1])
 
-    response_photo = await authorized_client.get("/benches/1")
-    photo_url = response_photo["photo_url"]
-    assert photo_url is not None
+    bench = json.loads(await get_cached_bench(async_session, 1))
+    assert bench["name"] == "Bench 1"
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from redis import asyncio as aioredis
+
+from src.cache import LRUCache, SingleFlight, TwoTierBackend
+from src.config import REDIS_HOST, REDIS_PORT
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(max_bytes=15, ttl=60)
+    lru.set("a", b"12345")
+    lru.set("b", b"12345")
+    assert lru.get("a") == b"12345"
+
+    lru.set("c", b"12345")
+    assert lru.get("b") is None
+    assert lru.get("a") == b"12345"
+    assert lru.size <= 15
+
+
+def test_lru_cache_expires_entries():
+    lru = LRUCache(max_bytes=100, ttl=60)
+    lru.set("a", b"value", ttl=0)
+    assert lru.get("a") is None
+    assert len(lru) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_calls():
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    flight = SingleFlight()
+    results = await asyncio.gather(*(flight.do("key", loader) for _ in range(10)))
+    assert results == [1] * 10
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_two_tier_backend_serves_local_copy():
+    redis = aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}")
+    backend = TwoTierBackend(redis, max_bytes=1024, ttl=30)
+
+    await backend.set("test:two-tier", b"value", 60)
+    await redis.delete("test:two-tier")
+    assert await backend.get("test:two-tier") == b"value"
+
+    await backend.clear(key="test:two-tier")
+    assert await backend.get("test:two-tier") is None
+    await redis.close()
@@ -0,0 +1,102 @@
+import pytest
+from fastapi import Depends, FastAPI
+from httpx import AsyncClient
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import (DB_HOST_TEST, DB_NAME_TEST, DB_PASS_TEST, DB_PORT_TEST,
+                        DB_USER_TEST)
+from src.database import (PRIMARY_COOKIE, ReadYourWritesMiddleware, ReplicaSet,
+                          connect_args, create_engine, get_read_session,
+                          pool_status)
+from src.main import app
+
+DATABASE_URL_TEST = f"postgresql+asyncpg://{DB_USER_TEST}:{DB_PASS_TEST}@{DB_HOST_TEST}:{DB_PORT_TEST}/{DB_NAME_TEST}"
+
+
+async def test_pool_status_records_waits():
+    engine = create_engine(DATABASE_URL_TEST, pool_size=1, max_overflow=0, pool_timeout=0.1)
+    try:
+        async with engine.connect():
+            assert pool_status(engine)["checked_out"] == 1
+            with pytest.raises(PoolTimeoutError):
+                await engine.connect()
+        await engine.dispose()
+
+        status = pool_status(engine)
+        assert status["checked_out"] == 0
+        assert status["checkouts"] == 2
+        assert status["timeouts"] == 1
+        assert status["max_wait_seconds"] >= 0.1
+    finally:
+        await engine.dispose()
+
+
+async def test_pgbouncer_mode():
+    engine = create_engine(DATABASE_URL_TEST, connect_args=connect_args(pgbouncer=True))
+    try:
+        async with engine.connect() as connection:
+            for value in (1, 2):
+                query = text("SELECT :value").bindparams(value=value)
+                assert await connection.scalar(query) == value
+            # Statements are not kept prepared on the server connection
+            prepared = text("SELECT statement FROM pg_prepared_statements")
+            assert (await connection.scalars(prepared)).all() == [prepared.text]
+    finally:
+        await engine.dispose()
+
+
+async def test_db_pool_status_requires_superuser():
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/status/db_pool")
+    assert response.status_code == 401
+
+
+async def test_replica_set_skips_unhealthy_replicas():
+    good = [create_engine(DATABASE_URL_TEST), create_engine(DATABASE_URL_TEST)]
+    down = create_engine(DATABASE_URL_TEST.replace(f":{DB_PORT_TEST}/", ":1/"))
+    replica_set = ReplicaSet([good[0], down, good[1]])
+    try:
+        assert replica_set.pick() is None
+        await replica_set.check()
+        assert [replica_set.pick() for _ in range(4)] == good * 2
+    finally:
+        for engine in replica_set.engines:
+            await engine.dispose()
+
+
+async def test_read_session_reads_own_writes(monkeypatch):
+    replica = create_engine(DATABASE_URL_TEST)
+    replica_set = ReplicaSet([replica])
+    replica_set.healthy = [replica]
+    monkeypatch.setattr("src.database.replicas", replica_set)
+
+    reads = FastAPI()
+    reads.add_middleware(ReadYourWritesMiddleware, window=60)
+
+    @reads.get("/read")
+    async def read(session: AsyncSession = Depends(get_read_session)):
+        return {"replica": session.bind is replica}
+
+    @reads.post("/write")
+    async def write():
+        return {}
+
+    try:
+        async with AsyncClient(app=reads, base_url="http://test") as client:
+            assert (await client.get("/read")).json() == {"replica": True}
+            response = await client.post("/write")
+            assert PRIMARY_COOKIE in response.cookies
+            assert (await client.get("/read")).json() == {"replica": False}
+    finally:
+        await replica.dispose()
+
+
+def test_cached_routes_read_from_primary():
+    # Their cache would keep what a lagging replica returned
+    cached = {"/benches", "/benches/{bench_id}", "/nearest_bench/", "/tiles/{z}/{x}/{y}.mvt"}
+    routes = [route for route in app.routes if getattr(route, "path", None) in cached]
+    assert len(routes) == len(cached)
+    for route in routes:
+        assert get_read_session not in {d.call for d in route.dependant.dependencies}
@@ -0,0 +1,99 @@
+import io
+
+import pytest
+from PIL import Image
+
+from src.benches.photos import store_photo
+from src.storage import MemoryStorage
+from src.tasks.images import (make_full, make_variants, store_full, store_variants,
+                              variant_name)
+
+ORIENTATION = 0x0112
+GPS_INFO = 0x8825
+
+
+def _jpeg(size=(3000, 2000)) -> bytes:
+    exif = Image.Exif()
+    # Rotated 90 degrees clockwise on display
+    exif[ORIENTATION] = 6
+    exif[GPS_INFO] = {1: "N", 2: (55.0, 45.0, 0.0)}
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "green").save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_make_variants_resizes_and_strips_exif():
+    variants = make_variants(_jpeg())
+
+    assert {(v.variant, v.width, v.height) for v in variants} == {
+        ("thumb", 213, 320),
+        ("medium", 853, 1280),
+    }
+    assert "image/webp" in {v.content_type for v in variants}
+    for variant in variants:
+        with Image.open(io.BytesIO(variant.data)) as image:
+            assert image.size == (variant.width, variant.height)
+            assert not image.getexif()
+
+
+def test_make_variants_never_upscales():
+    variants = make_variants(_jpeg(size=(200, 100)))
+
+    # Both variants would be the original size, it is kept once
+    assert {(v.variant, v.width, v.height) for v in variants} == {("thumb", 100, 200)}
+
+
+def test_make_full_strips_exif():
+    full = make_full(_jpeg())
+
+    assert (full.content_type, full.width, full.height) == ("image/jpeg", 2000, 3000)
+    with Image.open(io.BytesIO(full.data)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (2000, 3000)
+        assert not image.getexif()
+
+
+@pytest.mark.asyncio
+async def test_store_full():
+    storage = MemoryStorage()
+
+    url = await store_full(storage, "photos/abc.jpg", _jpeg())
+
+    # The upload stays private
+    assert storage.public == {"photos/abc.full.jpg"}
+    assert url == f"{storage.base_url}photos/abc.full.jpg"
+    assert storage.objects["photos/abc.full.jpg"][1] == "image/jpeg"
+
+
+@pytest.mark.asyncio
+async def test_store_full_of_mpo():
+    # Several pictures in one JPEG, as phone cameras save them
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 200), "green").save(
+        buffer, format="MPO", save_all=True, append_images=[Image.new("RGB", (300, 200))]
+    )
+    storage = MemoryStorage()
+
+    async def chunks():
+        yield buffer.getvalue()
+
+    name, content_type = await store_photo(storage, chunks())
+    url = await store_full(storage, name, await storage.read(name))
+
+    assert content_type == "image/jpeg"
+    data, content_type = storage.objects[url.removeprefix(storage.base_url)]
+    assert content_type == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as image:
+        assert (image.format, image.size) == ("JPEG", (300, 200))
+
+
+@pytest.mark.asyncio
+async def test_store_variants():
+    storage = MemoryStorage()
+
+    records = await store_variants(storage, "photos/abc.jpg", _jpeg())
+
+    names = {variant_name("photos/abc.jpg", "thumb", "webp"), "photos/abc.medium.webp"}
+    assert names <= storage.public
+    assert {r["url"] for r in records} == {f"{storage.base_url}{name}" for name in storage.public}
+    assert storage.objects["photos/abc.thumb.webp"][1] == "image/webp"
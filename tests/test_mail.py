@@ -0,0 +1,64 @@
+import socket
+
+import pytest
+
+from benchmarks.smtp import DebugSMTPServer
+from src.tasks import task
+from src.tasks.smtp import SMTPPool, SMTPSendError
+from src.tasks.task import get_verification_email_template, send_verification_emails
+
+
+@pytest.fixture
+def smtp_server():
+    with DebugSMTPServer() as server:
+        yield server
+
+
+def _messages(*emails: str):
+    return [get_verification_email_template(email, "token") for email in emails]
+
+
+def test_smtp_pool_reuses_connection(smtp_server):
+    pool = SMTPPool("127.0.0.1", smtp_server.port, "none", max_messages=3)
+
+    for message in _messages("a@te.st", "b@te.st"):
+        assert pool.send([message]) == []
+    assert pool.send(_messages("c@te.st", "d@te.st", "e@te.st")) == []
+    pool.close()
+
+    assert len(smtp_server.messages) == 5
+    # A new connection after max_messages
+    assert smtp_server.connections == pool.connections == 2
+
+
+def test_smtp_pool_reconnects(smtp_server):
+    pool = SMTPPool("127.0.0.1", smtp_server.port, "none")
+    pool.send(_messages("a@te.st"))
+    # Closed by the server while idle
+    pool._server.sock.shutdown(socket.SHUT_RDWR)
+
+    assert pool.send(_messages("b@te.st")) == []
+    assert len(smtp_server.messages) == 2
+    assert pool.connections == 2
+
+
+def test_smtp_pool_reports_unsent():
+    pool = SMTPPool("127.0.0.1", 1, "none", timeout=1)
+    messages = _messages("a@te.st", "b@te.st")
+
+    with pytest.raises(SMTPSendError) as error:
+        pool.send(messages)
+    assert error.value.unsent == messages
+
+
+def test_send_verification_emails(smtp_server, monkeypatch):
+    pool = SMTPPool("127.0.0.1", smtp_server.port, "none")
+    monkeypatch.setattr(task, "smtp_pool", pool)
+
+    send_verification_emails.apply(
+        args=[[("a@te.st", "token-a"), ("refused@te.st", "token-r"), ("b@te.st", "token-b")]]
+    )
+
+    assert len(smtp_server.messages) == 2
+    assert b"To: b@te.st" in smtp_server.messages[1]
+    assert smtp_server.connections == 1
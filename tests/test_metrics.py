@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from httpx import AsyncClient
+from prometheus_client import REGISTRY
+from redis import asyncio as aioredis
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from src.cache import TwoTierBackend
+from src.config import (DB_HOST_TEST, DB_NAME_TEST, DB_PASS_TEST, DB_PORT_TEST,
+                        DB_USER_TEST, REDIS_HOST, REDIS_PORT)
+from src.database import create_engine
+from src.main import app
+from src.metrics import instrument_engine
+
+DATABASE_URL_TEST = f"postgresql+asyncpg://{DB_USER_TEST}:{DB_PASS_TEST}@{DB_HOST_TEST}:{DB_PORT_TEST}/{DB_NAME_TEST}"
+
+
+def _sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_metrics_endpoint_labels_routes():
+    labels = {"method": "GET", "route": "/benches/{bench_id}"}
+    before = _sample("http_request_duration_seconds_count", **labels)
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        await client.get("/benches/123456")
+        await client.get("/benches/654321")
+        await client.get("/no/such/path")
+        response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'route="/benches/{bench_id}"' in response.text
+    assert 'route="unmatched",status="404"' in response.text
+    # The metrics request itself
+    assert 'http_requests_in_progress{method="GET"} 1.0' in response.text
+    assert _sample("http_request_duration_seconds_count", **labels) == before + 2
+
+
+async def test_instrument_engine():
+    engine = create_engine(DATABASE_URL_TEST)
+    instrument_engine(engine, "test")
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+            with pytest.raises(DBAPIError):
+                await connection.execute(text("SELECT * FROM no_such_table"))
+            assert _sample("db_pool_checked_out", database="test") == 1
+    finally:
+        await engine.dispose()
+
+    assert _sample("db_query_duration_seconds_count", database="test", statement="SELECT") == 1
+    assert _sample("db_query_errors_total", database="test") == 1
+    assert _sample("db_pool_checked_out", database="test") == 0
+    assert _sample("db_pool_wait_seconds_count", database="test") == 1
+
+
+async def test_cache_lookups():
+    redis = aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}")
+    backend = TwoTierBackend(redis, max_bytes=1024, ttl=30)
+    before = {
+        result: _sample("cache_lookups_total", result=result)
+        for result in ("local", "redis", "miss")
+    }
+
+    await backend.get("test:metrics")
+    await redis.set("test:metrics", b"value", ex=60)
+    await backend.get("test:metrics")
+    await backend.get("test:metrics")
+
+    await redis.delete("test:metrics")
+    await redis.close()
+    for result in ("local", "redis", "miss"):
+        assert _sample("cache_lookups_total", result=result) == before[result] + 1
+
+
+def test_gunicorn_conf_enables_multiprocess_mode():
+    # Like the gunicorn master: the config first, then the app, in a fresh process
+    code = (
+        "import runpy; runpy.run_path('gunicorn.conf.py'); "
+        "from prometheus_client import values; print(values.ValueClass.__name__)"
+    )
+    env = {key: value for key, value in os.environ.items() if key != "PROMETHEUS_MULTIPROC_DIR"}
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "MmapedValue"
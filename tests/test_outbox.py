@@ -0,0 +1,102 @@
+import time
+
+import pytest
+import redis
+from celery.exceptions import Retry
+
+from benchmarks.smtp import DebugSMTPServer
+from src.config import REDIS_HOST, REDIS_PORT
+from src.tasks import outbox
+from src.tasks.outbox import (BACKOFF_MAX, BUCKET_KEY, OUTBOX_KEY, flush_outbox,
+                              queue_verification_email)
+from src.tasks.smtp import SMTPPool
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    for key in client.keys("mail:*"):
+        client.delete(key)
+    scheduled = []
+    monkeypatch.setattr(
+        outbox.flush_email_outbox, "apply_async", lambda countdown: scheduled.append(countdown)
+    )
+    client.scheduled = scheduled
+    yield client
+    for key in client.keys("mail:*"):
+        client.delete(key)
+    client.close()
+
+
+@pytest.fixture
+def pool():
+    with DebugSMTPServer() as server:
+        pool = SMTPPool("127.0.0.1", server.port, "none")
+        pool.server = server
+        yield pool
+        pool.close()
+
+
+def test_outbox_sends_batch(client, pool):
+    for i in range(3):
+        queue_verification_email(f"user{i}@te.st", f"token-{i}", client)
+
+    # One flush for the whole window
+    assert client.scheduled == [outbox.EMAIL_FLUSH_WINDOW]
+    assert flush_outbox(client, pool) is None
+    assert len(pool.server.messages) == 3
+    assert pool.server.connections == 1
+    assert client.llen(OUTBOX_KEY) == 0
+
+
+def test_outbox_rate_limit(client, pool):
+    now = time.time()
+    client.hset(BUCKET_KEY, mapping={"tokens": 2, "updated": now})
+    for i in range(5):
+        queue_verification_email(f"user{i}@te.st", "token", client)
+
+    delay = flush_outbox(client, pool, now=now)
+
+    assert len(pool.server.messages) == 2
+    assert client.llen(OUTBOX_KEY) == 3
+    assert delay == pytest.approx(1 / outbox.EMAIL_RATE_LIMIT)
+
+
+def test_outbox_backs_off_domain(client, pool):
+    now = time.time()
+    queue_verification_email("user@deferred.te.st", "token", client)
+    queue_verification_email("user@te.st", "token", client)
+
+    delay = flush_outbox(client, pool, now=now)
+    assert len(pool.server.messages) == 1
+    assert outbox.BACKOFF_BASE * 0.75 <= delay <= outbox.BACKOFF_BASE
+
+    # Not tried again before the backoff is over
+    queue_verification_email("other@te.st", "token", client)
+    flush_outbox(client, pool, now=now + 1)
+    assert len(pool.server.messages) == 2
+    assert client.llen(OUTBOX_KEY) == 1
+
+    flush_outbox(client, pool, now=now + BACKOFF_MAX)
+    assert client.llen(OUTBOX_KEY) == 1
+    assert b'"attempts": 2' in client.lindex(OUTBOX_KEY, 0)
+
+
+def test_failed_flush_is_retried(client, monkeypatch):
+    def fail(client, pool):
+        raise redis.ConnectionError("Connection refused")
+
+    retries = []
+
+    def retry(exc, countdown, max_retries):
+        retries.append(countdown)
+        return Retry(exc=exc, when=countdown)
+
+    monkeypatch.setattr(outbox, "flush_outbox", fail)
+    monkeypatch.setattr(outbox.flush_email_outbox, "retry", retry)
+    queue_verification_email("user@te.st", "token", client)
+
+    with pytest.raises(Retry):
+        outbox.flush_email_outbox()
+    assert len(retries) == 1
+    assert 0.75 * outbox.BACKOFF_BASE <= retries[0] <= outbox.BACKOFF_BASE
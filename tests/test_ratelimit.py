@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from src.auth.service import get_jwt_strategy
+from src.constants import OVERLOADED, RATE_LIMITED
+from src.ratelimit import RateLimit, RateLimitMiddleware, parse_rate_limits
+from src.shedding import LoadMonitor, LoadSheddingMiddleware
+from src.users.models import User
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("/benches=10/30, *=5") == {
+        "/benches": RateLimit(10, 30),
+        "*": RateLimit(5, 5),
+    }
+
+
+async def test_rate_limit_per_client():
+    limited = FastAPI()
+    limited.add_middleware(
+        RateLimitMiddleware, routes=limited.router.routes, limits={"/limited/{id}": RateLimit(1, 2)}
+    )
+
+    @limited.get("/limited/{id}")
+    async def limited_route(id: int):
+        return {}
+
+    @limited.get("/free")
+    async def free_route():
+        return {}
+
+    async with AsyncClient(app=limited, base_url="http://test") as client:
+        statuses = [(await client.get(f"/limited/{i}")).status_code for i in range(3)]
+        assert statuses == [200, 200, 429]
+        response = await client.get("/limited/1")
+        assert response.json()["error"]["code"] == RATE_LIMITED
+        assert response.headers["Retry-After"] == "1"
+        assert (await client.get("/free")).status_code == 200
+
+        # Users have buckets of their own
+        client.cookies["token"] = await get_jwt_strategy().write_token(User(id=1))
+        assert (await client.get("/limited/1")).status_code == 200
+
+
+async def test_load_shedding():
+    monitor = LoadMonitor(loop_lag=0.1, pool_wait=1)
+    shedding = FastAPI()
+    shedding.add_middleware(LoadSheddingMiddleware, monitor=monitor)
+
+    @shedding.get("/metrics")
+    async def metrics():
+        return {}
+
+    @shedding.get("/benches")
+    async def benches():
+        return {}
+
+    task = asyncio.create_task(monitor.run(interval=0.01))
+    await asyncio.sleep(0.05)
+    assert monitor.overload() == (0, None)
+    # Blocks the event loop
+    time.sleep(0.3)
+    await asyncio.sleep(0.02)
+    task.cancel()
+    share, reason = monitor.overload()
+    assert share > 0.5 and reason == "loop_lag"
+
+    monitor.values["loop_lag"] = 0.2
+
+    async with AsyncClient(app=shedding, base_url="http://test") as client:
+        response = await client.get("/benches")
+        assert response.status_code == 503
+        assert response.json()["error"]["code"] == OVERLOADED
+        assert (await client.get("/metrics")).status_code == 200
@@ -0,0 +1,97 @@
+import gc
+
+import pytest
+
+from src.benches.photos import PHOTO_MAX_SIZE, PhotoTooLargeError, store_photo
+from src.storage import LocalStorage, StorageError, StoredObject
+
+
+async def _chunks(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_local_storage(tmp_path):
+    storage = LocalStorage(tmp_path / "objects", tmp_path / "public", "http://media.test/")
+
+    await storage.write("a/b.png", b"data", "image/png")
+    assert await storage.read("a/b.png") == b"data"
+    assert await storage.stat("a/b.png") == StoredObject(4, "image/png")
+
+    await storage.rename("a/b.png", "c/d.png")
+    assert not await storage.exists("a/b.png")
+    # Only published objects are under the served directory
+    assert not (tmp_path / "public").exists()
+    assert await storage.publish("c/d.png") == "http://media.test/c/d.png"
+    assert (tmp_path / "public" / "c" / "d.png").read_bytes() == b"data"
+
+    await storage.write("c/d.png", b"new data", "image/png")
+    assert (tmp_path / "public" / "c" / "d.png").read_bytes() == b"new data"
+
+    await storage.delete("c/d.png")
+    assert await storage.stat("c/d.png") is None
+    assert not (tmp_path / "public" / "c" / "d.png").exists()
+
+    with pytest.raises(StorageError):
+        await storage.read("../outside")
+
+
+@pytest.mark.asyncio
+async def test_local_storage_drops_unfinished_writes(tmp_path):
+    storage = LocalStorage(tmp_path, tmp_path / "public", "http://media.test/")
+
+    writer = await storage.open_writer("a.png", "image/png")
+    await writer.write(b"partial")
+    del writer
+    gc.collect()
+
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == []
+
+
+@pytest.mark.asyncio
+async def test_store_photo_on_local_storage(tmp_path):
+    storage = LocalStorage(tmp_path, tmp_path / "public", "http://media.test/")
+    photo = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+    name, content_type = await store_photo(storage, _chunks(photo[:10], photo[10:]))
+    again, _ = await store_photo(storage, _chunks(photo))
+
+    assert again == name
+    assert content_type == "image/png"
+    assert (tmp_path / name).read_bytes() == photo
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == [tmp_path / name]
+
+
+@pytest.mark.asyncio
+async def test_store_photo_aborts_unfinished_upload(tmp_path):
+    storage = LocalStorage(tmp_path, tmp_path / "public", "http://media.test/")
+    photo = b"\x89PNG\r\n\x1a\n" + bytes(PHOTO_MAX_SIZE)
+
+    # The traceback keeps the writer alive, only abort() removes its file
+    with pytest.raises(PhotoTooLargeError) as error:
+        await store_photo(storage, _chunks(photo[:16], photo[16:]))
+
+    assert error.traceback
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == []
+
+
+@pytest.mark.asyncio
+async def test_storage_retries_transient_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.storage.RETRY_DELAY", 0)
+    storage = LocalStorage(tmp_path, tmp_path / "public", "http://media.test/", retries=2)
+    storage.is_transient = lambda error: isinstance(error, ConnectionError)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("reset")
+        return "ok"
+
+    assert await storage._call(flaky) == "ok"
+
+    calls.clear()
+    with pytest.raises(StorageError):
+        await storage._call(flaky, retry=False)
+    assert len(calls) == 1